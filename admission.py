@@ -0,0 +1,149 @@
+'''
+Admission control of the Flask routes (see admission_control).
+
+Each route is gated by the adaptive concurrency limit of the dependency it
+mostly waits on. When a dependency's latency exceeds its SLO the limit
+shrinks and requests are shed with a 503, lowest priority first.
+ROUTE_PRIORITIES overrides priorities, e.g. "get_chat_history=low".
+
+A request takes a slot of its dependency's limit before its route runs, and
+returns it once the response has been sent, which for streamed responses is
+when the stream ends.
+'''
+
+import math
+import os
+import time
+
+from flask import g, jsonify, request
+
+from admission_control import AdaptiveConcurrencyLimit, parse_route_priorities
+
+ADMISSION_CONTROL = os.environ.get("ADMISSION_CONTROL", "1") == "1"
+ROUTE_DEPENDENCIES = {
+    "chatbot_response": "sagemaker",
+    "chatbot_response_stream": "sagemaker",
+    "get_chat_history": "s3",
+    "get_chat": "s3",
+    "user_authentication": "dynamodb",
+    "user_creation": "dynamodb",
+    "list_chats": "dynamodb",
+    "new_chat": "dynamodb",
+}
+ROUTE_PRIORITIES = {
+    "user_authentication": "high",
+    "user_creation": "high",
+    "new_chat": "high",
+    **parse_route_priorities(os.environ.get("ROUTE_PRIORITIES", "")),
+}
+
+
+def retry_later_response(status_code: int, message: str, retry_after: float):
+    """
+    Builds an error response telling the client when to retry
+    - status_code: int, 429 or 503
+    - message: string
+    - retry_after: float, in seconds
+    """
+    response = jsonify({"status_code": status_code, "message": message})
+    response.status_code = status_code
+    response.headers["Retry-After"] = str(max(1, math.ceil(retry_after)))
+    return response
+
+
+def dependency_limits(sagemaker_initial_limit: int, sagemaker_max_limit: int):
+    """
+    Returns the adaptive concurrency limit of each dependency
+    - sagemaker_initial_limit: int
+    - sagemaker_max_limit: int, calls the SageMaker clients can hold in flight
+    """
+    return {
+        "sagemaker": AdaptiveConcurrencyLimit(
+            latency_slo_ms=float(os.environ.get("SAGEMAKER_LATENCY_SLO_MS", 20000)),
+            initial_limit=sagemaker_initial_limit,
+            min_limit=4,
+            max_limit=sagemaker_max_limit,
+        ),
+        "s3": AdaptiveConcurrencyLimit(
+            latency_slo_ms=float(os.environ.get("S3_LATENCY_SLO_MS", 2000)),
+            initial_limit=64,
+            min_limit=4,
+            max_limit=512,
+        ),
+        "dynamodb": AdaptiveConcurrencyLimit(
+            latency_slo_ms=float(os.environ.get("DYNAMODB_LATENCY_SLO_MS", 500)),
+            initial_limit=64,
+            min_limit=4,
+            max_limit=512,
+        ),
+    }
+
+
+class RouteAdmission:
+    """
+    Admits or sheds the requests of a Flask app by route
+    - limits: dict of dependency name to AdaptiveConcurrencyLimit
+    - route_dependencies: dict of endpoint name to dependency name; other
+      routes are not gated
+    - route_priorities: dict of endpoint name to priority, "normal" if absent
+    """
+
+    def __init__(self, limits: dict, route_dependencies: dict, route_priorities: dict):
+        self.limits = limits
+        self.route_dependencies = route_dependencies
+        self.route_priorities = route_priorities
+
+    def init_app(self, app):
+        """
+        Registers the admission hooks on the app
+        - app: Flask
+        """
+        app.before_request(self.admit_request)
+        app.after_request(self.release_admission)
+        app.teardown_request(self.release_admission_on_error)
+
+    def admit_request(self):
+        """
+        Sheds the request with a 503 if the dependency its route waits on has
+        no room for the route's priority
+        """
+        dependency = self.route_dependencies.get(request.endpoint)
+        if dependency is None or request.method == "OPTIONS":
+            return None
+        limit = self.limits[dependency]
+        if not limit.try_acquire(self.route_priorities.get(request.endpoint, "normal")):
+            return retry_later_response(
+                503, "The server is busy. Try again shortly.", limit.retry_after()
+            )
+        g.admission = (limit, time.monotonic())
+        return None
+
+    def release_admission(self, response):
+        """
+        Returns the request's admission slot once the response has been sent,
+        which for streamed responses is when the stream ends
+        """
+        admission = g.pop("admission", None)
+        if admission is not None:
+            limit, started = admission
+            overloaded = response.status_code == 503
+            response.call_on_close(
+                lambda: limit.release(time.monotonic() - started, overloaded)
+            )
+        return response
+
+    def release_admission_on_error(self, error=None):
+        """
+        Returns the admission slot of a request that failed before a response
+        was made
+        """
+        admission = g.pop("admission", None)
+        if admission is not None:
+            limit, started = admission
+            limit.release(time.monotonic() - started, overloaded=error is not None)
+
+    def stats(self):
+        """
+        Returns the limit, in-flight requests and shed counts per dependency
+        """
+        return {dependency: limit.stats() for dependency, limit in self.limits.items()}
@@ -0,0 +1,131 @@
+'''
+Latency-driven admission control with route priorities.
+
+Every downstream dependency (the inference endpoint, S3, DynamoDB) gets an
+AdaptiveConcurrencyLimit that is tuned with AIMD (additive increase,
+multiplicative decrease): requests that finish within the dependency's
+latency SLO raise the limit by about one per limit's worth of requests, and
+a request that misses the SLO or fails with an overload error cuts it by a
+constant factor, at most once per SLO period.
+
+Requests are admitted while the dependency has room for their priority:
+low-priority requests may only use part of the limit, so as latency climbs
+and the limit shrinks they are shed first, while high-priority requests
+keep getting through.
+'''
+
+import math
+import threading
+import time
+
+from metrics import Histogram
+
+# Fraction of a dependency's limit that requests of each priority may use
+PRIORITY_SHARES = {"high": 1.0, "normal": 0.8, "low": 0.5}
+LATENCY_MS_BUCKETS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000]
+
+
+def parse_route_priorities(value: str):
+    """
+    Parses "endpoint=priority,..." into a dict, e.g.
+    "get_chat_history=low,user_authentication=high". Raises ValueError on an
+    unknown priority
+    - value: string
+    """
+    priorities = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        endpoint, _, priority = item.partition("=")
+        if priority not in PRIORITY_SHARES:
+            raise ValueError(f"Unknown priority {priority!r} for {endpoint}")
+        priorities[endpoint.strip()] = priority
+    return priorities
+
+
+class AdaptiveConcurrencyLimit:
+    """
+    AIMD concurrency limit for one dependency
+    - latency_slo_ms: float, requests slower than this count as congestion
+    - initial_limit: int
+    - min_limit: int
+    - max_limit: int
+    - backoff: float, factor the limit is multiplied by on congestion
+    """
+
+    def __init__(
+        self,
+        latency_slo_ms: float,
+        initial_limit: int,
+        min_limit: int,
+        max_limit: int,
+        backoff: float = 0.9,
+    ):
+        self.latency_slo = latency_slo_ms / 1000
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.limit = float(initial_limit)
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+        self._counters = {"admitted": 0, "decreases": 0}
+        self._shed = {priority: 0 for priority in PRIORITY_SHARES}
+        self.latency_ms = Histogram(LATENCY_MS_BUCKETS)
+
+    def try_acquire(self, priority: str):
+        """
+        Admits a request if the dependency has room for its priority.
+        Returns False when the request should be shed
+        - priority: string, a key of PRIORITY_SHARES
+        """
+        with self._lock:
+            if self.in_flight >= max(1, int(self.limit * PRIORITY_SHARES[priority])):
+                self._shed[priority] += 1
+                return False
+            self.in_flight += 1
+            self._counters["admitted"] += 1
+            return True
+
+    def release(self, latency: float, overloaded: bool = False):
+        """
+        Records a finished request and adjusts the limit
+        - latency: float, in seconds
+        - overloaded: bool, the request failed because the dependency is
+          overloaded or unavailable
+        """
+        self.latency_ms.observe(latency * 1000)
+        now = time.monotonic()
+        with self._lock:
+            self.in_flight -= 1
+            if overloaded or latency > self.latency_slo:
+                # Requests that finish together saw the same congestion;
+                # back off once for them
+                if now - self._last_decrease >= self.latency_slo:
+                    self.limit = max(self.min_limit, self.limit * self.backoff)
+                    self._last_decrease = now
+                    self._counters["decreases"] += 1
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def retry_after(self):
+        """
+        Returns a whole number of seconds to wait before retrying a shed
+        request: the mean latency, at least 1
+        """
+        mean_ms = self.latency_ms.stats()["mean"] or 0
+        return max(1, math.ceil(mean_ms / 1000))
+
+    def stats(self):
+        """
+        Returns the current limit, requests in flight, admitted and shed
+        counts and the latency distribution
+        """
+        with self._lock:
+            stats = {
+                "limit": self.limit,
+                "in_flight": self.in_flight,
+                "latency_slo_ms": self.latency_slo * 1000,
+                **self._counters,
+                "shed": dict(self._shed),
+            }
+        stats["latency_ms"] = self.latency_ms.stats()
+        return stats
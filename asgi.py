@@ -0,0 +1,183 @@
+'''
+Asynchronous (ASGI) serving mode for the backend.
+
+Run with an ASGI server instead of `python backend.py`, e.g.
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+
+Requests are accepted on an asyncio event loop and served by the same Flask
+routes. Each handler runs on a bounded thread pool chosen by route, so
+the event loop itself never blocks on boto3:
+- inference routes run on INFERENCE_EXECUTOR. It is sized so that around a
+  thousand SageMaker calls can wait in flight at once
+- every other route runs on ROUTE_EXECUTOR. Authentication and history
+  requests therefore never queue behind in-flight generations
+'''
+
+import asyncio
+import io
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import backend
+
+INFERENCE_ROUTES = {"/chatbot_response", "/chatbot_response_stream"}
+INFERENCE_EXECUTOR = ThreadPoolExecutor(
+    max_workers=backend.SAGEMAKER_MAX_IN_FLIGHT, thread_name_prefix="inference"
+)
+ROUTE_EXECUTOR = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("ASGI_ROUTE_THREADS", 32)),
+    thread_name_prefix="route",
+)
+# Called with no arguments when the server shuts down
+SHUTDOWN_HOOKS = []
+if backend.HISTORY_WRITER is not None:
+    SHUTDOWN_HOOKS.append(backend.HISTORY_WRITER.close)
+
+
+def build_environ(scope: dict, body: bytes):
+    """
+    Translates an ASGI HTTP scope and request body into a WSGI environ
+    - scope: dict
+    - body: bytes
+    """
+    server_name, server_port = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server_name,
+        "SERVER_PORT": str(server_port),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": (scope.get("client") or ("", 0))[0],
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = value
+            continue
+        if name == "CONTENT_LENGTH":
+            continue
+        key = f"HTTP_{name}"
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+def start_wsgi_response(environ: dict):
+    """
+    Runs the Flask app for one request and returns its status, headers, the
+    body iterable and the first body chunk (None if the body is empty).
+    Called on an executor thread
+    - environ: dict
+    """
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        if exc_info is not None and started:
+            raise exc_info[1].with_traceback(exc_info[2])
+        started["status"] = status
+        started["headers"] = headers
+
+    result = backend.app(environ, start_response)
+    chunks = iter(result)
+    first_chunk = next(chunks, None)
+    return started["status"], started["headers"], result, chunks, first_chunk
+
+
+async def read_body(receive):
+    """
+    Reads the full request body from the ASGI receive channel
+    - receive: ASGI receive callable
+    """
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            break
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+    return bytes(body)
+
+
+async def serve_http(scope: dict, receive, send):
+    """
+    Serves one HTTP request through the Flask app on the executor for its
+    route, streaming the response body chunk by chunk
+    - scope: dict
+    - receive: ASGI receive callable
+    - send: ASGI send callable
+    """
+    loop = asyncio.get_running_loop()
+    executor = (
+        INFERENCE_EXECUTOR if scope["path"] in INFERENCE_ROUTES else ROUTE_EXECUTOR
+    )
+    environ = build_environ(scope, await read_body(receive))
+
+    status, headers, result, chunks, chunk = await loop.run_in_executor(
+        executor, start_wsgi_response, environ
+    )
+    try:
+        await send(
+            {
+                "type": "http.response.start",
+                "status": int(status.split(" ", 1)[0]),
+                "headers": [
+                    (name.lower().encode("latin-1"), value.encode("latin-1"))
+                    for name, value in headers
+                ],
+            }
+        )
+        # Streamed responses (NDJSON, SSE) are pulled one chunk at a time
+        while chunk is not None:
+            if chunk:
+                await send(
+                    {"type": "http.response.body", "body": chunk, "more_body": True}
+                )
+            chunk = await loop.run_in_executor(executor, next, chunks, None)
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+    finally:
+        if hasattr(result, "close"):
+            await loop.run_in_executor(executor, result.close)
+
+
+async def serve_lifespan(receive, send):
+    """
+    Handles server startup and shutdown, running SHUTDOWN_HOOKS on shutdown
+    - receive: ASGI receive callable
+    - send: ASGI send callable
+    """
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            loop = asyncio.get_running_loop()
+            for hook in SHUTDOWN_HOOKS:
+                await loop.run_in_executor(None, hook)
+            INFERENCE_EXECUTOR.shutdown(wait=True)
+            ROUTE_EXECUTOR.shutdown(wait=True)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    """
+    ASGI entry point
+    """
+    if scope["type"] == "http":
+        await serve_http(scope, receive, send)
+    elif scope["type"] == "lifespan":
+        await serve_lifespan(receive, send)
+    else:
+        raise ValueError(f"Unsupported ASGI scope type: {scope['type']}")
@@ -6,15 +6,89 @@ This file is used for running the flask application and connecting to different
 - DynamoDB
 '''
 
-import json
+import atexit
 import os
+import signal
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 import boto3
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
+from admission import (
+    ADMISSION_CONTROL,
+    ROUTE_DEPENDENCIES,
+    ROUTE_PRIORITIES,
+    RouteAdmission,
+    dependency_limits,
+    retry_later_response,
+)
+from chat_cache import CachedChat, ChatCache
+from chat_index import ChatIndex
+from chat_summarizer import ChatSummarizer, turns_after_summary
+from circuit_breaker import EndpointUnavailable, InvalidModelRequest, ResilientEndpoint
+from chat_segments import SegmentedChatStore
+from chat_store import (
+    BoundedS3Client,
+    chat_key,
+    list_chat_objects,
+    manifest_key,
+    read_array_turns,
+)
+from context_builder import ContextBuilder, TokenCounter
+from history_append import HistoryAppender
+from history_journal import HistoryJournal
+from history_pages import (
+    NDJSON_MIMETYPE,
+    changed_since,
+    chat_history_etag,
+    chat_history_response,
+    fetch_chats,
+    get_optional_chat_ids,
+    get_optional_positive_int,
+    not_modified_response,
+    page_of,
+    stream_response,
+)
+from history_writer import LambdaHistorySink, WriteBehindBuffer
+import json_codec
+from micro_batcher import MicroBatcher, parse_batch_response
+from rate_limits import (
+    INFERENCE_MAX_CONCURRENT,
+    build_inference_scheduler,
+    build_rate_limiter,
+    init_app as init_rate_limits,
+)
+from recent_turns import RECENT_TURNS, has_recent_turns, merge_recent_turns
+from reply_cache import cached_reply, stats as reply_cache_stats
+from sagemaker_stream import ModelStreamError, iter_tgi_tokens
+
+
+class CodecJSONProvider(DefaultJSONProvider):
+    """
+    Routes Flask's request parsing and jsonify responses through json_codec
+    """
+
+    def dumps(self, obj, **kwargs):
+        return json_codec.dumps(obj, default=self.default).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return json_codec.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            json_codec.dumps(obj, default=self.default), mimetype=self.mimetype
+        )
+
+
 app = Flask(__name__)
+app.json = CodecJSONProvider(app)
 
 # Cors - Change this for Prod
 CORS(
@@ -24,7 +98,9 @@ CORS(
             "origins": [
                 "http://localhost:5173",
                 "https://main.ds37782qp0di8.amplifyapp.com",
-            ]
+            ],
+            # Lets the client read the tag it sends back in If-None-Match
+            "expose_headers": ["ETag"],
         }
     },
 )
@@ -40,24 +116,182 @@ USER_METADATA_TABLE_NAME = "user-metadata"
 DYNAMODB_RESOURCE = boto3.resource("dynamodb")
 DYNAMODB_TABLE = "user-metadata"
 USER_METADATA_TABLE = DYNAMODB_RESOURCE.Table(USER_METADATA_TABLE_NAME)
+# One summary item per chat, for the chat listing (see chat_index)
+CHAT_INDEX_TABLE_NAME = "chat-index"
+CHAT_INDEX = ChatIndex(DYNAMODB_RESOURCE.Table(CHAT_INDEX_TABLE_NAME), title_length=60)
+# New turns are counted in the chat index from this pool, off the request path
+CHAT_INDEX_EXECUTOR = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("CHAT_INDEX_MAX_CONCURRENCY", 8)),
+    thread_name_prefix="chat-index",
+)
+# Per-user rate limits of the inference routes (see rate_limits)
+RATE_LIMITER = build_rate_limiter(DYNAMODB_RESOURCE)
+init_rate_limits(app)
 
 # SageMaker Parameters
-SAGEMAKER_RESOURCE = boto3.client(
-    "sagemaker-runtime",
-    aws_access_key_id="REMOVED_FOR_SECURITY",
-    aws_secret_access_key="REMOVED_FOR_SECURITY",
-    region_name="us-east-2",
-)
+# Upper bound on concurrent invocations; sizes the client's connection pool
+# and the inference thread pool of the ASGI serving mode (asgi.py)
+SAGEMAKER_MAX_IN_FLIGHT = int(os.environ.get("SAGEMAKER_MAX_IN_FLIGHT", 1024))
+# botocore fixes the read timeout per client, so there is one client per
+# timeout bucket and each call picks one from recent latencies. Retries are
+# left to the circuit breaker and failover instead of botocore
+SAGEMAKER_TIMEOUT_BUCKETS = [5, 10, 20, 40, 60]
+SAGEMAKER_CONNECT_TIMEOUT = 2
+SAGEMAKER_CLIENTS = {
+    read_timeout: boto3.client(
+        "sagemaker-runtime",
+        aws_access_key_id="REMOVED_FOR_SECURITY",
+        aws_secret_access_key="REMOVED_FOR_SECURITY",
+        region_name="us-east-2",
+        config=Config(
+            max_pool_connections=SAGEMAKER_MAX_IN_FLIGHT,
+            connect_timeout=SAGEMAKER_CONNECT_TIMEOUT,
+            read_timeout=read_timeout,
+            retries={"total_max_attempts": 1},
+        ),
+    )
+    for read_timeout in SAGEMAKER_TIMEOUT_BUCKETS
+}
+# Model calls in flight at once; past this, users take turns for freed slots
+INFERENCE_SCHEDULER = build_inference_scheduler()
 SAGEMAKER_ENDPOINT_NAME = "huggingface-pytorch-tgi-inference-2024-12-08-15-56-08-806"
+# Optional endpoint that takes over while the primary's circuit is open
+SAGEMAKER_SECONDARY_ENDPOINT_NAME = os.environ.get("SAGEMAKER_SECONDARY_ENDPOINT_NAME")
+SAGEMAKER_ENDPOINT = ResilientEndpoint(
+    SAGEMAKER_CLIENTS,
+    [SAGEMAKER_ENDPOINT_NAME]
+    + ([SAGEMAKER_SECONDARY_ENDPOINT_NAME] if SAGEMAKER_SECONDARY_ENDPOINT_NAME else []),
+    failure_threshold=int(os.environ.get("SAGEMAKER_BREAKER_FAILURES", 5)),
+    reset_timeout_seconds=float(os.environ.get("SAGEMAKER_BREAKER_RESET_SECONDS", 30)),
+)
+INSTRUCTIONS = """You are a friendly and empathetic companion.
+    Engage in meaningful conversations, respond empathetically to the user's
+    feelings and thoughts, and gently decline inappropriate or harmful topics. 
+    Respond to this prompt only:
+    """
+GENERATION_PARAMETERS = {
+    "max_new_tokens": 100,
+    "temperature": 0.7,
+    "top_p": 0.9,
+    "return_full_text": False,
+}
+# Micro-batching of concurrent prompts into one request with a list of inputs.
+# Off by default: the TGI container only takes a single string input (and
+# batches internally), batching needs a container that accepts input lists
+INFERENCE_BATCHING = os.environ.get("INFERENCE_BATCHING", "0") == "1"
+INFERENCE_BATCH_MAX_SIZE = int(os.environ.get("INFERENCE_BATCH_MAX_SIZE", 8))
+INFERENCE_BATCH_MAX_WAIT_MS = float(os.environ.get("INFERENCE_BATCH_MAX_WAIT_MS", 5))
+# Recent turns of the chat are prepended to the model input, newest first,
+# within CONTEXT_TOKEN_BUDGET input tokens (instructions and prompt included).
+# At most CONTEXT_MAX_TURNS turns are read; a budget of 0 sends the prompt alone
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", 768))
+CONTEXT_MAX_TURNS = int(os.environ.get("CONTEXT_MAX_TURNS", 20))
+CONTEXT_HEADER = "Conversation so far:\n"
+CONTEXT_BUILDER = None
+if CONTEXT_TOKEN_BUDGET > 0:
+    CONTEXT_BUILDER = ContextBuilder(
+        TokenCounter(
+            max_entries=int(os.environ.get("TOKEN_COUNT_CACHE_MAX_ENTRIES", 100000)),
+            tokenizer_file=os.environ.get("CONTEXT_TOKENIZER_FILE"),
+        ),
+        CONTEXT_TOKEN_BUDGET,
+    )
+# Rolling chat summaries, regenerated in the background every
+# SUMMARY_EVERY_TURNS turns (0 disables them). Prompts carry the summary plus
+# the turns after it; the newest SUMMARY_RECENT_TURNS turns are never folded
+# in. Summaries are generated at most once per SUMMARY_MIN_INTERVAL_SECONDS
+SUMMARY_EVERY_TURNS = int(os.environ.get("SUMMARY_EVERY_TURNS", 10))
+SUMMARY_RECENT_TURNS = int(os.environ.get("SUMMARY_RECENT_TURNS", 4))
+SUMMARY_MIN_INTERVAL_SECONDS = float(os.environ.get("SUMMARY_MIN_INTERVAL_SECONDS", 2))
+SUMMARY_MAX_PENDING = int(os.environ.get("SUMMARY_MAX_PENDING", 100))
+# How long a chat found without a summary is not looked up again
+SUMMARY_MISSING_TTL_SECONDS = float(os.environ.get("SUMMARY_MISSING_TTL_SECONDS", 60))
+SUMMARY_MAX_NEW_TOKENS = 150
+SUMMARY_HEADER = "Summary of the earlier conversation:\n"
 
 # S3 Parameters
-
-S3_CLIENT = boto3.client("s3")
+# Every S3 request (fetches, tail reads, listings, puts, deletes) takes a slot
+# of one process-wide limit, so S3_MAX_CONCURRENCY bounds the requests in
+# flight across all requests and background work, not per request
+S3_MAX_CONCURRENCY = int(os.environ.get("S3_MAX_CONCURRENCY", 16))
+S3_CLIENT = BoundedS3Client(
+    boto3.client("s3", config=Config(max_pool_connections=S3_MAX_CONCURRENCY)),
+    S3_MAX_CONCURRENCY,
+)
+S3_EXECUTOR = ThreadPoolExecutor(
+    max_workers=S3_MAX_CONCURRENCY, thread_name_prefix="s3-fetch"
+)
 BUCKET_NAME = "ece1779-chat-history"
+# Budget for cached chats; keep well under the 512 MB task memory
+CHAT_CACHE_MAX_BYTES = int(os.environ.get("CHAT_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+CHAT_CACHE = ChatCache(S3_CLIENT, BUCKET_NAME, CHAT_CACHE_MAX_BYTES)
+# Any chat file this small is the empty "[]" placeholder and is not fetched
+EMPTY_CHAT = b"[]"
+# Streamed histories keep at most this many chat fetches in flight
+CHAT_STREAM_WINDOW = S3_MAX_CONCURRENCY
+# Chat storage format: "array" rewrites {username}/{chat_id}.json on every
+# turn, "segments" appends segment objects listed by a manifest and compacts
+# them in the background. Array chats are migrated on their next turn
+CHAT_STORAGE = os.environ.get("CHAT_STORAGE", "array")
+CHAT_SMALL_SEGMENT_BYTES = 64 * 1024
+CHAT_COMPACT_MIN_SEGMENTS = 8
+CHAT_SEGMENTS = None
+if CHAT_STORAGE == "segments":
+    CHAT_SEGMENTS = SegmentedChatStore(
+        CHAT_CACHE,
+        CHAT_SMALL_SEGMENT_BYTES,
+        CHAT_COMPACT_MIN_SEGMENTS,
+        max_pending=1000,
+    )
 
 # Lambda Parameters
 LAMBDA_CLIENT = boto3.client("lambda")
 LAMBDA_FUNCTION_NAME = "AddChatHistory"
+# Write-behind of chat history appends. "lambda" queues turns and invokes
+# AddChatHistory from a background thread, "s3" appends to the chat files
+# directly and "off" invokes the Lambda on the request path. Queued turns are
+# flushed every HISTORY_FLUSH_MAX_ENTRIES turns or HISTORY_FLUSH_INTERVAL_SECONDS
+HISTORY_WRITE_BEHIND = os.environ.get("HISTORY_WRITE_BEHIND", "lambda")
+HISTORY_FLUSH_MAX_ENTRIES = int(os.environ.get("HISTORY_FLUSH_MAX_ENTRIES", 64))
+HISTORY_FLUSH_INTERVAL_SECONDS = float(
+    os.environ.get("HISTORY_FLUSH_INTERVAL_SECONDS", 0.5)
+)
+# Send every flush as one invocation (history_append.lambda_handler accepts
+# batches); 0 sends one invocation per turn, for a Lambda that does not
+HISTORY_LAMBDA_BATCHED = os.environ.get("HISTORY_LAMBDA_BATCHED", "1") == "1"
+# Directory of the local journal that keeps queued turns across restarts (no
+# journal when unset). It must be on a volume that outlives the container
+HISTORY_JOURNAL_DIR = os.environ.get("HISTORY_JOURNAL_DIR")
+HISTORY_JOURNAL_SEGMENT_BYTES = 16 * 1024 * 1024
+HISTORY_WRITER = None
+if HISTORY_WRITE_BEHIND in ("lambda", "s3"):
+    HISTORY_WRITER = WriteBehindBuffer(
+        (
+            HistoryAppender(CHAT_CACHE, executor=S3_EXECUTOR, segments=CHAT_SEGMENTS)
+            if HISTORY_WRITE_BEHIND == "s3"
+            else LambdaHistorySink(
+                LAMBDA_CLIENT, LAMBDA_FUNCTION_NAME, batched=HISTORY_LAMBDA_BATCHED
+            )
+        ),
+        HISTORY_FLUSH_MAX_ENTRIES,
+        HISTORY_FLUSH_INTERVAL_SECONDS,
+        journal=(
+            HistoryJournal(HISTORY_JOURNAL_DIR, HISTORY_JOURNAL_SEGMENT_BYTES)
+            if HISTORY_JOURNAL_DIR
+            else None
+        ),
+    )
+    # Queued turns are written before the process exits
+    atexit.register(HISTORY_WRITER.close)
+
+# Admission control by route (see admission), off with ADMISSION_CONTROL=0
+ADMISSION = RouteAdmission(
+    dependency_limits(2 * INFERENCE_MAX_CONCURRENT, SAGEMAKER_MAX_IN_FLIGHT),
+    ROUTE_DEPENDENCIES,
+    ROUTE_PRIORITIES,
+)
+if ADMISSION_CONTROL:
+    ADMISSION.init_app(app)
 
 
 def check_dynamo_db_user_name(username: str):
@@ -69,60 +303,427 @@ def check_dynamo_db_user_name(username: str):
     return response
 
 
-@app.route("/chatbot_response", methods=["POST"])
-def chatbot_response():
+def fetch_chat(username: str, chat):
     """
-    Run model invocation by calling SageMaker Inference Endpoint
+    Reads a single listed chat file through the chat cache and returns the
+    cached entry (ETag, parsed chat and its JSON encoding), including turns
+    that are not persisted yet, or None if the chat file no longer exists
     - username: string
-    - chat_id: int 
+    - chat: ChatObject
+    """
+    if CHAT_SEGMENTS is not None and chat.key == manifest_key(username, chat.chat_id):
+        try:
+            entry = CHAT_SEGMENTS.fetch(username, chat.chat_id, etag=chat.etag)
+        except ClientError as e:
+            raise FileNotFoundError(f"Error accessing the S3 file: {str(e)}") from e
+        return None if entry is None else merge_recent_turns(username, chat.chat_id, entry)
+
+    if chat.size <= len(EMPTY_CHAT):
+        entry = CachedChat(etag=chat.etag, chat=[], encoded=EMPTY_CHAT, size=0)
+        return merge_recent_turns(username, chat.chat_id, entry)
+
+    try:
+        entry = CHAT_CACHE.fetch(chat.key, etag=chat.etag)
+    except ClientError as e:
+        raise FileNotFoundError(f"Error accessing the S3 file: {str(e)}") from e
+
+    if entry is None:
+        print(f"Key not found: {chat.key}")
+        return None
+    print(f"Successfully read JSON from S3: {chat.key}")
+    return merge_recent_turns(username, chat.chat_id, entry)
+
+
+def read_stored_turns(username: str, chat_id: int, last_n_turns: int = None):
+    """
+    Reads a chat, or only its last turns, as stored in S3. Returns (turns,
+    has_more, first) like read_chat_turns, or None if the chat does not exist
+    - username: string
+    - chat_id: int
+    - last_n_turns: int (optional, defaults to every turn)
+    """
+    try:
+        if CHAT_SEGMENTS is not None:
+            return CHAT_SEGMENTS.read_turns(username, chat_id, last_n_turns)
+        return read_array_turns(CHAT_CACHE, chat_key(username, chat_id), last_n_turns)
+    except ClientError as e:
+        raise FileNotFoundError(f"Error accessing the S3 file: {str(e)}") from e
+
+
+def read_chat_turns(username: str, chat_id: int, last_n_turns: int = None):
+    """
+    Reads a chat, or only its last turns. Returns (turns, has_more, first),
+    or None if the chat does not exist; first is the index of the first
+    returned turn in the chat, or None if it is unknown (see
+    chat_store.read_array_turns). Only the end of an array chat file, or the
+    newest segments of a segmented chat, are downloaded unless the chat is
+    already cached. Turns that are not persisted yet are included
+    - username: string
+    - chat_id: int
+    - last_n_turns: int (optional, defaults to every turn)
+    """
+    tail = read_stored_turns(username, chat_id, last_n_turns)
+    if tail is None:
+        return None
+
+    turns, has_more, first = tail
+    if has_recent_turns(username, chat_id):
+        if first is None:
+            # The overlay needs the number of stored turns; the whole chat is
+            # read instead, and cached
+            tail = read_stored_turns(username, chat_id)
+            if tail is None:
+                return None
+            turns, has_more, first = tail
+        turns = turns + RECENT_TURNS.pending(username, chat_id, first + len(turns))
+    if last_n_turns is not None and len(turns) > last_n_turns:
+        if first is not None:
+            first += len(turns) - last_n_turns
+        turns, has_more = turns[-last_n_turns:], True
+    return turns, has_more, first
+
+
+def build_context(username: str, chat_id: int, prompt: str):
+    """
+    Returns the chat's rolling summary, if it has one, and the recent turns
+    after it that fit in the context token budget, rendered as model input,
+    or an empty string if there are none. The summary and the turns are read
+    in parallel. Failing to read them only costs the context, not the request
+    - username: string
+    - chat_id: int
     - prompt: string
     """
-    data = request.get_json()
-    print(data)
+    if CONTEXT_BUILDER is None:
+        return ""
+    summary_future = None
+    if CHAT_SUMMARIZER is not None:
+        summary_future = S3_EXECUTOR.submit(CHAT_SUMMARIZER.get, username, chat_id)
+    try:
+        tail = read_chat_turns(username, chat_id, CONTEXT_MAX_TURNS)
+        summary = summary_future.result() if summary_future is not None else None
+        if summary is not None and tail is not None and tail[2] is None:
+            # Skipping the summarized turns needs the index of the tail's
+            # first turn; the whole chat is read instead, and cached
+            tail = read_chat_turns(username, chat_id)
+    except (ClientError, FileNotFoundError) as e:
+        print(f"Failed to read context for {username}/{chat_id}: {e}")
+        return ""
+    if tail is None:
+        return ""
+
+    turns, _, first = tail
+    prefix = ""
+    if summary is not None:
+        # Only the turns after the summary are sent verbatim
+        turns = turns_after_summary(turns, first, summary)[-CONTEXT_MAX_TURNS:]
+        prefix = f"{SUMMARY_HEADER}{summary['summary']}\n"
+    context, _ = CONTEXT_BUILDER.build(
+        turns, CONTEXT_HEADER + prefix + INSTRUCTIONS + prompt
+    )
+    return prefix + context
 
-    instructions = """You are a friendly and empathetic companion.
-    Engage in meaningful conversations, respond empathetically to the user's
-    feelings and thoughts, and gently decline inappropriate or harmful topics. 
-    Respond to this prompt only:
+
+def build_generation_payload(prompt: str, context: str = ""):
     """
-    payload = {
-        "inputs": instructions + data["prompt"],
-        "parameters": {
-            "max_new_tokens": 100,
-            "temperature": 0.7,
-            "top_p": 0.9,
-            "return_full_text": False,
-        },
+    Builds the TGI request body for a user prompt
+    - prompt: string
+    - context: string (optional), earlier turns as built by build_context
+    """
+    inputs = INSTRUCTIONS + prompt
+    if context:
+        inputs = f"{CONTEXT_HEADER}{context}\n{inputs}"
+    return {
+        "inputs": inputs,
+        "parameters": dict(GENERATION_PARAMETERS),
     }
 
-    model_response = SAGEMAKER_RESOURCE.invoke_endpoint(
-        EndpointName=SAGEMAKER_ENDPOINT_NAME,
+
+def invoke_endpoint(payload: dict):
+    """
+    Sends one request to the SageMaker inference endpoint, or to the
+    secondary endpoint while the primary is unavailable, and returns the
+    decoded response
+    - payload: dict
+    """
+    model_response = SAGEMAKER_ENDPOINT.invoke(
+        "invoke_endpoint",
         ContentType="application/json",
-        Body=json.dumps(payload).encode("utf-8"),
+        Body=json_codec.dumps(payload),
     )
+    return json_codec.loads(model_response["Body"].read())
 
-    model_response = model_response["Body"].read().decode("utf-8")
-    model_response = json.loads(model_response)
-    model_reply = model_response[0]["generated_text"][1:]
 
-    print(f"Model Response: {model_reply}")
+def send_generation_batch(inputs: list, parameters: dict):
+    """
+    Sends a batch of prompts as one request and returns the generated text
+    for each of them
+    - inputs: list of string
+    - parameters: dict
+    """
+    model_response = invoke_endpoint({"inputs": inputs, "parameters": parameters})
+    return parse_batch_response(model_response, len(inputs))
 
-    model_history_entry = {"prompt": data["prompt"], "model_response": model_reply}
 
-    payload = {
-        "username": data["username"],
-        "chat_id": data["chat_id"],
-        "model_history_entry": model_history_entry,
-    }
-    LAMBDA_CLIENT.invoke(
-        FunctionName=LAMBDA_FUNCTION_NAME,
-        InvocationType="Event",  # Wait for the response
-        Payload=json.dumps(payload),
+INFERENCE_BATCHER = None
+if INFERENCE_BATCHING:
+    INFERENCE_BATCHER = MicroBatcher(
+        send_generation_batch, INFERENCE_BATCH_MAX_SIZE, INFERENCE_BATCH_MAX_WAIT_MS
+    )
+
+
+def generate_text(payload: dict, username: str = None):
+    """
+    Runs one generation and returns the generated text, going through the
+    micro-batcher when batching is enabled. The call waits for its user's
+    turn when every inference slot is taken
+    - payload: dict, as built by build_generation_payload
+    - username: string (optional), background work shares one turn
+    """
+    with INFERENCE_SCHEDULER.slot(username):
+        if INFERENCE_BATCHER is not None:
+            return INFERENCE_BATCHER.submit(payload["inputs"], payload["parameters"])
+        model_response = invoke_endpoint(payload)
+    return model_response[0]["generated_text"]
+
+
+def generate_summary(inputs: str):
+    """
+    Runs one summary generation for the chat summarizer
+    - inputs: string
+    """
+    parameters = dict(GENERATION_PARAMETERS, max_new_tokens=SUMMARY_MAX_NEW_TOKENS)
+    return generate_text({"inputs": inputs, "parameters": parameters})
+
+
+CHAT_SUMMARIZER = None
+if CONTEXT_BUILDER is not None and SUMMARY_EVERY_TURNS > 0:
+    CHAT_SUMMARIZER = ChatSummarizer(
+        CHAT_CACHE,
+        generate_summary,
+        every_turns=SUMMARY_EVERY_TURNS,
+        recent_turns=SUMMARY_RECENT_TURNS,
+        min_interval_seconds=SUMMARY_MIN_INTERVAL_SECONDS,
+        max_pending=SUMMARY_MAX_PENDING,
+        chat_segments=CHAT_SEGMENTS,
+        missing_ttl_seconds=SUMMARY_MISSING_TTL_SECONDS,
+    )
+
+
+def index_turn(username: str, chat_id: int, prompt: str, overlay_turn=None):
+    """
+    Counts a new turn in the chat index, then places the turn in the recent
+    turns overlay at the position the index gives it and schedules a summary
+    of the chat when it is due. Runs on CHAT_INDEX_EXECUTOR
+    - username: string
+    - chat_id: int
+    - prompt: string
+    - overlay_turn: handle from RECENT_TURNS.add (optional)
+    """
+    turn_count = CHAT_INDEX.count_turn(username, chat_id, prompt)
+    if overlay_turn is not None:
+        # A turn the index did not count cannot be placed, and is dropped
+        RECENT_TURNS.place(
+            username,
+            chat_id,
+            overlay_turn,
+            None if turn_count is None else turn_count - 1,
+        )
+    if CHAT_SUMMARIZER is not None and turn_count is not None:
+        CHAT_SUMMARIZER.schedule(username, chat_id, turn_count)
+
+
+def record_turn(username: str, chat_id: int, prompt: str, model_reply: str):
+    """
+    Appends a prompt / reply turn to the chat history, through the
+    write-behind buffer or directly through the AddChatHistory Lambda, and
+    merges it into reads until it is persisted. The chat index is updated in
+    the background (see index_turn)
+    - username: string
+    - chat_id: int
+    - prompt: string
+    - model_reply: string
+    """
+    model_history_entry = {"prompt": prompt, "model_response": model_reply}
+    if HISTORY_WRITER is not None:
+        HISTORY_WRITER.append(username, chat_id, model_history_entry)
+    else:
+        payload = {
+            "username": username,
+            "chat_id": chat_id,
+            "model_history_entry": model_history_entry,
+        }
+        LAMBDA_CLIENT.invoke(
+            FunctionName=LAMBDA_FUNCTION_NAME,
+            InvocationType="Event",  # Wait for the response
+            Payload=json_codec.dumps(payload),
+        )
+    # Only turns on their way to the history are merged into reads
+    overlay_turn = None
+    if RECENT_TURNS is not None:
+        overlay_turn = RECENT_TURNS.add(username, chat_id, None, model_history_entry)
+    CHAT_INDEX_EXECUTOR.submit(index_turn, username, chat_id, prompt, overlay_turn)
+
+
+@app.errorhandler(EndpointUnavailable)
+def endpoint_unavailable(error: EndpointUnavailable):
+    """
+    Answers inference requests with a fast 503 while no endpoint is available
+    - error: EndpointUnavailable
+    """
+    return retry_later_response(
+        503,
+        "The assistant is temporarily unavailable. Try again shortly.",
+        error.retry_after,
+    )
+
+
+@app.errorhandler(InvalidModelRequest)
+def invalid_model_request(error: InvalidModelRequest):
+    """
+    Answers requests the model rejected as invalid, e.g. a prompt over the
+    input token limit, with the model's 4xx status
+    - error: InvalidModelRequest
+    """
+    print(f"Model rejected the request: {error}")
+    response = jsonify(
+        {
+            "status_code": error.status_code,
+            "message": "The model could not process this prompt.",
+        }
+    )
+    response.status_code = error.status_code
+    return response
+
+
+def check_rate_limit(username: str):
+    """
+    Counts an inference request against the user's rate limit, raising
+    RateLimited when it is exceeded
+    - username: string
+    """
+    if RATE_LIMITER is not None:
+        RATE_LIMITER.check(username)
+
+
+@app.route("/chatbot_response", methods=["POST"])
+def chatbot_response():
+    """
+    Run model invocation by calling SageMaker Inference Endpoint. The most
+    recent turns of the chat are sent along as context
+    - username: string
+    - chat_id: int 
+    - prompt: string
+    - use_cache: bool (optional, reuse the reply to an identical prompt)
+    """
+    data = request.get_json()
+    print(data)
+    check_rate_limit(data["username"])
+
+    context = build_context(data["username"], data["chat_id"], data["prompt"])
+    payload = build_generation_payload(data["prompt"], context)
+    # A reply that depends on earlier turns is not reused for other chats
+    model_reply = cached_reply(
+        lambda: generate_text(payload, data["username"])[1:],
+        payload,
+        use_cache=data.get("use_cache") is True,
+        prompt=None if context else data["prompt"],
     )
 
+    print(f"Model Response: {model_reply}")
+
+    record_turn(data["username"], data["chat_id"], data["prompt"], model_reply)
+
     return jsonify({"status_code": 200, "response": model_reply})
 
 
+def server_sent_event(data: dict, event: str = None):
+    """
+    Encodes one server-sent event
+    - data: dict
+    - event: string (optional event name)
+    """
+    message = b"data: %s\n\n" % json_codec.dumps(data)
+    if event is not None:
+        message = b"event: %s\n%s" % (event.encode("utf-8"), message)
+    return message
+
+
+@app.route("/chatbot_response_stream", methods=["POST"])
+def chatbot_response_stream():
+    """
+    Streaming variant of /chatbot_response. Tokens are relayed to the client
+    as server-sent events while SageMaker generates them: one
+    data: {"token": ...} event per token, then an "event: done" event with
+    the full reply (or an "event: error" event). The full reply is appended
+    to the chat history once generation finishes, before "done" is sent; if
+    that fails, "error" is sent instead
+    - username: string
+    - chat_id: int
+    - prompt: string
+    """
+    data = request.get_json()
+    print(data)
+    check_rate_limit(data["username"])
+
+    context = build_context(data["username"], data["chat_id"], data["prompt"])
+    payload = build_generation_payload(data["prompt"], context)
+    payload["stream"] = True
+
+    # The inference slot is held until the stream is closed
+    INFERENCE_SCHEDULER.acquire(data["username"])
+    try:
+        model_response = SAGEMAKER_ENDPOINT.invoke(
+            "invoke_endpoint_with_response_stream",
+            ContentType="application/json",
+            Body=json_codec.dumps(payload),
+        )
+    except Exception:
+        INFERENCE_SCHEDULER.release()
+        raise
+
+    def generate():
+        tokens = []
+        try:
+            for token in iter_tgi_tokens(model_response["Body"]):
+                # Like /chatbot_response, drop the leading character the
+                # model emits before the reply
+                if not tokens:
+                    token = token[1:]
+                tokens.append(token)
+                if token:
+                    yield server_sent_event({"token": token})
+        except ModelStreamError as e:
+            print(f"Model stream failed: {e}")
+            yield server_sent_event(
+                {"status_code": 500, "message": "Model response failed"}, "error"
+            )
+            return
+
+        model_reply = "".join(tokens)
+        print(f"Model Response: {model_reply}")
+        # Stored before "done" is sent: a client that disconnects once it
+        # has the reply closes the generator at that yield
+        try:
+            record_turn(data["username"], data["chat_id"], data["prompt"], model_reply)
+        except Exception as e:  # pylint: disable=broad-except
+            # The 200 status is already sent; the client must not take the
+            # reply for saved
+            print(f"Failed to record the streamed reply: {e}")
+            yield server_sent_event(
+                {"status_code": 500, "message": "Failed to save the response"}, "error"
+            )
+            return
+        yield server_sent_event({"status_code": 200, "response": model_reply}, "done")
+
+    response = Response(
+        generate(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    response.call_on_close(INFERENCE_SCHEDULER.release)
+    return response
+
+
 @app.route("/user_authentication", methods=["POST"])
 def user_authentication():
     """
@@ -153,37 +754,108 @@ def user_authentication():
 @app.route("/get_chat_history", methods=["POST"])
 def get_chat_history():
     """
-    Retrieves the chat history by connecting with S3 and parsing JSON files
+    Retrieves the chat history by listing the user's chat files in S3 and
+    parsing them. Chats are paged newest first: a page holds the last `limit`
+    chats below `before_chat_id`, and `next_cursor` is the `before_chat_id`
+    of the next (older) page, or None when there are no older chats. The
+    response carries an ETag; sending it back in If-None-Match returns 304
+    while the page is unchanged. With `Accept: application/x-ndjson` the
+    chats are streamed as they are fetched instead (see history_pages).
+
+    For delta sync, pass the `watermark` of the previous response as
+    `since` to get only the chats modified at or after it, and the chat IDs
+    the client holds as `known_chat_ids` to learn which were deleted
     - username: string
+    - limit: int (optional, defaults to every chat)
+    - before_chat_id: int (optional, defaults to the newest chat)
+    - since: int (optional, milliseconds since the epoch)
+    - known_chat_ids: list of int (optional)
     """
     data = request.get_json()
+    try:
+        limit = get_optional_positive_int(data, "limit")
+        before_chat_id = get_optional_positive_int(data, "before_chat_id")
+        since = get_optional_positive_int(data, "since")
+        known_chat_ids = get_optional_chat_ids(data, "known_chat_ids")
+    except ValueError as e:
+        return jsonify({"status_code": 400, "message": str(e)}), 400
+
     response = check_dynamo_db_user_name(data["username"])
 
     if "Item" not in response:
         return jsonify({"status_code": 400, "message": "User does not exist"}), 400
 
-    # Convert chat_count to an integer
-    chat_count = int(response["Item"]["chat_count"])
-    chat_history = []
-
-    if chat_count != 0:
-        for i in range(1, chat_count + 1):
-            key = f"{data['username']}/{i}.json"
-            try:
-                # Attempt to fetch the object
-                response = S3_CLIENT.get_object(Bucket=BUCKET_NAME, Key=key)
-                file_content = response["Body"].read().decode("utf-8")
-                json_dict = json.loads(file_content)
-                print(f"Successfully read JSON from S3: {json_dict}")
-                curr_chat_history = {i: json_dict}
-                chat_history.append(curr_chat_history)
-            except ClientError as e:
-                if e.response["Error"]["Code"] == "NoSuchKey":
-                    print(f"Key not found: {key}")
-                    continue
-                raise FileNotFoundError(f"Error accessing the S3 file: {str(e)}") from e
-
-    return jsonify({"status_code": 200, "chat_history": chat_history})
+    # One listing finds every chat that exists; no per-ID probing
+    chats = list_chat_objects(
+        S3_CLIENT, BUCKET_NAME, data["username"], segmented=CHAT_SEGMENTS is not None
+    )
+    chats, sync_info = changed_since(data["username"], chats, since, known_chat_ids)
+    chats, next_cursor = page_of(chats, limit, before_chat_id)
+    page_info = {"next_cursor": next_cursor, **sync_info}
+    fetch = partial(fetch_chat, data["username"])
+
+    preferred = request.accept_mimetypes.best_match(
+        ["application/json", NDJSON_MIMETYPE]
+    )
+    if preferred == NDJSON_MIMETYPE:
+        return stream_response(fetch, S3_EXECUTOR, CHAT_STREAM_WINDOW, chats, page_info)
+
+    # Unchanged histories are answered with an empty 304, without reading S3
+    etag = chat_history_etag(data["username"], chats, page_info)
+    if request.if_none_match.contains(etag):
+        return not_modified_response(etag)
+
+    chat_history = fetch_chats(fetch, S3_EXECUTOR, chats)
+    return chat_history_response(chat_history, page_info, etag)
+
+
+@app.route("/chats/<int:chat_id>", methods=["GET"])
+def get_chat(chat_id: int):
+    """
+    Retrieves a single chat with one S3 read. With last_n_turns only the end
+    of the chat is returned; unless the chat is already cached, only the end
+    of the chat file is downloaded and decoded. has_more tells whether older
+    turns were left out
+    - username: string (query parameter)
+    - last_n_turns: int (optional query parameter)
+    """
+    username = request.args.get("username")
+    if not username:
+        return jsonify({"status_code": 400, "message": "Username is required."}), 400
+    try:
+        last_n_turns = get_optional_positive_int(request.args, "last_n_turns")
+    except ValueError as e:
+        return jsonify({"status_code": 400, "message": str(e)}), 400
+
+    tail = read_chat_turns(username, chat_id, last_n_turns)
+    if tail is None:
+        return jsonify({"status_code": 404, "message": "Chat does not exist"}), 404
+
+    turns, has_more, _ = tail
+    return jsonify(
+        {"status_code": 200, "chat_id": chat_id, "chat": turns, "has_more": has_more}
+    )
+
+
+@app.route("/list_chats", methods=["POST"])
+def list_chats():
+    """
+    Lists chat summaries (chat_id, title, turn_count, last_updated) from the
+    chat index with a single DynamoDB query and no S3 reads. Paging works the
+    same way as /get_chat_history
+    - username: string
+    - limit: int (optional, defaults to every chat)
+    - before_chat_id: int (optional, defaults to the newest chat)
+    """
+    data = request.get_json()
+    try:
+        limit = get_optional_positive_int(data, "limit")
+        before_chat_id = get_optional_positive_int(data, "before_chat_id")
+    except ValueError as e:
+        return jsonify({"status_code": 400, "message": str(e)}), 400
+
+    chats, next_cursor = CHAT_INDEX.list_chats(data["username"], limit, before_chat_id)
+    return jsonify({"status_code": 200, "chats": chats, "next_cursor": next_cursor})
 
 
 @app.route("/new_chat", methods=["POST"])
@@ -207,12 +879,12 @@ def new_chat():
 
     # Create a placeholder JSON file in S3 for the new chat
     placeholder = []
-    key = f"{username}/{new_chat_id}.json"
+    key = chat_key(username, new_chat_id)
     try:
         S3_CLIENT.put_object(
             Bucket=BUCKET_NAME,
             Key=key,
-            Body=json.dumps(placeholder),
+            Body=json_codec.dumps(placeholder),
             ContentType="application/json",
         )
         print(f"Created placeholder file in S3: {key}")
@@ -222,6 +894,8 @@ def new_chat():
             jsonify({"status_code": 500, "message": "Failed to initialize new chat"}),
             500,
         )
+
+    CHAT_INDEX.add_chat(username, new_chat_id)
     return jsonify({"status_code": 200, "chat_id": new_chat_id})
 
 
@@ -261,6 +935,41 @@ def user_creation():
     )
 
 
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """
+    Returns in-process counters for monitoring
+    """
+    stats = {
+        "status_code": 200,
+        "chat_cache": CHAT_CACHE.stats(),
+        **reply_cache_stats(),
+        "inference_endpoint": SAGEMAKER_ENDPOINT.stats(),
+        "inference_scheduler": INFERENCE_SCHEDULER.stats(),
+    }
+    if RATE_LIMITER is not None:
+        stats["rate_limiter"] = RATE_LIMITER.stats()
+    if HISTORY_WRITER is not None:
+        stats["history_writer"] = HISTORY_WRITER.stats()
+        if HISTORY_WRITER.journal is not None:
+            stats["history_journal"] = HISTORY_WRITER.journal.stats()
+    if RECENT_TURNS is not None:
+        stats["recent_turns"] = RECENT_TURNS.stats()
+    if CHAT_SEGMENTS is not None:
+        stats["chat_segments"] = CHAT_SEGMENTS.stats()
+    if ADMISSION_CONTROL:
+        stats["admission_control"] = ADMISSION.stats()
+    if CONTEXT_BUILDER is not None:
+        stats["context"] = CONTEXT_BUILDER.stats()
+    if CHAT_SUMMARIZER is not None:
+        stats["chat_summaries"] = CHAT_SUMMARIZER.stats()
+    if INFERENCE_BATCHER is not None:
+        stats["inference_batching"] = INFERENCE_BATCHER.stats()
+    return jsonify(stats)
+
+
 if __name__ == "__main__":
+    # Exit normally on SIGTERM (docker stop) so queued history is flushed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     # Used to test - local server
     app.run(host="0.0.0.0", port=5000)
@@ -0,0 +1,191 @@
+'''
+Benchmark of the chat history append engine in history_append.
+
+Every append rewrites the whole chat file, so its cost grows with the chat.
+For chats of 10, 100 and 1000 turns this measures append throughput and
+latency against an in-memory S3 with ETags and conditional writes, running
+the engine the ways it is deployed:
+- cached: in-process, one turn per append, chats read through a warm cache
+- cold: in-process with an empty cache, so every append downloads and
+  decodes the chat, like a Lambda instance that just started
+- pool: one flush of a turn for each of POOL_CHATS chats, written in
+  parallel by a thread pool
+- lambda: the same flush sent through the Lambda handler as one batched event
+- segments: in-process like cached, with chats in the segmented format
+  (chat_segments), where an append writes a new segment instead of the chat
+- compacting: segments with COMPACTING_APPENDS_PER_CHAT appends per chat,
+  enough for the small segments to be compacted; compactions run in the
+  append that triggers them, so their cost is part of its latency
+
+Set BENCH_S3_LATENCY_MS to add a fixed delay to every S3 request.
+
+Run from the repository root:
+    python -m benchmarks.bench_history_append
+'''
+
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from benchmarks.bench_json_codec import TURN_COUNTS, make_chat
+from chat_cache import ChatCache
+from chat_segments import SegmentedChatStore
+from chat_store import chat_key
+from history_append import HistoryAppender, handle_event
+import json_codec
+from tests.conftest import MemoryS3
+
+BUCKET_NAME = "bench"
+USERNAME = "bench"
+# Appends go to CHATS chats in turn, so no chat grows by more than
+# APPENDS_PER_CHAT turns during a run
+CHATS = 40
+APPENDS_PER_CHAT = 5
+COMPACTING_APPENDS_PER_CHAT = 20
+POOL_CHATS = 8
+SMALL_SEGMENT_BYTES = 64 * 1024
+COMPACT_MIN_SEGMENTS = 8
+CACHE_MAX_BYTES = 1024 * 1024 * 1024
+S3_LATENCY_MS = float(os.environ.get("BENCH_S3_LATENCY_MS", 0))
+
+
+def make_appender(turns: int, cache_max_bytes: int, executor=None, segmented: bool = False):
+    """
+    Returns a HistoryAppender over a fresh store holding CHATS chats of the
+    given number of turns. Cached appenders start with every chat cached
+    - turns: int
+    - cache_max_bytes: int
+    - executor: Executor (optional)
+    - segmented: bool, store the chats in the segmented format
+    """
+    store = MemoryS3(S3_LATENCY_MS)
+    encoded = json_codec.dumps(make_chat(turns))
+    cache = ChatCache(store, BUCKET_NAME, cache_max_bytes)
+    segments = None
+    if segmented:
+        segments = SegmentedChatStore(
+            cache, SMALL_SEGMENT_BYTES, COMPACT_MIN_SEGMENTS, max_pending=0, background=False
+        )
+    for chat_id in range(CHATS):
+        store.objects[chat_key(USERNAME, chat_id)] = (encoded, '"0"')
+        cache.fetch(chat_key(USERNAME, chat_id))
+        if segments is not None:
+            segments.migrate_chat(USERNAME, chat_id)
+    store.bytes_written = 0
+    return HistoryAppender(cache, executor=executor, segments=segments)
+
+
+def percentile(values: list, fraction: float):
+    """
+    Returns the value at the given fraction of the sorted values
+    - values: list of floats
+    - fraction: float, between 0 and 1
+    """
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run_single(appender: HistoryAppender, appends: int = APPENDS_PER_CHAT):
+    """
+    Appends one turn at a time. Returns the latencies
+    - appender: HistoryAppender
+    - appends: int, appends per chat
+    """
+    turn = make_chat(1, seed=1)[0]
+    latencies = []
+    for _ in range(appends):
+        for chat_id in range(CHATS):
+            started = time.perf_counter()
+            appender.append(USERNAME, chat_id, [turn])
+            latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+def run_batched(appender: HistoryAppender, through_handler: bool):
+    """
+    Writes flushes of one turn for each of POOL_CHATS chats. Returns the
+    latencies
+    - appender: HistoryAppender
+    - through_handler: bool, send each flush as a batched Lambda event
+    """
+    turn = make_chat(1, seed=1)[0]
+    latencies = []
+    for _ in range(APPENDS_PER_CHAT):
+        for first in range(0, CHATS, POOL_CHATS):
+            chat_ids = range(first, min(CHATS, first + POOL_CHATS))
+            started = time.perf_counter()
+            if through_handler:
+                event = {
+                    "chats": [
+                        {
+                            "username": USERNAME,
+                            "chat_id": chat_id,
+                            "model_history_entries": [turn],
+                        }
+                        for chat_id in chat_ids
+                    ]
+                }
+                # The Lambda receives the event as JSON
+                handle_event(appender, json_codec.loads(json_codec.dumps(event)))
+            else:
+                appender.write(
+                    OrderedDict(((USERNAME, chat_id), [turn]) for chat_id in chat_ids)
+                )
+            latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+def main():
+    """
+    Prints append throughput and latency per engine mode and chat size
+    """
+    print(f"S3 latency: {S3_LATENCY_MS} ms per request")
+    print(
+        "latency is per append for cached / cold / segments / compacting,"
+        " per flush for pool / lambda"
+    )
+    print(
+        f"{'turns':>6} {'mode':>10} {'turns/s':>9} {'p50 ms':>8} {'p99 ms':>8}"
+        f" {'KB/append':>10} {'compactions':>11}"
+    )
+    with ThreadPoolExecutor(POOL_CHATS) as executor:
+        for turns in TURN_COUNTS:
+            runs = [
+                ("cached", make_appender(turns, CACHE_MAX_BYTES), run_single),
+                ("cold", make_appender(turns, 0), run_single),
+                (
+                    "pool",
+                    make_appender(turns, CACHE_MAX_BYTES, executor),
+                    partial(run_batched, through_handler=False),
+                ),
+                (
+                    "lambda",
+                    make_appender(turns, CACHE_MAX_BYTES),
+                    partial(run_batched, through_handler=True),
+                ),
+                ("segments", make_appender(turns, CACHE_MAX_BYTES, segmented=True), run_single),
+                (
+                    "compacting",
+                    make_appender(turns, CACHE_MAX_BYTES, segmented=True),
+                    partial(run_single, appends=COMPACTING_APPENDS_PER_CHAT),
+                ),
+            ]
+            for mode, appender, run in runs:
+                latencies = run(appender)
+                appended = appender.stats()["appended"]
+                written = appender.chat_cache.s3_client.bytes_written
+                compactions = ""
+                if appender.segments is not None:
+                    compactions = f" {appender.segments.stats()['compactions']:>11}"
+                print(
+                    f"{turns:>6} {mode:>10} {appended / sum(latencies):>9.0f}"
+                    f" {percentile(latencies, 0.5) * 1000:>8.2f}"
+                    f" {percentile(latencies, 0.99) * 1000:>8.2f}"
+                    f" {written / appended / 1024:>10.1f}{compactions}"
+                )
+
+
+if __name__ == "__main__":
+    main()
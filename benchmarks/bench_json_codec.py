@@ -0,0 +1,82 @@
+'''
+Microbenchmark of the JSON codecs in json_codec on realistic chat files.
+
+Builds chats shaped like the ones stored in S3 (a list of prompt /
+model_response turns with ~100-token replies) and times, for every
+available codec, decoding a chat file from bytes and encoding it back.
+
+Run from the repository root:
+    python -m benchmarks.bench_json_codec
+'''
+
+import random
+import timeit
+from functools import partial
+
+import json_codec
+
+WORDS = (
+    "I feel really tired today and I am not sure why, maybe work has been "
+    "stressful lately. That sounds hard — it's okay to feel this way. "
+    "Would you like to talk about what's been happening? 😊 café naïve"
+).split()
+TURN_COUNTS = (10, 100, 1000)
+REPEATS = 5
+
+
+def make_chat(turns: int, seed: int = 0):
+    """
+    Builds a chat with the given number of turns
+    - turns: int
+    - seed: int
+    """
+    rng = random.Random(seed)
+    return [
+        {
+            "prompt": " ".join(rng.choices(WORDS, k=rng.randint(5, 40))),
+            "model_response": " ".join(rng.choices(WORDS, k=rng.randint(60, 100))),
+        }
+        for _ in range(turns)
+    ]
+
+
+def best_time(statement, number: int):
+    """
+    Returns the best per-call time of statement in microseconds
+    - statement: callable
+    - number: int, calls per repeat
+    """
+    times = timeit.repeat(statement, number=number, repeat=REPEATS)
+    return min(times) / number * 1e6
+
+
+def main():
+    """
+    Prints decode and encode times per codec and chat size
+    """
+    print(f"codecs available: {', '.join(json_codec.CODECS)}")
+    print(f"{'turns':>6} {'bytes':>9} {'codec':>7} {'decode us':>10} {'encode us':>10}")
+    for turns in TURN_COUNTS:
+        chat = make_chat(turns)
+        number = max(1, 2000 // turns)
+        baseline = None
+        for name, (dumps, loads) in json_codec.CODECS.items():
+            encoded = dumps(chat)
+            decode = best_time(partial(loads, encoded), number)
+            encode = best_time(partial(dumps, chat), number)
+            speedup = ""
+            if baseline is None:
+                baseline = (decode, encode)
+            else:
+                speedup = (
+                    f"  ({baseline[0] / decode:.1f}x decode,"
+                    f" {baseline[1] / encode:.1f}x encode)"
+                )
+            print(
+                f"{turns:>6} {len(encoded):>9} {name:>7}"
+                f" {decode:>10.1f} {encode:>10.1f}{speedup}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+'''
+In-process read-through cache for the chat files stored in S3.
+
+Entries are revalidated against the ETag from a listing when the caller has
+one, and with a conditional GET otherwise, so an unchanged chat costs nothing
+or a bodiless 304 instead of a full download and JSON parse. The raw S3 body
+is kept next to the parsed chat and reused as the chat's JSON encoding when
+responses are assembled, so unchanged chats are never re-serialized.
+'''
+
+import threading
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+
+from botocore.exceptions import ClientError
+
+import json_codec
+
+# Parsed Python objects take several times the size of their JSON encoding,
+# so each entry is charged for its raw bytes plus an estimate of the parsed copy
+PARSED_SIZE_FACTOR = 3
+
+
+class CachedChat(NamedTuple):
+    """
+    A chat file as last read from S3
+    - etag: string, the S3 ETag of the object
+    - chat: list, the parsed chat
+    - encoded: bytes, the JSON encoding of the chat
+    - size: int, bytes charged against the cache budget
+    """
+
+    etag: str
+    chat: list
+    encoded: bytes
+    size: int
+
+
+def is_not_modified(error: ClientError):
+    """
+    Checks if a ClientError is the 304 returned by a conditional GET
+    - error: ClientError
+    """
+    if error.response.get("ResponseMetadata", {}).get("HTTPStatusCode") == 304:
+        return True
+    return error.response.get("Error", {}).get("Code") in ("304", "NotModified")
+
+
+class ChatCache:
+    """
+    Byte-bounded LRU cache of chat files keyed by S3 key
+    - s3_client: boto3 S3 client
+    - bucket_name: string
+    - max_bytes: int, total size budget of the cached entries
+    """
+
+    def __init__(self, s3_client, bucket_name: str, max_bytes: int):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def fetch(self, key: str, etag: Optional[str] = None) -> Optional[CachedChat]:
+        """
+        Returns the chat stored at key, downloading it only if it changed
+        since it was cached. Returns None if the key does not exist. When the
+        current ETag is already known (e.g. from a listing) and matches the
+        cached entry, no request is made at all
+        - key: string
+        - etag: string (optional)
+        """
+        cached = self.get(key)
+        if cached is not None and etag is not None and cached.etag == etag:
+            self._count("hits")
+            return cached
+
+        params = {"Bucket": self.bucket_name, "Key": key}
+        if cached is not None:
+            params["IfNoneMatch"] = cached.etag
+
+        try:
+            response = self.s3_client.get_object(**params)
+        except ClientError as e:
+            if cached is not None and is_not_modified(e):
+                self._count("hits")
+                return cached
+            if e.response["Error"]["Code"] == "NoSuchKey":
+                self.invalidate(key)
+                return None
+            raise
+
+        self._count("misses")
+        encoded = response["Body"].read()
+        entry = CachedChat(
+            etag=response["ETag"],
+            chat=json_codec.loads(encoded),
+            encoded=encoded,
+            size=len(encoded) * (1 + PARSED_SIZE_FACTOR),
+        )
+        self.put(key, entry)
+        return entry
+
+    def get(self, key: str) -> Optional[CachedChat]:
+        """
+        Returns the cached entry for key without revalidating it
+        - key: string
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key: str, entry: CachedChat):
+        """
+        Stores an entry, evicting the least recently used entries to stay
+        within the byte budget. Entries larger than the budget are not kept
+        - key: string
+        - entry: CachedChat
+        """
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= previous.size
+            if entry.size > self.max_bytes:
+                return
+            self._entries[key] = entry
+            self._size += entry.size
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= evicted.size
+                self._counters["evictions"] += 1
+
+    def write(self, key: str, chat, encoded: bytes, **condition) -> CachedChat:
+        """
+        Puts a JSON document to S3 and caches it. Returns the new entry. If
+        the put fails, e.g. because a condition does not hold, the cached
+        entry is dropped and the ClientError raised
+        - key: string
+        - chat: the parsed document
+        - encoded: bytes, its JSON encoding
+        - condition: IfMatch or IfNoneMatch (optional), for a conditional put
+        """
+        try:
+            response = self.s3_client.put_object(
+                Bucket=self.bucket_name,
+                Key=key,
+                Body=encoded,
+                ContentType="application/json",
+                **condition,
+            )
+        except ClientError:
+            self.invalidate(key)
+            raise
+        entry = CachedChat(
+            etag=response["ETag"],
+            chat=chat,
+            encoded=encoded,
+            size=len(encoded) * (1 + PARSED_SIZE_FACTOR),
+        )
+        self.put(key, entry)
+        return entry
+
+    def invalidate(self, key: str):
+        """
+        Drops the cached entry for key, if any
+        - key: string
+        """
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= previous.size
+
+    def stats(self):
+        """
+        Returns the cache counters and current size
+        """
+        with self._lock:
+            return {
+                **self._counters,
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "max_bytes": self.max_bytes,
+            }
+
+    def _count(self, counter: str):
+        with self._lock:
+            self._counters[counter] += 1
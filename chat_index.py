@@ -0,0 +1,113 @@
+'''
+Per-user chat index in DynamoDB.
+
+The table holds one summary item per chat (partition key username, sort
+key chat_id, a number) with its title, turn count and last update time, so
+the chat sidebar is listed with a single query and no S3 reads. The title
+is taken from the first prompt of the chat.
+
+The index only feeds the listing and the turn positions of the recent
+turns overlay, so failing to update it is logged instead of failing the
+request.
+'''
+
+import time
+
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+
+
+class ChatIndex:
+    """
+    Chat summaries of every user
+    - table: boto3 DynamoDB Table
+    - title_length: int, characters of the first prompt kept as the title
+    """
+
+    def __init__(self, table, title_length: int = 60):
+        self.table = table
+        self.title_length = title_length
+
+    def add_chat(self, username: str, chat_id: int):
+        """
+        Adds the summary item of a new chat
+        - username: string
+        - chat_id: int
+        """
+        try:
+            self.table.put_item(
+                Item={
+                    "username": username,
+                    "chat_id": chat_id,
+                    "turn_count": 0,
+                    "last_updated": int(time.time() * 1000),
+                }
+            )
+        except ClientError as e:
+            print(f"Failed to add chat to chat index: {e}")
+
+    def count_turn(self, username: str, chat_id: int, prompt: str):
+        """
+        Records a new turn in the chat's summary item and returns the chat's
+        turn count, or None if the update failed
+        - username: string
+        - chat_id: int
+        - prompt: string
+        """
+        try:
+            response = self.table.update_item(
+                Key={"username": username, "chat_id": int(chat_id)},
+                UpdateExpression=(
+                    "ADD turn_count :one "
+                    "SET last_updated = :now, title = if_not_exists(title, :title)"
+                ),
+                ExpressionAttributeValues={
+                    ":one": 1,
+                    ":now": int(time.time() * 1000),
+                    ":title": prompt[: self.title_length],
+                },
+                ReturnValues="UPDATED_NEW",
+            )
+        except ClientError as e:
+            print(f"Failed to update chat index for {username}/{chat_id}: {e}")
+            return None
+        return int(response["Attributes"]["turn_count"])
+
+    def list_chats(self, username: str, limit: int = None, before_chat_id: int = None):
+        """
+        Returns (chats, next_cursor): the last `limit` chat summaries below
+        before_chat_id, oldest to newest, and the before_chat_id of the next
+        (older) page, or None when there are no older chats
+        - username: string
+        - limit: int (optional, defaults to every chat)
+        - before_chat_id: int (optional, defaults to the newest chat)
+        """
+        key_condition = Key("username").eq(username)
+        if before_chat_id is not None:
+            key_condition = key_condition & Key("chat_id").lt(before_chat_id)
+        query = {"KeyConditionExpression": key_condition, "ScanIndexForward": False}
+        if limit is not None:
+            # One chat past the page tells whether an older page exists; a
+            # full page alone still comes with a LastEvaluatedKey
+            query["Limit"] = limit + 1
+        response = self.table.query(**query)
+        items = response["Items"]
+        # Without the extra chat, only a page cut short by the 1 MB response
+        # limit comes with a LastEvaluatedKey
+        more = "LastEvaluatedKey" in response
+        if limit is not None:
+            more = more or len(items) > limit
+            items = items[:limit]
+
+        # Query returns newest first; pages are returned oldest to newest
+        chats = [
+            {
+                "chat_id": int(item["chat_id"]),
+                "title": item.get("title"),
+                "turn_count": int(item.get("turn_count", 0)),
+                "last_updated": int(item["last_updated"]),
+            }
+            for item in reversed(items)
+        ]
+        next_cursor = chats[0]["chat_id"] if more and chats else None
+        return chats, next_cursor
@@ -0,0 +1,506 @@
+'''
+Append-only, segmented storage of chats.
+
+A chat stored as one JSON array is rewritten whole for every turn, so a turn
+costs O(turns) to write and a chat O(turns^2). In the segmented format a
+chat is a manifest plus immutable segment objects:
+    {username}/{chat_id}.manifest.json
+        {"segments": [{"number": 0, "turns": 12, "bytes": 9000}, ...],
+         "next_segment": 3, "turn_count": 20}
+    {username}/{chat_id}.segments/{number}.jsonl, one turn per line
+Appending turns writes them as a new segment, then swaps in a manifest that
+lists it, conditional on the ETag of the manifest that was read. A writer
+that loses the race deletes its segment and retries on the new manifest.
+An append costs the size of the new turns plus the manifest, however long
+the chat is.
+
+A background compactor merges the runs of small segments at the end of a
+chat into one segment, so that reading a whole chat takes a few GETs.
+Segments are immutable, so they are cached without revalidation. The
+segments a compaction replaced are deleted after the new manifest is in
+place; a reader that finds one gone reads the manifest again.
+
+Tail reads fetch the manifest and then segments from the newest back, only
+as many as hold the requested turns: for the last few turns, usually just
+the newest one.
+
+Migration: a chat without a manifest is read from its array file at
+{username}/{chat_id}.json. The first append to it, or migrate_chat, copies
+the array into the first segment of a new manifest. Every chat of some
+users can be migrated up front with
+    python -m chat_segments [--delete-arrays] <username> ...
+The array file is left in place unless migrate_chat is asked to delete it,
+or --delete-arrays is given; once the manifest
+exists it is ignored. Every writer of a deployment (the backend and the
+AddChatHistory Lambda) has to use the segmented format before chats are
+migrated, or turns written to the array files afterwards are not seen.
+'''
+
+import argparse
+import os
+import threading
+from collections import OrderedDict
+
+import boto3
+from botocore.exceptions import ClientError
+
+from chat_cache import CachedChat, ChatCache, PARSED_SIZE_FACTOR
+from chat_store import (
+    chat_key,
+    list_chat_objects,
+    manifest_key,
+    read_array_turns,
+    segment_key,
+)
+import json_codec
+
+CONFLICT_ERROR_CODES = ("PreconditionFailed", "ConditionalRequestConflict")
+# Attempts at a conditional write (a new manifest, or an array chat in
+# history_append) before an append fails
+WRITE_ATTEMPTS = 3
+# Segment numbers tried past a number that is taken (e.g. by the segment of
+# a writer that crashed before updating the manifest)
+SEGMENT_NUMBER_ATTEMPTS = 8
+# Reads of the manifest when a segment it lists was compacted away
+READ_ATTEMPTS = 3
+
+
+class SegmentMissing(FileNotFoundError):
+    """
+    Raised when a segment listed by a manifest no longer exists
+    """
+
+
+def is_conflict(error: ClientError):
+    """
+    Checks if a conditional write failed because the object changed
+    - error: ClientError
+    """
+    return error.response["Error"]["Code"] in CONFLICT_ERROR_CODES
+
+
+def encode_segment(turns: list):
+    """
+    Encodes turns as JSONL
+    - turns: list of turns
+    """
+    return b"".join(json_codec.dumps(turn) + b"\n" for turn in turns)
+
+
+def decode_segment(data: bytes):
+    """
+    Decodes a JSONL segment into a CachedChat whose encoded field is the
+    turns as a JSON array, built from the lines without re-serializing them
+    - data: bytes
+    """
+    lines = [line for line in data.split(b"\n") if line]
+    encoded = b"[" + b",".join(lines) + b"]"
+    return CachedChat(
+        etag=None,
+        chat=[json_codec.loads(line) for line in lines],
+        encoded=encoded,
+        size=len(encoded) * (1 + PARSED_SIZE_FACTOR),
+    )
+
+
+class SegmentedChatStore:
+    """
+    Reads and appends to chats in the segmented format, and compacts them in
+    the background
+    - chat_cache: ChatCache, holds manifests, segments and array files
+    - small_segment_bytes: int, segments below this size get merged
+    - compact_min_segments: int, small segments at the end of a chat that
+      trigger a compaction
+    - max_pending: int, chats that may wait for a compaction at once
+    - background: bool, compact from a worker thread; otherwise right after
+      the append that triggers it (e.g. in a Lambda, which is frozen between
+      invocations)
+    """
+
+    def __init__(
+        self,
+        chat_cache,
+        small_segment_bytes: int,
+        compact_min_segments: int,
+        max_pending: int,
+        background: bool = True,
+    ):
+        self.chat_cache = chat_cache
+        self.small_segment_bytes = small_segment_bytes
+        self.compact_min_segments = compact_min_segments
+        self.max_pending = max_pending
+        self.background = background
+        self._pending = OrderedDict()
+        self._condition = threading.Condition()
+        self._worker = None
+        self._counters = {
+            "appends": 0,
+            "segments_written": 0,
+            "conflicts": 0,
+            "migrated": 0,
+            "compactions": 0,
+            "compacted_segments": 0,
+            "failed_compactions": 0,
+            "dropped_compactions": 0,
+            "read_retries": 0,
+        }
+
+    def fetch(self, username: str, chat_id: int, etag: str = None):
+        """
+        Returns the whole chat as a CachedChat whose ETag is the manifest's,
+        or None if the chat does not exist. Chats that are not migrated yet
+        are read from their array file
+        - username: string
+        - chat_id: int
+        - etag: string (optional), the manifest's ETag from a listing
+        """
+        for attempt in range(READ_ATTEMPTS):
+            manifest = self.chat_cache.fetch(
+                manifest_key(username, chat_id), etag=etag if attempt == 0 else None
+            )
+            if manifest is None:
+                return self.chat_cache.fetch(chat_key(username, chat_id))
+            try:
+                segments = self._load_segments(username, chat_id, manifest.chat["segments"])
+            except SegmentMissing:
+                self._retry_read(username, chat_id)
+                continue
+            encoded = b",".join(
+                segment.encoded[1:-1] for segment in segments if segment.chat
+            )
+            return CachedChat(
+                etag=manifest.etag,
+                chat=[turn for segment in segments for turn in segment.chat],
+                encoded=b"[" + encoded + b"]",
+                size=sum(segment.size for segment in segments),
+            )
+        raise SegmentMissing(f"Segments of {username}/{chat_id} keep disappearing")
+
+    def read_turns(self, username: str, chat_id: int, last_n_turns: int = None):
+        """
+        Reads a chat, or only its last turns. Returns (turns, has_more,
+        first) like chat_store.read_array_turns, or None if the chat does not
+        exist. Only the newest segments that hold last_n_turns are read
+        - username: string
+        - chat_id: int
+        - last_n_turns: int (optional, defaults to every turn)
+        """
+        for _ in range(READ_ATTEMPTS):
+            manifest = self.chat_cache.fetch(manifest_key(username, chat_id))
+            if manifest is None:
+                return read_array_turns(
+                    self.chat_cache, chat_key(username, chat_id), last_n_turns
+                )
+            listed = manifest.chat["segments"]
+            if last_n_turns is not None:
+                count, first = 0, len(listed)
+                while first > 0 and count < last_n_turns:
+                    first -= 1
+                    count += listed[first]["turns"]
+                listed = listed[first:]
+            try:
+                segments = self._load_segments(username, chat_id, listed)
+            except SegmentMissing:
+                self._retry_read(username, chat_id)
+                continue
+            turns = [turn for segment in segments for turn in segment.chat]
+            if last_n_turns is not None:
+                turns = turns[-last_n_turns:]
+            first = manifest.chat["turn_count"] - len(turns)
+            return turns, first > 0, first
+        raise SegmentMissing(f"Segments of {username}/{chat_id} keep disappearing")
+
+    def append(self, username: str, chat_id: int, entries: list):
+        """
+        Appends turns to a chat as a new segment, migrating the chat from its
+        array file first if needed. Returns the bytes written
+        - username: string
+        - chat_id: int
+        - entries: list of turns
+        """
+        written, manifest = self._commit(username, chat_id, entries)
+        with self._condition:
+            self._counters["appends"] += 1
+        small = 0
+        for segment in reversed(manifest["segments"]):
+            if segment["bytes"] >= self.small_segment_bytes:
+                break
+            small += 1
+        if small >= self.compact_min_segments:
+            self._schedule_compaction(username, chat_id)
+        return written
+
+    def migrate_chat(self, username: str, chat_id: int, delete_array: bool = False):
+        """
+        Moves a chat from its array file to the segmented format. Returns
+        False if it was already migrated
+        - username: string
+        - chat_id: int
+        - delete_array: bool, delete the array file afterwards
+        """
+        key = manifest_key(username, chat_id)
+        migrated = self.chat_cache.fetch(key) is None
+        if migrated:
+            try:
+                self._commit(username, chat_id, [])
+            except ClientError as e:
+                # Migrated concurrently by an append
+                if not is_conflict(e):
+                    raise
+                migrated = False
+        if delete_array:
+            array_key = chat_key(username, chat_id)
+            self.chat_cache.s3_client.delete_object(
+                Bucket=self.chat_cache.bucket_name, Key=array_key
+            )
+            self.chat_cache.invalidate(array_key)
+        return migrated
+
+    def compact(self, username: str, chat_id: int):
+        """
+        Merges the run of small segments at the end of a chat into one
+        segment. Returns False if there was nothing to merge or the chat
+        changed meanwhile; the next append schedules it again
+        - username: string
+        - chat_id: int
+        """
+        key = manifest_key(username, chat_id)
+        current = self.chat_cache.fetch(key)
+        if current is None:
+            return False
+        manifest = current.chat
+        listed = manifest["segments"]
+        first = len(listed)
+        while first > 0 and listed[first - 1]["bytes"] < self.small_segment_bytes:
+            first -= 1
+        run = listed[first:]
+        if len(run) < 2:
+            return False
+
+        turns = [
+            turn
+            for segment in self._load_segments(username, chat_id, run)
+            for turn in segment.chat
+        ]
+        merged = self._put_segment(username, chat_id, manifest["next_segment"], turns)
+        new_manifest = {
+            "segments": listed[:first] + [merged],
+            "next_segment": merged["number"] + 1,
+            "turn_count": manifest["turn_count"],
+        }
+        try:
+            self._put_manifest(key, new_manifest, {"IfMatch": current.etag})
+        except ClientError as e:
+            self._delete_segments(username, chat_id, [merged])
+            if not is_conflict(e):
+                raise
+            return False
+        self._delete_segments(username, chat_id, run)
+        with self._condition:
+            self._counters["compactions"] += 1
+            self._counters["compacted_segments"] += len(run)
+        return True
+
+    def stats(self):
+        """
+        Returns the append, migration and compaction counters
+        """
+        with self._condition:
+            return {**self._counters, "compactions_queued": len(self._pending)}
+
+    def _commit(self, username: str, chat_id: int, entries: list):
+        """
+        Adds the turns as a new segment (none if there are no turns) and
+        swaps in the new manifest. Returns (bytes written, new manifest)
+        """
+        key = manifest_key(username, chat_id)
+        for attempt in range(WRITE_ATTEMPTS):
+            current = self.chat_cache.fetch(key)
+            segments, migrated = [], False
+            if current is not None:
+                manifest = current.chat
+                condition = {"IfMatch": current.etag}
+            else:
+                manifest = {"segments": [], "next_segment": 0, "turn_count": 0}
+                condition = {"IfNoneMatch": "*"}
+                array = self.chat_cache.fetch(chat_key(username, chat_id))
+                migrated = array is not None
+                if migrated and array.chat:
+                    segments.append(self._put_segment(username, chat_id, 0, array.chat))
+            if entries:
+                number = segments[-1]["number"] + 1 if segments else manifest["next_segment"]
+                segments.append(self._put_segment(username, chat_id, number, entries))
+
+            new_manifest = {
+                "segments": manifest["segments"] + segments,
+                "next_segment": (
+                    segments[-1]["number"] + 1 if segments else manifest["next_segment"]
+                ),
+                "turn_count": manifest["turn_count"] + sum(s["turns"] for s in segments),
+            }
+            try:
+                written = self._put_manifest(key, new_manifest, condition)
+            except ClientError as e:
+                self._delete_segments(username, chat_id, segments)
+                if not is_conflict(e) or attempt == WRITE_ATTEMPTS - 1:
+                    raise
+                with self._condition:
+                    self._counters["conflicts"] += 1
+                self.chat_cache.invalidate(key)
+                continue
+            with self._condition:
+                self._counters["segments_written"] += len(segments)
+                self._counters["migrated"] += int(migrated)
+            return written + sum(s["bytes"] for s in segments), new_manifest
+
+    def _put_segment(self, username: str, chat_id: int, number: int, turns: list):
+        """
+        Writes turns as a new segment at the first free number from number
+        on. Returns its manifest entry
+        """
+        encoded = encode_segment(turns)
+        for candidate in range(number, number + SEGMENT_NUMBER_ATTEMPTS):
+            key = segment_key(username, chat_id, candidate)
+            try:
+                self.chat_cache.s3_client.put_object(
+                    Bucket=self.chat_cache.bucket_name,
+                    Key=key,
+                    Body=encoded,
+                    ContentType="application/x-ndjson",
+                    IfNoneMatch="*",
+                )
+            except ClientError as e:
+                if not is_conflict(e):
+                    raise
+                continue
+            self.chat_cache.put(key, decode_segment(encoded))
+            return {"number": candidate, "turns": len(turns), "bytes": len(encoded)}
+        raise RuntimeError(f"No free segment number for {username}/{chat_id}")
+
+    def _put_manifest(self, key: str, manifest: dict, condition: dict):
+        encoded = json_codec.dumps(manifest)
+        self.chat_cache.write(key, manifest, encoded, **condition)
+        return len(encoded)
+
+    def _load_segments(self, username: str, chat_id: int, listed: list):
+        """
+        Returns the listed segments as CachedChats, from the cache if
+        possible. Raises SegmentMissing if one was deleted
+        """
+        segments = []
+        for segment in listed:
+            key = segment_key(username, chat_id, segment["number"])
+            entry = self.chat_cache.get(key)
+            if entry is None:
+                try:
+                    response = self.chat_cache.s3_client.get_object(
+                        Bucket=self.chat_cache.bucket_name, Key=key
+                    )
+                except ClientError as e:
+                    if e.response["Error"]["Code"] == "NoSuchKey":
+                        raise SegmentMissing(key) from e
+                    raise
+                entry = decode_segment(response["Body"].read())
+                self.chat_cache.put(key, entry)
+            segments.append(entry)
+        return segments
+
+    def _delete_segments(self, username: str, chat_id: int, listed: list):
+        for segment in listed:
+            key = segment_key(username, chat_id, segment["number"])
+            self.chat_cache.invalidate(key)
+            try:
+                self.chat_cache.s3_client.delete_object(
+                    Bucket=self.chat_cache.bucket_name, Key=key
+                )
+            except ClientError as e:
+                print(f"Failed to delete segment {key}: {e}")
+
+    def _retry_read(self, username: str, chat_id: int):
+        # The manifest that was read is out of date
+        self.chat_cache.invalidate(manifest_key(username, chat_id))
+        with self._condition:
+            self._counters["read_retries"] += 1
+
+    def _schedule_compaction(self, username: str, chat_id: int):
+        if not self.background:
+            self._compact_logged(username, chat_id)
+            return
+        with self._condition:
+            if self._worker is None:
+                self._worker = threading.Thread(
+                    target=self._run, name="chat-compactor", daemon=True
+                )
+                self._worker.start()
+            if (username, chat_id) in self._pending:
+                return
+            if len(self._pending) >= self.max_pending:
+                self._counters["dropped_compactions"] += 1
+                return
+            self._pending[(username, chat_id)] = None
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                (username, chat_id), _ = self._pending.popitem(last=False)
+            self._compact_logged(username, chat_id)
+
+    def _compact_logged(self, username: str, chat_id: int):
+        try:
+            self.compact(username, chat_id)
+        except Exception as e:  # pylint: disable=broad-except
+            print(f"Failed to compact {username}/{chat_id}: {e}")
+            with self._condition:
+                self._counters["failed_compactions"] += 1
+
+
+def migrate_user(store: SegmentedChatStore, username: str, delete_arrays: bool = False):
+    """
+    Migrates every array chat of a user. Returns the number of chats
+    migrated
+    - store: SegmentedChatStore
+    - username: string
+    - delete_arrays: bool, delete the array files afterwards
+    """
+    chats = list_chat_objects(
+        store.chat_cache.s3_client, store.chat_cache.bucket_name, username, segmented=True
+    )
+    migrated = 0
+    for chat in chats:
+        if chat.key == chat_key(username, chat.chat_id):
+            migrated += store.migrate_chat(username, chat.chat_id, delete_arrays)
+        elif delete_arrays:
+            # Migrated by an append; its array file may still be there
+            store.migrate_chat(username, chat.chat_id, delete_array=True)
+    return migrated
+
+
+def main():
+    """
+    Migrates the chats of the given users to the segmented format
+    """
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("usernames", nargs="+")
+    parser.add_argument(
+        "--bucket", default=os.environ.get("HISTORY_BUCKET_NAME", "ece1779-chat-history")
+    )
+    parser.add_argument("--delete-arrays", action="store_true")
+    args = parser.parse_args()
+
+    # Migrations add no segments, so nothing is ever compacted
+    store = SegmentedChatStore(
+        ChatCache(boto3.client("s3"), args.bucket, 0),
+        small_segment_bytes=0,
+        compact_min_segments=1,
+        max_pending=0,
+        background=False,
+    )
+    for username in args.usernames:
+        print(f"{username}: migrated {migrate_user(store, username, args.delete_arrays)} chats")
+
+
+if __name__ == "__main__":
+    main()
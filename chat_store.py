@@ -0,0 +1,284 @@
+'''
+Discovery of the chat files stored in S3 under each user's prefix.
+
+Chats live at {username}/{chat_id}.json, with the chat's rolling summary (if
+any) next to it at {username}/{chat_id}.summary.json. Listing the prefix once tells us
+which chats exist along with their ETag, size and last-modified time, so
+reads never have to probe chat IDs that were deleted or never written.
+
+Chats in the segmented format (see chat_segments) are a manifest at
+{username}/{chat_id}.manifest.json and segment objects under
+{username}/{chat_id}.segments/. A listing of segmented chats reports the
+manifest of a chat in place of its array file.
+
+Tail reads fetch only the end of a chat file with a ranged GET and decode
+just the last few turns of the JSON array.
+
+BoundedS3Client caps the S3 requests in flight across every thread of the
+process, whether they come from the fetch pool, a request thread or a
+background worker.
+'''
+
+import io
+import re
+import threading
+from datetime import datetime
+from typing import NamedTuple
+
+from botocore.exceptions import ClientError
+
+import json_codec
+
+# Initial guess of the encoded size of one turn for ranged tail reads; the
+# range doubles until it holds enough turns
+TAIL_BYTES_PER_TURN = 2048
+
+
+class BoundedPaginator:
+    """
+    A boto3 paginator whose page requests take a slot of a BoundedS3Client
+    - paginator: boto3 paginator
+    - slots: threading.BoundedSemaphore
+    """
+
+    def __init__(self, paginator, slots):
+        self.paginator = paginator
+        self._slots = slots
+
+    def paginate(self, **kwargs):
+        """
+        Yields the pages of the listing, fetching each one in a slot
+        """
+        pages = iter(self.paginator.paginate(**kwargs))
+        while True:
+            with self._slots:
+                page = next(pages, None)
+            if page is None:
+                return
+            yield page
+
+
+class BoundedS3Client:
+    """
+    The subset of the S3 client used by the backend, with at most
+    max_concurrency requests in flight at once. Object bodies are read
+    before the slot is given back, so the connection is free by then
+    - s3_client: boto3 S3 client
+    - max_concurrency: int
+    """
+
+    def __init__(self, s3_client, max_concurrency: int):
+        self.s3_client = s3_client
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+
+    def get_object(self, **kwargs):
+        """
+        Returns an object, with its body already read
+        """
+        with self._slots:
+            response = self.s3_client.get_object(**kwargs)
+            response["Body"] = io.BytesIO(response["Body"].read())
+        return response
+
+    def put_object(self, **kwargs):
+        """
+        Stores an object
+        """
+        with self._slots:
+            return self.s3_client.put_object(**kwargs)
+
+    def delete_object(self, **kwargs):
+        """
+        Deletes an object
+        """
+        with self._slots:
+            return self.s3_client.delete_object(**kwargs)
+
+    def get_paginator(self, operation_name: str):
+        """
+        Returns a paginator whose page requests are bounded too
+        - operation_name: string
+        """
+        return BoundedPaginator(self.s3_client.get_paginator(operation_name), self._slots)
+
+
+class ChatObject(NamedTuple):
+    """
+    A chat file as reported by ListObjectsV2
+    - chat_id: int
+    - key: string, the S3 key of the chat file
+    - etag: string
+    - size: int, in bytes
+    - last_modified: datetime
+    """
+
+    chat_id: int
+    key: str
+    etag: str
+    size: int
+    last_modified: datetime
+
+
+def chat_key(username: str, chat_id: int):
+    """
+    Returns the S3 key of a chat file
+    - username: string
+    - chat_id: int
+    """
+    return f"{username}/{chat_id}.json"
+
+
+def summary_key(username: str, chat_id: int):
+    """
+    Returns the S3 key of a chat's rolling summary
+    - username: string
+    - chat_id: int
+    """
+    return f"{username}/{chat_id}.summary.json"
+
+
+def manifest_key(username: str, chat_id: int):
+    """
+    Returns the S3 key of a segmented chat's manifest
+    - username: string
+    - chat_id: int
+    """
+    return f"{username}/{chat_id}.manifest.json"
+
+
+def segment_key(username: str, chat_id: int, number: int):
+    """
+    Returns the S3 key of one segment of a segmented chat
+    - username: string
+    - chat_id: int
+    - number: int
+    """
+    return f"{username}/{chat_id}.segments/{number:08d}.jsonl"
+
+
+def list_chat_objects(s3_client, bucket_name: str, username: str, segmented: bool = False):
+    """
+    Lists every chat file under the user's prefix, paginating as needed, and
+    returns them as ChatObjects sorted by chat_id. Other objects under the
+    prefix are ignored
+    - s3_client: boto3 S3 client
+    - bucket_name: string
+    - username: string
+    - segmented: bool, also list manifests, which replace the array file of
+      their chat
+    """
+    prefix = f"{username}/"
+    suffix = r"(\.manifest)?\.json" if segmented else r"\.json"
+    key_pattern = re.compile(re.escape(prefix) + r"(\d+)" + suffix)
+    chats = {}
+
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        for item in page.get("Contents", []):
+            match = key_pattern.fullmatch(item["Key"])
+            if match is None:
+                continue
+            chat_id = int(match.group(1))
+            if chat_id in chats and not (segmented and match.group(2)):
+                continue
+            chats[chat_id] = ChatObject(
+                chat_id=chat_id,
+                key=item["Key"],
+                etag=item["ETag"],
+                size=item["Size"],
+                last_modified=item["LastModified"],
+            )
+
+    return [chats[chat_id] for chat_id in sorted(chats)]
+
+
+def parse_chat_tail(data: bytes, last_n_turns: int, complete: bool):
+    """
+    Decodes the last turns of a chat from the end of its JSON array. Returns
+    (turns, has_more), or None when data does not hold last_n_turns complete
+    turns and more of the file is needed
+    - data: bytes, a suffix of the chat file
+    - last_n_turns: int
+    - complete: bool, True if data is the whole chat file
+    """
+    if complete:
+        turns = json_codec.loads(data)
+        return turns[-last_n_turns:], len(turns) > last_n_turns
+
+    # The range may start inside a multi-byte character
+    text = data.lstrip(bytes(range(0x80, 0xC0))).decode("utf-8")
+
+    # Find the first turn boundary in the suffix: a "{" after "[" or "," from
+    # which the rest of the file parses as the tail of the array. Braces
+    # inside strings fail to parse and are skipped
+    start = text.find("{")
+    while start != -1:
+        before = start - 1
+        while before >= 0 and text[before].isspace():
+            before -= 1
+        if before >= 0 and text[before] in ",[":
+            try:
+                turns = json_codec.loads("[" + text[start:])
+            except ValueError:
+                turns = None
+            if turns is not None:
+                if len(turns) < last_n_turns:
+                    return None
+                return turns[-last_n_turns:], True
+        start = text.find("{", start + 1)
+    return None
+
+
+def fetch_chat_tail(s3_client, bucket_name: str, key: str, last_n_turns: int):
+    """
+    Reads the last turns of a chat file with ranged GETs, doubling the range
+    until it holds last_n_turns turns or covers the whole file. Returns
+    (turns, has_more), or None if the chat file does not exist
+    - s3_client: boto3 S3 client
+    - bucket_name: string
+    - key: string
+    - last_n_turns: int
+    """
+    range_bytes = TAIL_BYTES_PER_TURN * last_n_turns
+    while True:
+        try:
+            response = s3_client.get_object(
+                Bucket=bucket_name, Key=key, Range=f"bytes=-{range_bytes}"
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "NoSuchKey":
+                return None
+            raise
+
+        # Content-Range is "bytes <first>-<last>/<total>"
+        content_range = response.get("ContentRange") or "bytes 0-"
+        complete = content_range.split(" ")[1].startswith("0-")
+        tail = parse_chat_tail(response["Body"].read(), last_n_turns, complete)
+        if tail is not None:
+            return tail
+        range_bytes *= 2
+
+
+def read_array_turns(chat_cache, key: str, last_n_turns: int = None):
+    """
+    Reads a chat array file, or only its last turns. Returns (turns,
+    has_more, first), or None if the file does not exist. first is the index
+    in the chat of the first returned turn, or None when only the end of the
+    file was read and the number of turns before it is unknown. Only the end
+    of the file is downloaded unless the chat is already cached
+    - chat_cache: ChatCache
+    - key: string
+    - last_n_turns: int (optional, defaults to every turn)
+    """
+    if last_n_turns is None or chat_cache.get(key) is not None:
+        entry = chat_cache.fetch(key)
+        if entry is None:
+            return None
+        turns = entry.chat if last_n_turns is None else entry.chat[-last_n_turns:]
+        first = len(entry.chat) - len(turns)
+        return turns, first > 0, first
+    tail = fetch_chat_tail(chat_cache.s3_client, chat_cache.bucket_name, key, last_n_turns)
+    if tail is None:
+        return None
+    turns, has_more = tail
+    return turns, has_more, None if has_more else 0
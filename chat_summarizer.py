@@ -0,0 +1,220 @@
+'''
+Rolling summaries of long chats, generated in the background.
+
+Every few turns the turns of a chat that are not summarized yet, except the
+most recent ones, are folded into the chat's summary by the model. The
+summary is stored next to the chat file as
+    {"summary": <text>, "turn_count": <turns covered>}
+Prompts then carry the summary plus the turns that came after it instead of
+the whole transcript. The summary covers the first turn_count turns of the
+chat, so the turns after it are found by their index.
+
+Most chats never get a summary, so a chat found without one is remembered
+for missing_ttl_seconds and its summary is not looked up again meanwhile.
+
+Summaries are produced by a single worker thread that waits at least
+min_interval_seconds between generations, so they never run on the request
+path and only take a bounded share of the endpoint. Requests for the same
+chat that are already queued are coalesced, and requests beyond max_pending
+are dropped; the next scheduled turn picks the work up again.
+'''
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from chat_store import chat_key, summary_key
+from context_builder import format_turn
+import json_codec
+
+# Chats remembered to have no summary
+MISSING_MAX_CHATS = 10000
+SUMMARY_INSTRUCTIONS = """Summarize the conversation below between a user and a companion.
+    Keep what the user shared about themselves, their feelings and the topics
+    discussed, as needed to continue the conversation. Reply with the summary only.
+    """
+
+
+def turns_after_summary(turns: list, first: int, summary: dict):
+    """
+    Returns the turns that come after the turns covered by the summary
+    - turns: list of turn dicts, oldest first, e.g. the tail of a chat
+    - first: int, index in the chat of the first of the turns
+    - summary: dict
+    """
+    return turns[max(0, summary["turn_count"] - first) :]
+
+
+def build_summary_input(summary: Optional[dict], turns: list):
+    """
+    Builds the model input that folds new turns into a summary
+    - summary: dict (optional), the current summary
+    - turns: list of turn dicts to add to it
+    """
+    parts = [SUMMARY_INSTRUCTIONS]
+    if summary is not None:
+        parts.append(f"Summary so far:\n{summary['summary']}\n")
+    parts.append("Conversation:\n")
+    parts.extend(format_turn(turn) for turn in turns)
+    parts.append("Summary:\n")
+    return "".join(parts)
+
+
+class ChatSummarizer:
+    """
+    Keeps rolling summaries of chats up to date from a background thread
+    - chat_cache: ChatCache, used to read chats and to read and write
+      summaries
+    - generate: callable(inputs: str) returning the generated text
+    - every_turns: int, a chat is summarized again every this many turns
+    - recent_turns: int, newest turns left out of the summary
+    - min_interval_seconds: float, minimum time between two generations
+    - max_pending: int, chats that may wait for a summary at once
+    - chat_segments: SegmentedChatStore (optional), read chats in the
+      segmented format
+    - missing_ttl_seconds: float, how long a chat without a summary is not
+      looked up again; summaries written by this process are seen at once
+    """
+
+    def __init__(
+        self,
+        chat_cache,
+        generate,
+        every_turns: int,
+        recent_turns: int,
+        min_interval_seconds: float,
+        max_pending: int,
+        chat_segments=None,
+        missing_ttl_seconds: float = 60,
+    ):
+        self.chat_cache = chat_cache
+        self.chat_segments = chat_segments
+        self.generate = generate
+        self.every_turns = every_turns
+        self.recent_turns = recent_turns
+        self.min_interval_seconds = min_interval_seconds
+        self.max_pending = max_pending
+        self.missing_ttl_seconds = missing_ttl_seconds
+        self._pending = OrderedDict()
+        self._missing = OrderedDict()
+        self._condition = threading.Condition()
+        self._worker = None
+        self._counters = {
+            "scheduled": 0,
+            "coalesced": 0,
+            "dropped": 0,
+            "generated": 0,
+            "skipped": 0,
+            "failed": 0,
+            "missing_hits": 0,
+        }
+
+    def schedule(self, username: str, chat_id: int, turn_count: int):
+        """
+        Queues the chat for summarization if turn_count is a multiple of
+        every_turns. Never blocks
+        - username: string
+        - chat_id: int
+        - turn_count: int, turns in the chat including the new one
+        """
+        if turn_count % self.every_turns:
+            return
+        with self._condition:
+            if self._worker is None:
+                self._worker = threading.Thread(
+                    target=self._run, name="chat-summarizer", daemon=True
+                )
+                self._worker.start()
+            if (username, chat_id) in self._pending:
+                self._counters["coalesced"] += 1
+                return
+            if len(self._pending) >= self.max_pending:
+                self._counters["dropped"] += 1
+                return
+            self._counters["scheduled"] += 1
+            self._pending[(username, chat_id)] = None
+            self._condition.notify()
+
+    def get(self, username: str, chat_id: int) -> Optional[dict]:
+        """
+        Returns the chat's summary, or None if it has none yet
+        - username: string
+        - chat_id: int
+        """
+        key = (username, int(chat_id))
+        with self._condition:
+            expires_at = self._missing.get(key)
+            if expires_at is not None:
+                if expires_at > time.monotonic():
+                    self._counters["missing_hits"] += 1
+                    return None
+                del self._missing[key]
+        entry = self.chat_cache.fetch(summary_key(username, chat_id))
+        if entry is not None:
+            return entry.chat
+        with self._condition:
+            self._missing[key] = time.monotonic() + self.missing_ttl_seconds
+            self._missing.move_to_end(key)
+            while len(self._missing) > MISSING_MAX_CHATS:
+                self._missing.popitem(last=False)
+        return None
+
+    def stats(self):
+        """
+        Returns the summarization counters and queue length
+        """
+        with self._condition:
+            return {**self._counters, "queued": len(self._pending)}
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                (username, chat_id), _ = self._pending.popitem(last=False)
+
+            started = time.monotonic()
+            try:
+                outcome = "generated" if self._summarize(username, chat_id) else "skipped"
+            except Exception as e:  # pylint: disable=broad-except
+                print(f"Failed to summarize {username}/{chat_id}: {e}")
+                outcome = "failed"
+            with self._condition:
+                self._counters[outcome] += 1
+            if outcome != "skipped":
+                time.sleep(max(0.0, started + self.min_interval_seconds - time.monotonic()))
+
+    def _summarize(self, username: str, chat_id: int):
+        """
+        Folds the turns that are not summarized yet, except the newest
+        recent_turns, into the chat's summary. Returns False if there was
+        nothing to add
+        """
+        if self.chat_segments is not None:
+            chat = self.chat_segments.fetch(username, chat_id)
+        else:
+            chat = self.chat_cache.fetch(chat_key(username, chat_id))
+        if chat is None:
+            return False
+        entry = self.chat_cache.fetch(summary_key(username, chat_id))
+        summary = entry.chat if entry is not None else None
+        turns = chat.chat
+        if summary is not None:
+            turns = turns[summary["turn_count"] :]
+        turns = turns[: max(0, len(turns) - self.recent_turns)]
+        if not turns:
+            return False
+
+        text = self.generate(build_summary_input(summary, turns)).strip()
+        new_summary = {
+            "summary": text,
+            "turn_count": (summary["turn_count"] if summary else 0) + len(turns),
+        }
+        self._store(summary_key(username, chat_id), new_summary)
+        with self._condition:
+            self._missing.pop((username, int(chat_id)), None)
+        return True
+
+    def _store(self, key: str, summary: dict):
+        self.chat_cache.write(key, summary, json_codec.dumps(summary))
@@ -0,0 +1,355 @@
+'''
+Circuit breaking, adaptive timeouts and failover for SageMaker endpoints.
+
+Each endpoint has a CircuitBreaker. After failure_threshold consecutive
+failures (timeouts, connection errors, throttling or 5xx responses) the
+circuit opens and calls to the endpoint fail immediately instead of waiting
+out a timeout. After reset_timeout_seconds one probe call is let through:
+success closes the circuit again, failure reopens it.
+
+Timeouts follow the endpoint's recent latency. botocore fixes the read
+timeout per client, so one client is created per timeout bucket and each
+call uses the smallest bucket above a multiple of the recent p99 latency.
+
+ResilientEndpoint tries the primary endpoint, then the optional secondary
+endpoint, and raises EndpointUnavailable when no endpoint can take the call,
+so callers can answer with a fast degraded response. Requests the model
+container rejects as invalid (e.g. a prompt over its input token limit) are
+not endpoint failures: they raise InvalidModelRequest without failing over.
+'''
+
+import math
+import threading
+import time
+from collections import deque
+
+from botocore.exceptions import ClientError, ConnectionError as BotoConnectionError
+from botocore.exceptions import HTTPClientError, ReadTimeoutError
+
+from metrics import Histogram
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+# Error codes of invoke_endpoint that mean the endpoint is unhealthy rather
+# than that the request is invalid. ModelError (HTTP 424) wraps whatever the
+# container answered, so it is judged by the container's status instead
+FAILURE_ERROR_CODES = {
+    "ModelNotReadyException",
+    "InternalFailure",
+    "InternalDependencyException",
+    "ServiceUnavailable",
+    "ThrottlingException",
+}
+LATENCY_BUCKETS = [0.25, 0.5, 1, 2, 4, 8, 16, 32, 64]
+
+
+class EndpointUnavailable(Exception):
+    """
+    Raised when every endpoint's circuit is open or failed the call
+    - retry_after: int, seconds until an endpoint may accept calls again
+    """
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class InvalidModelRequest(Exception):
+    """
+    Raised when the model container rejects a request as invalid
+    - status_code: int, the container's 4xx status
+    """
+
+    def __init__(self, message: str, status_code: int):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def model_error_status(error: Exception):
+    """
+    Returns the container's status code wrapped in a ModelError, or None for
+    any other error or when the status is missing
+    - error: Exception
+    """
+    if not isinstance(error, ClientError):
+        return None
+    if error.response.get("Error", {}).get("Code") != "ModelError":
+        return None
+    status = error.response.get(
+        "OriginalStatusCode", error.response.get("Error", {}).get("OriginalStatusCode")
+    )
+    try:
+        return int(status)
+    except (TypeError, ValueError):
+        return None
+
+
+def is_endpoint_failure(error: Exception):
+    """
+    Checks if an invoke_endpoint error counts against the endpoint's health.
+    A ModelError only does when the container answered with a 5xx or 429 (or
+    its status is missing)
+    - error: Exception
+    """
+    if isinstance(error, (BotoConnectionError, HTTPClientError)):
+        return True
+    if isinstance(error, ClientError):
+        code = error.response.get("Error", {}).get("Code")
+        if code == "ModelError":
+            status = model_error_status(error)
+            return status is None or status == 429 or status >= 500
+        status = error.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+        return code in FAILURE_ERROR_CODES or status == 429 or status >= 500
+    return False
+
+
+class CircuitBreaker:
+    """
+    Consecutive-failure circuit breaker
+    - failure_threshold: int, consecutive failures that open the circuit
+    - reset_timeout_seconds: float, how long the circuit stays open before a
+      probe call is let through
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout_seconds = reset_timeout_seconds
+        self.state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+        self._transitions = {}
+        self._counters = {"successes": 0, "failures": 0, "rejected": 0}
+
+    def allow(self):
+        """
+        Checks if a call may go through, moving an open circuit to half-open
+        once the reset timeout has passed. Only one probe call is allowed
+        while half-open
+        """
+        with self._lock:
+            if self.state == OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout_seconds:
+                    self._counters["rejected"] += 1
+                    return False
+                self._transition(HALF_OPEN)
+            if self.state == HALF_OPEN:
+                if self._probing:
+                    self._counters["rejected"] += 1
+                    return False
+                self._probing = True
+            return True
+
+    def record_success(self):
+        """
+        Records a successful call, closing a half-open circuit
+        """
+        with self._lock:
+            self._counters["successes"] += 1
+            self._failures = 0
+            self._probing = False
+            if self.state != CLOSED:
+                self._transition(CLOSED)
+
+    def record_failure(self):
+        """
+        Records a failed call, opening the circuit when a probe fails or the
+        failure threshold is reached
+        """
+        with self._lock:
+            self._counters["failures"] += 1
+            self._failures += 1
+            self._probing = False
+            if self.state == HALF_OPEN or (
+                self.state == CLOSED and self._failures >= self.failure_threshold
+            ):
+                self._opened_at = time.monotonic()
+                self._transition(OPEN)
+
+    def retry_after(self):
+        """
+        Returns the seconds until an open circuit lets a probe through, or 0
+        """
+        with self._lock:
+            if self.state != OPEN:
+                return 0.0
+            elapsed = time.monotonic() - self._opened_at
+            return max(0.0, self.reset_timeout_seconds - elapsed)
+
+    def stats(self):
+        """
+        Returns the state, call counters and transition counts
+        """
+        with self._lock:
+            return {
+                "state": self.state,
+                **self._counters,
+                "transitions": dict(self._transitions),
+            }
+
+    def _transition(self, state: str):
+        name = f"{self.state}_to_{state}"
+        self._transitions[name] = self._transitions.get(name, 0) + 1
+        print(f"Circuit breaker: {self.state} -> {state}")
+        self.state = state
+
+
+class AdaptiveTimeout:
+    """
+    Picks a read timeout from fixed buckets based on recent call latencies
+    - timeouts: list of float, the available read timeouts in seconds
+    - multiplier: float, headroom over the recent p99 latency
+    - window: int, number of recent latencies considered
+    - min_samples: int, latencies needed before timeouts are tightened
+    """
+
+    def __init__(self, timeouts, multiplier: float, window: int, min_samples: int):
+        self.timeouts = sorted(timeouts)
+        self.multiplier = multiplier
+        self.min_samples = min_samples
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float):
+        """
+        Records the latency of a call. Timed-out calls record the timeout
+        - seconds: float
+        """
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def current(self):
+        """
+        Returns the smallest timeout bucket above multiplier times the recent
+        p99 latency, or the largest bucket until enough calls were observed
+        """
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return self.timeouts[-1]
+            latencies = sorted(self._latencies)
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        target = p99 * self.multiplier
+        for timeout in self.timeouts:
+            if timeout >= target:
+                return timeout
+        return self.timeouts[-1]
+
+
+class ResilientEndpoint:
+    """
+    Invokes the primary SageMaker endpoint, failing over to the secondary
+    one, through per-endpoint circuit breakers and adaptive timeouts
+    - clients: dict of read timeout (seconds) to sagemaker-runtime client
+    - endpoint_names: list of string, primary first
+    - failure_threshold: int
+    - reset_timeout_seconds: float
+    - timeout_multiplier: float
+    """
+
+    def __init__(
+        self,
+        clients: dict,
+        endpoint_names: list,
+        failure_threshold: int,
+        reset_timeout_seconds: float,
+        timeout_multiplier: float = 3.0,
+    ):
+        self.clients = clients
+        self.endpoint_names = endpoint_names
+        self.breakers = {
+            name: CircuitBreaker(failure_threshold, reset_timeout_seconds)
+            for name in endpoint_names
+        }
+        self.timeouts = {
+            name: AdaptiveTimeout(
+                clients.keys(), timeout_multiplier, window=200, min_samples=20
+            )
+            for name in endpoint_names
+        }
+        self.latencies = {name: Histogram(LATENCY_BUCKETS) for name in endpoint_names}
+        self._lock = threading.Lock()
+        self._counters = {"failovers": 0, "unavailable": 0}
+
+    def invoke(self, method: str, **kwargs):
+        """
+        Calls a sagemaker-runtime method (invoke_endpoint or
+        invoke_endpoint_with_response_stream) on the first endpoint that
+        accepts it and returns the response. Raises EndpointUnavailable if
+        none does, and InvalidModelRequest if the container rejects the
+        request as invalid, without trying the next endpoint. Streaming
+        calls always use the largest timeout, since their read timeout
+        applies between chunks
+        - method: string
+        - kwargs: the call's arguments, without EndpointName
+        """
+        for index, name in enumerate(self.endpoint_names):
+            breaker = self.breakers[name]
+            if not breaker.allow():
+                continue
+            if index > 0:
+                self._count("failovers")
+
+            adaptive = self.timeouts[name]
+            timeout = adaptive.timeouts[-1] if "stream" in method else adaptive.current()
+            started = time.monotonic()
+            try:
+                response = getattr(self.clients[timeout], method)(
+                    EndpointName=name, **kwargs
+                )
+            except Exception as e:  # pylint: disable=broad-except
+                if not is_endpoint_failure(e):
+                    # The request itself is invalid; the endpoint answered
+                    breaker.record_success()
+                    status = model_error_status(e)
+                    if status is not None:
+                        raise InvalidModelRequest(str(e), status) from e
+                    raise
+                print(f"Endpoint {name} failed: {e}")
+                if isinstance(e, ReadTimeoutError):
+                    adaptive.observe(timeout)
+                breaker.record_failure()
+                continue
+
+            elapsed = time.monotonic() - started
+            adaptive.observe(elapsed)
+            self.latencies[name].observe(elapsed)
+            breaker.record_success()
+            return response
+
+        self._count("unavailable")
+        raise EndpointUnavailable(
+            "No inference endpoint is available", self.retry_after()
+        )
+
+    def retry_after(self):
+        """
+        Returns the whole seconds until the first endpoint lets calls through
+        again, at least 1
+        """
+        waits = [breaker.retry_after() for breaker in self.breakers.values()]
+        return max(1, math.ceil(min(waits)))
+
+    def stats(self):
+        """
+        Returns failover counters and, per endpoint, the breaker state and
+        transitions, the current timeout and the latency distribution
+        """
+        with self._lock:
+            counters = dict(self._counters)
+        return {
+            **counters,
+            "endpoints": {
+                name: {
+                    **self.breakers[name].stats(),
+                    "timeout_seconds": self.timeouts[name].current(),
+                    "latency_seconds": self.latencies[name].stats(),
+                }
+                for name in self.endpoint_names
+            },
+        }
+
+    def _count(self, counter: str):
+        with self._lock:
+            self._counters[counter] += 1
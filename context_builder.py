@@ -0,0 +1,165 @@
+'''
+Token-budgeted conversation context for generation requests.
+
+Recent turns of a chat are prepended to the model input, newest first, until
+the configured input-token budget is spent, so the model sees as much of the
+conversation as fits without letting long chats inflate input tokens and
+latency.
+
+Token counts of turns are cached by content: the turns of a chat are the same
+from one request to the next, so building the input for turn N+1 only counts
+the tokens of turn N. Counts come from a Hugging Face tokenizer file when the
+tokenizers package is installed and one is configured, and from a
+character-based estimate otherwise.
+'''
+
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+
+from metrics import Histogram
+
+try:
+    from tokenizers import Tokenizer
+except ImportError:
+    Tokenizer = None
+
+# Roughly how many characters of English text a BPE token covers
+CHARS_PER_TOKEN = 4
+TOKEN_PIECE_PATTERN = re.compile(r"\w+|[^\w\s]")
+CONTEXT_TURN_BUCKETS = [0, 1, 2, 4, 8, 16, 32, 64]
+CONTEXT_TOKEN_BUCKETS = [64, 128, 256, 512, 1024, 2048, 4096]
+
+
+def estimate_tokens(text: str):
+    """
+    Estimates the token count of text without a tokenizer: words are split
+    into pieces of CHARS_PER_TOKEN characters and punctuation counts as one
+    token each
+    - text: string
+    """
+    return sum(
+        -(-len(piece) // CHARS_PER_TOKEN) for piece in TOKEN_PIECE_PATTERN.findall(text)
+    )
+
+
+def format_turn(turn: dict):
+    """
+    Renders one stored chat turn as model input
+    - turn: dict with prompt and model_response
+    """
+    return f"User: {turn.get('prompt', '')}\nAssistant: {turn.get('model_response', '')}\n"
+
+
+class TokenCounter:
+    """
+    Counts tokens, caching the counts of recently seen texts
+    - max_entries: int
+    - tokenizer_file: string (optional), a Hugging Face tokenizer.json to
+      count with; requires the tokenizers package
+    """
+
+    def __init__(self, max_entries: int, tokenizer_file: str = None):
+        self.max_entries = max_entries
+        self._tokenizer = None
+        if tokenizer_file:
+            if Tokenizer is None:
+                raise ImportError("tokenizer_file requires the tokenizers package")
+            self._tokenizer = Tokenizer.from_file(tokenizer_file)
+        self._counts = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0}
+
+    def count(self, text: str):
+        """
+        Returns the token count of text, tokenizing it only if it was not
+        counted recently
+        - text: string
+        """
+        key = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+        with self._lock:
+            tokens = self._counts.get(key)
+            if tokens is not None:
+                self._counts.move_to_end(key)
+                self._counters["hits"] += 1
+                return tokens
+            self._counters["misses"] += 1
+
+        tokens = self.tokenize(text)
+        with self._lock:
+            self._counts[key] = tokens
+            while len(self._counts) > self.max_entries:
+                self._counts.popitem(last=False)
+        return tokens
+
+    def tokenize(self, text: str):
+        """
+        Returns the token count of text without the cache
+        - text: string
+        """
+        if self._tokenizer is not None:
+            return len(self._tokenizer.encode(text, add_special_tokens=False).ids)
+        return estimate_tokens(text)
+
+    def stats(self):
+        """
+        Returns the cache counters and current size
+        """
+        with self._lock:
+            return {
+                **self._counters,
+                "entries": len(self._counts),
+                "tokenizer": "tokenizers" if self._tokenizer is not None else "estimate",
+            }
+
+
+class ContextBuilder:
+    """
+    Fits the most recent turns of a chat into an input-token budget
+    - token_counter: TokenCounter
+    - token_budget: int, input tokens for the instructions, the prompt and
+      the included turns together
+    """
+
+    def __init__(self, token_counter: TokenCounter, token_budget: int):
+        self.token_counter = token_counter
+        self.token_budget = token_budget
+        self.context_turns = Histogram(CONTEXT_TURN_BUCKETS)
+        self.context_tokens = Histogram(CONTEXT_TOKEN_BUCKETS)
+
+    def build(self, turns: list, reserved: str):
+        """
+        Returns the context block for the newest turns that fit in the budget
+        left over by reserved, oldest first, and the number of turns in it.
+        Turns are taken newest first and stop at the first one that does not
+        fit, so the context never skips a turn
+        - turns: list of turn dicts, oldest first
+        - reserved: string, the rest of the model input (instructions and
+          prompt), which always goes in
+        """
+        remaining = self.token_budget - self.token_counter.tokenize(reserved)
+        included = []
+        for turn in reversed(turns):
+            text = format_turn(turn)
+            tokens = self.token_counter.count(text)
+            if tokens > remaining:
+                break
+            remaining -= tokens
+            included.append(text)
+
+        self.context_turns.observe(len(included))
+        self.context_tokens.observe(self.token_budget - remaining)
+        return "".join(reversed(included)), len(included)
+
+    def stats(self):
+        """
+        Returns the token budget, token count cache counters and the
+        distributions of turns and tokens per built input
+        """
+        return {
+            "token_budget": self.token_budget,
+            "token_counts": self.token_counter.stats(),
+            "context_turns": self.context_turns.stats(),
+            "context_tokens": self.context_tokens.stats(),
+        }
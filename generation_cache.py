@@ -0,0 +1,188 @@
+'''
+Exact-match cache of model generations for repeated prompts.
+
+Entries are keyed on the normalized model input plus the generation
+parameters and expire after a TTL. A bounded in-memory LRU tier answers most
+lookups; an optional SQLite tier keeps entries across restarts.
+
+Caching only makes sense for deterministic generations: a sampled reply is
+one draw out of many, so parameters that enable sampling make a request
+uncacheable unless allow_sampling is set.
+'''
+
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import json_codec
+
+# Generation parameters that make TGI sample instead of decoding greedily
+SAMPLING_PARAMETERS = ("temperature", "top_p", "top_k", "typical_p")
+# How many writes go to the SQLite tier between expiry / size pruning passes
+DISK_PRUNE_INTERVAL = 100
+
+
+def normalize_prompt(text: str):
+    """
+    Case-folds the text and collapses runs of whitespace
+    - text: string
+    """
+    return " ".join(text.casefold().split())
+
+
+def uses_sampling(parameters: dict):
+    """
+    Checks if generation parameters make the output non-deterministic. A
+    fixed seed makes sampling reproducible
+    - parameters: dict
+    """
+    if parameters.get("seed") is not None:
+        return False
+    if parameters.get("do_sample"):
+        return True
+    temperature = parameters.get("temperature")
+    if temperature is not None and temperature not in (0, 1):
+        return True
+    top_p = parameters.get("top_p")
+    if top_p is not None and top_p < 1:
+        return True
+    return bool(parameters.get("top_k") or parameters.get("typical_p"))
+
+
+class GenerationCache:
+    """
+    Two-tier TTL cache of generated text
+    - max_entries: int, size of the in-memory tier (and of the SQLite tier)
+    - ttl_seconds: float
+    - db_path: string (optional), SQLite file of the persistent tier
+    - allow_sampling: bool, also cache generations that use sampling
+    """
+
+    def __init__(
+        self,
+        max_entries: int,
+        ttl_seconds: float,
+        db_path: Optional[str] = None,
+        allow_sampling: bool = False,
+    ):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.allow_sampling = allow_sampling
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {
+            "hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "uncacheable": 0,
+        }
+        self._disk_writes = 0
+        self._db = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS generations "
+                "(key TEXT PRIMARY KEY, text TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._db.commit()
+
+    def accepts(self, parameters: dict):
+        """
+        Checks if generations with these parameters may be cached
+        - parameters: dict
+        """
+        if self.allow_sampling or not uses_sampling(parameters):
+            return True
+        with self._lock:
+            self._counters["uncacheable"] += 1
+        return False
+
+    @staticmethod
+    def key(inputs: str, parameters: dict):
+        """
+        Returns the cache key of a generation request
+        - inputs: string, the model input
+        - parameters: dict
+        """
+        digest = hashlib.sha256(normalize_prompt(inputs).encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(json_codec.dumps(dict(sorted(parameters.items()))))
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Returns the cached text for key, or None if it is missing or expired
+        - key: string
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                text, expires_at = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self._counters["hits"] += 1
+                    return text
+                del self._entries[key]
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT text, expires_at FROM generations WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and row[1] > now:
+                    self._store(key, row[0], row[1])
+                    self._counters["disk_hits"] += 1
+                    return row[0]
+
+            self._counters["misses"] += 1
+            return None
+
+    def put(self, key: str, text: str):
+        """
+        Caches generated text under key for the TTL
+        - key: string
+        - text: string
+        """
+        expires_at = time.time() + self.ttl_seconds
+        with self._lock:
+            self._store(key, text, expires_at)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO generations VALUES (?, ?, ?)",
+                    (key, text, expires_at),
+                )
+                self._disk_writes += 1
+                if self._disk_writes % DISK_PRUNE_INTERVAL == 0:
+                    self._prune_disk()
+                self._db.commit()
+
+    def stats(self):
+        """
+        Returns the cache counters and current size
+        """
+        with self._lock:
+            return {
+                **self._counters,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "persistent": self._db is not None,
+            }
+
+    def _store(self, key: str, text: str, expires_at: float):
+        self._entries[key] = (text, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._counters["evictions"] += 1
+
+    def _prune_disk(self):
+        self._db.execute("DELETE FROM generations WHERE expires_at <= ?", (time.time(),))
+        self._db.execute(
+            "DELETE FROM generations WHERE key IN (SELECT key FROM generations "
+            "ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
@@ -0,0 +1,268 @@
+'''
+Chat history append engine, and the AddChatHistory Lambda handler.
+
+Appending turns to a chat is a read-modify-write of the whole chat file at
+{username}/{chat_id}.json: the file is read, decoded, extended, encoded and
+put back, conditional on the ETag that was read so that a concurrent writer
+is detected and the append redone on the new version. The cost of an append
+grows with the size of the chat, not of the turn (see
+benchmarks/bench_history_append).
+
+The same HistoryAppender runs
+- in-process, as the "s3" sink of the write-behind buffer
+- behind a thread pool, writing the chats of a flush in parallel
+- as the AddChatHistory Lambda (lambda_handler), which accepts the
+  single-turn payload {"username", "chat_id", "model_history_entry"} and the
+  batched one {"chats": [{"username", "chat_id", "model_history_entries"}]}
+
+The Lambda is invoked asynchronously, so a failed append has to raise for
+Lambda's retries and dead-letter queue to see it. An event none of whose
+chats were written raises. When only some chats of a batch fail, the
+function invokes itself with those chats alone, so that a retry never
+appends the turns of the written chats a second time.
+
+Reads go through a ChatCache, so a chat that was written by the same process
+is revalidated with a conditional GET instead of downloaded and decoded.
+With a SegmentedChatStore, turns are appended as new segments instead (see
+chat_segments), and an append no longer rewrites the chat.
+
+To deploy the handler, zip history_append.py, chat_cache.py, chat_segments.py,
+chat_store.py and json_codec.py and set the Lambda handler to
+history_append.lambda_handler. Set CHAT_STORAGE=segments on the Lambda to
+write the segmented format.
+'''
+
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from functools import partial
+
+import boto3
+from botocore.exceptions import ClientError
+
+from chat_cache import ChatCache
+from chat_segments import WRITE_ATTEMPTS, SegmentedChatStore, is_conflict
+from chat_store import chat_key
+import json_codec
+
+LAMBDA_BUCKET_NAME = os.environ.get("HISTORY_BUCKET_NAME", "ece1779-chat-history")
+# Chats cached by a warm Lambda instance between invocations
+LAMBDA_CACHE_MAX_BYTES = int(os.environ.get("HISTORY_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+# "array" or "segments", see chat_segments
+LAMBDA_CHAT_STORAGE = os.environ.get("CHAT_STORAGE", "array")
+LAMBDA_SMALL_SEGMENT_BYTES = 64 * 1024
+LAMBDA_COMPACT_MIN_SEGMENTS = 8
+
+
+def parse_event(event: dict):
+    """
+    Returns the turns of an AddChatHistory payload as an OrderedDict of
+    (username, chat_id) to list of turns. Raises ValueError on a malformed
+    payload
+    - event: dict, single-turn or batched payload
+    """
+    chats = OrderedDict()
+    try:
+        if "chats" in event:
+            for chat in event["chats"]:
+                key = (chat["username"], int(chat["chat_id"]))
+                chats.setdefault(key, []).extend(chat["model_history_entries"])
+        else:
+            key = (event["username"], int(event["chat_id"]))
+            chats[key] = [event["model_history_entry"]]
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError(f"Malformed history payload: {e!r}") from e
+    return chats
+
+
+class HistoryAppender:
+    """
+    Appends turns to the chat files in S3. Written chats are stored in the
+    chat cache
+    - chat_cache: ChatCache
+    - executor: concurrent.futures.Executor (optional), writes the chats of a
+      batch in parallel; without it they are written one after the other
+    - segments: SegmentedChatStore (optional), append in the segmented format
+      instead of rewriting the chat array files
+    """
+
+    def __init__(self, chat_cache, executor=None, segments=None):
+        self.chat_cache = chat_cache
+        self.executor = executor
+        self.segments = segments
+        self._lock = threading.Lock()
+        self._counters = {"appended": 0, "writes": 0, "conflicts": 0, "failed": 0}
+
+    def write(self, chats: OrderedDict):
+        """
+        Writes the queued turns. Returns the keys of the chats that were
+        written
+        - chats: OrderedDict of (username, chat_id) to list of turns
+        """
+        futures = [self._submit(key, entries) for key, entries in chats.items()]
+        return [key for key, future in zip(chats, futures) if future.result()]
+
+    def append(self, username: str, chat_id: int, entries: list):
+        """
+        Appends turns to one chat, creating it if needed. Returns the bytes
+        written
+        - username: string
+        - chat_id: int
+        - entries: list of turns
+        """
+        if self.segments is not None:
+            written = self.segments.append(username, chat_id, entries)
+            with self._lock:
+                self._counters["appended"] += len(entries)
+                self._counters["writes"] += 1
+            return written
+
+        key = chat_key(username, chat_id)
+        for attempt in range(WRITE_ATTEMPTS):
+            current = self.chat_cache.fetch(key)
+            chat = (current.chat if current is not None else []) + entries
+            encoded = json_codec.dumps(chat)
+            condition = (
+                {"IfMatch": current.etag} if current is not None else {"IfNoneMatch": "*"}
+            )
+            try:
+                self.chat_cache.write(key, chat, encoded, **condition)
+            except ClientError as e:
+                # Someone else wrote the chat since it was read
+                if not is_conflict(e) or attempt == WRITE_ATTEMPTS - 1:
+                    raise
+                self._count("conflicts")
+                continue
+            with self._lock:
+                self._counters["appended"] += len(entries)
+                self._counters["writes"] += 1
+            return len(encoded)
+
+    def stats(self):
+        """
+        Returns the append / write / conflict counters
+        """
+        with self._lock:
+            return dict(self._counters)
+
+    def _submit(self, key: tuple, entries: list):
+        if self.executor is not None:
+            try:
+                return self.executor.submit(self._try_append, key, entries)
+            except RuntimeError:
+                # Pools are shut down before atexit handlers run, so the final
+                # drain of the write-behind buffer writes inline
+                pass
+        future = Future()
+        future.set_result(self._try_append(key, entries))
+        return future
+
+    def _try_append(self, key: tuple, entries: list):
+        username, chat_id = key
+        try:
+            self.append(username, chat_id, entries)
+        # Any failure fails this chat only: the caller retries or reports the
+        # chats that were not written, and the others must not be written again
+        except Exception as e:  # pylint: disable=broad-except
+            print(f"Failed to write history of {username}/{chat_id}: {e!r}")
+            self._count("failed")
+            return False
+        return True
+
+    def _count(self, counter: str):
+        with self._lock:
+            self._counters[counter] += 1
+
+
+class AppendFailed(Exception):
+    """
+    Raised when chats of an AddChatHistory payload were not written and
+    cannot be retried on their own
+    """
+
+
+def invoke_async(lambda_client, function_name: str, event: dict):
+    """
+    Sends an event to a Lambda function with an Event invocation
+    - lambda_client: boto3 Lambda client
+    - function_name: string
+    - event: dict
+    """
+    lambda_client.invoke(
+        FunctionName=function_name,
+        InvocationType="Event",
+        Payload=json_codec.dumps(event),
+    )
+
+
+def handle_event(appender: HistoryAppender, event: dict, retry=None):
+    """
+    Appends the turns of an AddChatHistory payload. Raises AppendFailed when
+    no chat was written. When only some were, the failed chats are passed to
+    retry as a batched payload, so that retrying them does not append the
+    turns of the written chats again; without retry, AppendFailed is raised
+    - appender: HistoryAppender
+    - event: dict, single-turn or batched payload
+    - retry: callable (optional), takes the payload of the failed chats
+    """
+    try:
+        chats = parse_event(event)
+    except ValueError as e:
+        # Retrying a malformed payload cannot succeed
+        print(e)
+        return {"status_code": 400, "message": str(e)}
+
+    written = set(appender.write(chats))
+    failed = [key for key in chats if key not in written]
+    if failed and (not written or retry is None):
+        raise AppendFailed(f"Failed to write {len(failed)} of {len(chats)} chats")
+    if failed:
+        print(f"Retrying {len(failed)} of {len(chats)} chats in a new invocation")
+        retry(
+            {
+                "chats": [
+                    {
+                        "username": username,
+                        "chat_id": chat_id,
+                        "model_history_entries": chats[(username, chat_id)],
+                    }
+                    for username, chat_id in failed
+                ]
+            }
+        )
+    return {"status_code": 200, "written": len(written), "retried": len(failed)}
+
+
+_LAMBDA_APPENDER = None
+_LAMBDA_CLIENT = None
+
+
+def lambda_handler(event, context):
+    """
+    AddChatHistory entry point. The appender, and its chat cache, are kept by
+    a warm Lambda instance between invocations. Chats that fail in a batch
+    that was partly written are sent to this function again
+    - event: dict, single-turn or batched payload
+    - context: Lambda context
+    """
+    global _LAMBDA_APPENDER, _LAMBDA_CLIENT  # pylint: disable=global-statement
+    if _LAMBDA_APPENDER is None:
+        _LAMBDA_CLIENT = boto3.client("lambda")
+        chat_cache = ChatCache(boto3.client("s3"), LAMBDA_BUCKET_NAME, LAMBDA_CACHE_MAX_BYTES)
+        segments = None
+        if LAMBDA_CHAT_STORAGE == "segments":
+            # A Lambda is frozen between invocations; compact in the request
+            segments = SegmentedChatStore(
+                chat_cache,
+                LAMBDA_SMALL_SEGMENT_BYTES,
+                LAMBDA_COMPACT_MIN_SEGMENTS,
+                max_pending=0,
+                background=False,
+            )
+        _LAMBDA_APPENDER = HistoryAppender(chat_cache, segments=segments)
+    return handle_event(
+        _LAMBDA_APPENDER,
+        event,
+        retry=partial(invoke_async, _LAMBDA_CLIENT, context.function_name),
+    )
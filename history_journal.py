@@ -0,0 +1,295 @@
+'''
+Crash-safe local journal of chat history appends.
+
+Every turn handed to the write-behind buffer is first appended to a journal
+on local disk and fsynced, so a turn that was acknowledged to the client
+survives a crash or restart of the task even if it was never flushed. On
+startup the journal's records are read back and queued again.
+
+The journal is a directory of numbered segment files. Each record is a
+header (payload length and CRC-32, little-endian uint32s) followed by the
+JSON payload, so a record torn by a crash is detected and dropped on
+recovery. Concurrent appends are group-committed: a single committer thread
+writes everything queued since its last fsync and syncs it once, and every
+waiting append returns after that one fsync. Under load the cost of an
+fsync is shared by all the turns it covers.
+
+Segments roll over at segment_max_bytes. A segment is deleted once every
+record in it has been acknowledged as written by the history sink. Delivery
+is at least once: a turn written just before a crash, but not acknowledged,
+is written again after recovery.
+
+A failed write fails the appends of its commit with OSError and starts a new
+segment, since the failed one may end in a torn record that recovery stops
+at. The committer keeps running, so appends succeed again once the disk
+does.
+'''
+
+import os
+import struct
+import threading
+import time
+import zlib
+
+import json_codec
+from metrics import Histogram
+
+RECORD_HEADER = struct.Struct("<II")
+SEGMENT_SUFFIX = ".journal"
+COMMIT_RECORDS_BUCKETS = [1, 2, 4, 8, 16, 32, 64, 128]
+COMMIT_MS_BUCKETS = [0.1, 0.5, 1, 2, 5, 10, 25, 50, 100]
+
+
+def encode_record(record: dict):
+    """
+    Encodes one journal record
+    - record: dict
+    """
+    payload = json_codec.dumps(record)
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def decode_records(data: bytes):
+    """
+    Decodes the records of a segment file. Returns (records, valid_bytes);
+    decoding stops at the first truncated or corrupt record
+    - data: bytes
+    """
+    records, offset = [], 0
+    while offset + RECORD_HEADER.size <= len(data):
+        length, checksum = RECORD_HEADER.unpack_from(data, offset)
+        start = offset + RECORD_HEADER.size
+        payload = data[start : start + length]
+        if len(payload) < length or zlib.crc32(payload) != checksum:
+            break
+        records.append(json_codec.loads(payload))
+        offset = start + length
+    return records, offset
+
+
+class HistoryJournal:
+    """
+    Append-only, group-committed journal in a local directory
+    - directory: string
+    - segment_max_bytes: int, size at which a new segment is started
+    """
+
+    def __init__(self, directory: str, segment_max_bytes: int):
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._condition = threading.Condition()
+        self._queue = []
+        self._appended = 0
+        self._committed = 0
+        self._failed = {}
+        self._closed = False
+        self._outstanding = {}
+        self._segment = None
+        self._counters = {"appended": 0, "commits": 0, "failed_commits": 0, "acknowledged": 0}
+        self.commit_records = Histogram(COMMIT_RECORDS_BUCKETS)
+        self.commit_ms = Histogram(COMMIT_MS_BUCKETS)
+
+        self.recovered = self._recover()
+        self._segment = max(self._outstanding, default=0) + 1
+        self._segment_bytes = 0
+        self._outstanding[self._segment] = 0
+        self._file = None
+        self._file_segment = None
+        self._committer = threading.Thread(
+            target=self._run, name="history-journal", daemon=True
+        )
+        self._committer.start()
+
+    def append(self, record: dict):
+        """
+        Appends a record and returns once it is on disk. Returns the id of
+        the segment holding it, to acknowledge it with later
+        - record: dict
+        """
+        data = encode_record(record)
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("History journal is closed")
+            if self._segment_bytes and self._segment_bytes + len(data) > self.segment_max_bytes:
+                self._start_segment()
+            self._segment_bytes += len(data)
+            self._outstanding[self._segment] += 1
+            self._appended += 1
+            sequence = self._appended
+            # [segment, data, sequence]; the segment changes if a failed
+            # write moves the record to a new segment before it is written
+            queued = [self._segment, data, sequence]
+            self._queue.append(queued)
+            self._counters["appended"] += 1
+            self._condition.notify_all()
+            while self._committed < sequence:
+                self._condition.wait()
+            error = self._failed.pop(sequence, None)
+            if error is not None:
+                raise OSError(f"History journal write failed: {error}")
+        return queued[0]
+
+    def acknowledge(self, segment: int, count: int = 1):
+        """
+        Marks records of a segment as written to the history sink. Segments
+        other than the current one are deleted once fully acknowledged
+        - segment: int
+        - count: int
+        """
+        with self._condition:
+            self._counters["acknowledged"] += count
+            self._outstanding[segment] -= count
+            if segment == self._segment and not self._outstanding[segment]:
+                # Nothing in the current segment is needed any more; start a
+                # new one so that it can be deleted
+                self._start_segment()
+            self._remove_finished_segments()
+
+    def close(self):
+        """
+        Waits for queued records to be committed and stops the committer
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._committer.join()
+
+    def stats(self):
+        """
+        Returns append / commit counters, segment count and commit sizes
+        """
+        with self._condition:
+            return {
+                **self._counters,
+                "segments": len(self._outstanding),
+                "records_per_commit": self.commit_records.stats(),
+                "commit_ms": self.commit_ms.stats(),
+            }
+
+    def _path(self, segment: int):
+        return os.path.join(self.directory, f"{segment:012d}{SEGMENT_SUFFIX}")
+
+    def _recover(self):
+        """
+        Reads the records of the segments left by a previous process. Every
+        recovered record counts as outstanding in its segment
+        """
+        recovered = []
+        segments = sorted(
+            int(name[: -len(SEGMENT_SUFFIX)])
+            for name in os.listdir(self.directory)
+            if name.endswith(SEGMENT_SUFFIX) and name[: -len(SEGMENT_SUFFIX)].isdigit()
+        )
+        for segment in segments:
+            with open(self._path(segment), "rb") as file:
+                data = file.read()
+            records, valid_bytes = decode_records(data)
+            if valid_bytes < len(data):
+                print(
+                    f"Journal segment {segment}: dropped {len(data) - valid_bytes} "
+                    "bytes of a torn record"
+                )
+            self._outstanding[segment] = len(records)
+            recovered.extend((record, segment) for record in records)
+        self._remove_finished_segments()
+        if recovered:
+            print(f"Recovered {len(recovered)} unwritten history records")
+        return recovered
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._queue and not self._closed:
+                    self._condition.wait()
+                if not self._queue:
+                    if self._file is not None:
+                        self._file.close()
+                    return
+                batch, self._queue = self._queue, []
+                sequence = batch[-1][2]
+
+            started = time.monotonic()
+            try:
+                self._write(batch)
+            except OSError as e:
+                print(f"History journal write failed: {e}")
+                self._close_file()
+                with self._condition:
+                    self._fail(batch, e)
+                    self._committed = sequence
+                    self._condition.notify_all()
+                continue
+            self.commit_records.observe(len(batch))
+            self.commit_ms.observe((time.monotonic() - started) * 1000)
+            with self._condition:
+                self._committed = sequence
+                self._counters["commits"] += 1
+                self._remove_finished_segments()
+                self._condition.notify_all()
+
+    def _fail(self, batch: list, error: OSError):
+        """
+        Fails the appends of a commit, and moves the records queued behind it
+        out of the segments it wrote to. Called with the condition held
+        """
+        self._counters["failed_commits"] += 1
+        broken = set()
+        for segment, _, sequence in batch:
+            self._outstanding[segment] -= 1
+            self._failed[sequence] = error
+            broken.add(segment)
+        if self._segment in broken:
+            self._start_segment()
+        for queued in self._queue:
+            if queued[0] in broken:
+                self._outstanding[queued[0]] -= 1
+                self._outstanding[self._segment] += 1
+                self._segment_bytes += len(queued[1])
+                queued[0] = self._segment
+        self._remove_finished_segments()
+
+    def _start_segment(self):
+        # Called with the condition held
+        self._segment += 1
+        self._segment_bytes = 0
+        self._outstanding[self._segment] = 0
+
+    def _write(self, batch: list):
+        for segment, data, _ in batch:
+            if segment != self._file_segment:
+                if self._file is not None:
+                    self._sync()
+                    self._file.close()
+                # Kept open across commits until the segment changes
+                self._file = open(  # pylint: disable=consider-using-with
+                    self._path(segment), "ab"
+                )
+                self._file_segment = segment
+            self._file.write(data)
+        self._sync()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _close_file(self):
+        if self._file is not None:
+            try:
+                self._file.close()
+            except OSError:
+                pass
+        self._file = None
+        self._file_segment = None
+
+    def _remove_finished_segments(self):
+        for segment in [
+            segment
+            for segment, outstanding in self._outstanding.items()
+            if outstanding <= 0 and segment != self._segment
+        ]:
+            del self._outstanding[segment]
+            try:
+                os.remove(self._path(segment))
+            except FileNotFoundError:
+                pass
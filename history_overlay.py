@@ -0,0 +1,175 @@
+'''
+Read-your-writes overlay for chat history.
+
+Turns are persisted asynchronously (by the AddChatHistory Lambda or the
+write-behind buffer), so a read of a chat right after a reply can miss the
+newest turns. The overlay keeps every turn generated by this process until
+a read shows it persisted, or until it expires, and reads append the turns
+that are still missing to what S3 returned.
+
+Each turn is kept with its index in the chat, taken from the chat's turn
+count. A read that finds turn_count turns stored confirms the pending turns
+below that index and appends the others, so a turn equal to one before it
+(e.g. a reply from the generation cache) is not mistaken for it. Turns are
+compared by index only: for a chat whose turn count is behind its stored
+turns (e.g. created before the chat index), turns are confirmed right away
+and reads only show what is persisted.
+
+The turn count is updated in the background, so a turn is recorded before
+its index is known and placed once it is. Until then it comes after the
+placed turns and no read confirms it.
+'''
+
+import threading
+import time
+from collections import OrderedDict
+
+
+def split_persisted(stored_count: int, pending: list):
+    """
+    Returns how many of the pending turns are already stored
+    - stored_count: int, turns in the stored chat
+    - pending: list of (index, turn) in index order, turns whose index is
+      not known yet (None) last
+    """
+    persisted = 0
+    while (
+        persisted < len(pending)
+        and pending[persisted][0] is not None
+        and pending[persisted][0] < stored_count
+    ):
+        persisted += 1
+    return persisted
+
+
+def index_order(pending: list):
+    """
+    Sort key of a pending turn: by index, turns without one last
+    - pending: list, [index, turn, expires_at]
+    """
+    return (pending[0] is None, pending[0] or 0)
+
+
+class RecentTurnsOverlay:
+    """
+    Per-chat turns that may not be persisted yet
+    - ttl_seconds: float, how long a turn is kept if no read confirms it
+    - max_chats: int
+    """
+
+    def __init__(self, ttl_seconds: float, max_chats: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_chats = max_chats
+        self._chats = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {
+            "added": 0,
+            "confirmed": 0,
+            "expired": 0,
+            "merged": 0,
+            "unplaced": 0,
+        }
+
+    def add(self, username: str, chat_id: int, index, turn: dict):
+        """
+        Records a turn that was just generated. Returns a handle for place
+        - username: string
+        - chat_id: int
+        - index: int, the turn's position in the chat, or None until place
+          is called
+        - turn: dict
+        """
+        key = (username, int(chat_id))
+        pending = [index, turn, time.monotonic() + self.ttl_seconds]
+        with self._lock:
+            turns = self._chats.setdefault(key, [])
+            turns.append(pending)
+            # Turns of concurrent requests can be recorded out of order
+            turns.sort(key=index_order)
+            self._chats.move_to_end(key)
+            self._counters["added"] += 1
+            while len(self._chats) > self.max_chats:
+                _, turns = self._chats.popitem(last=False)
+                self._counters["expired"] += len(turns)
+        return pending
+
+    def place(self, username: str, chat_id: int, handle: list, index):
+        """
+        Sets the index of a turn recorded without one, or forgets the turn
+        when its index cannot be known
+        - username: string
+        - chat_id: int
+        - handle: list, as returned by add
+        - index: int, or None
+        """
+        key = (username, int(chat_id))
+        with self._lock:
+            turns = self._chats.get(key)
+            if turns is None or not any(pending is handle for pending in turns):
+                return
+            if index is None:
+                turns = [pending for pending in turns if pending is not handle]
+                self._counters["unplaced"] += 1
+                if turns:
+                    self._chats[key] = turns
+                else:
+                    del self._chats[key]
+                return
+            handle[0] = index
+            turns.sort(key=index_order)
+
+    def has_pending(self, username: str, chat_id: int):
+        """
+        Checks if the chat has turns that may not be persisted yet
+        - username: string
+        - chat_id: int
+        """
+        with self._lock:
+            return (username, int(chat_id)) in self._chats
+
+    def live_turns(self, username: str, chat_id: int):
+        """
+        Returns the chat's unexpired (index, turn) pairs, persisted or not,
+        without changing the overlay. What reads merge into the chat only
+        changes when these or the stored chat do
+        - username: string
+        - chat_id: int
+        """
+        now = time.monotonic()
+        with self._lock:
+            turns = self._chats.get((username, int(chat_id)), [])
+            return [(index, turn) for index, turn, expires_at in turns if expires_at > now]
+
+    def pending(self, username: str, chat_id: int, stored_count: int):
+        """
+        Returns the chat's turns that come after the stored turns,
+        forgetting the ones that are stored
+        - username: string
+        - chat_id: int
+        - stored_count: int, turns in the chat as read from S3
+        """
+        key = (username, int(chat_id))
+        now = time.monotonic()
+        with self._lock:
+            turns = self._chats.get(key)
+            if turns is None:
+                return []
+            live = [pending for pending in turns if pending[2] > now]
+            self._counters["expired"] += len(turns) - len(live)
+            persisted = split_persisted(stored_count, live)
+            self._counters["confirmed"] += persisted
+            live = live[persisted:]
+            if not live:
+                del self._chats[key]
+                return []
+            self._chats[key] = live
+            self._counters["merged"] += 1
+            return [turn for _, turn, _ in live]
+
+    def stats(self):
+        """
+        Returns the overlay counters and the number of chats with pending
+        turns
+        """
+        with self._lock:
+            return {**self._counters, "chats": len(self._chats)}
@@ -0,0 +1,238 @@
+'''
+Paging, delta sync and encoding of /get_chat_history responses.
+
+A page is chosen from the chat listing alone: the chats below
+before_chat_id, the last `limit` of them, and with `since` only the chats
+modified at or after it (or with turns that are not persisted yet). The
+page's ETag is computed from the listing too, so an unchanged page is
+answered with a 304 before any chat is fetched.
+
+Chats are then either fetched in parallel and spliced into one JSON body,
+or streamed as NDJSON through a fixed window of fetches.
+'''
+
+import hashlib
+from collections import deque
+
+from flask import current_app
+
+import json_codec
+from recent_turns import chat_version, has_recent_turns
+
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+
+def get_optional_positive_int(data: dict, field: str):
+    """
+    Reads an optional positive integer field from the request body. Returns
+    None when the field is absent and raises ValueError when it is invalid
+    - data: dict
+    - field: string
+    """
+    value = data.get(field)
+    if value is None:
+        return None
+    try:
+        value = int(value)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"{field} must be a positive integer") from e
+    if value < 1:
+        raise ValueError(f"{field} must be a positive integer")
+    return value
+
+
+def get_optional_chat_ids(data: dict, field: str):
+    """
+    Reads an optional list of chat IDs from the request body. Returns an
+    empty list when the field is absent and raises ValueError when it is
+    invalid
+    - data: dict
+    - field: string
+    """
+    value = data.get(field)
+    if value is None:
+        return []
+    if not isinstance(value, list):
+        raise ValueError(f"{field} must be a list of chat IDs")
+    try:
+        return [int(chat_id) for chat_id in value]
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"{field} must be a list of chat IDs") from e
+
+
+def epoch_millis(timestamp):
+    """
+    Converts a datetime to integer milliseconds since the epoch
+    - timestamp: datetime
+    """
+    return int(timestamp.timestamp() * 1000)
+
+
+def changed_since(username: str, chats: list, since, known_chat_ids: list):
+    """
+    Picks the chats a delta sync returns from the user's listed chats.
+    Returns (chats, sync_info), sync_info holding the watermark and
+    deleted_chat_ids response fields
+    - username: string
+    - chats: list of ChatObject, sorted by chat_id
+    - since: int or None, milliseconds since the epoch; every chat is
+      returned without it
+    - known_chat_ids: list of int
+    """
+    # The watermark is the newest modification time the client has seen.
+    # S3 times are coarse, so chats modified exactly at `since` are resent
+    existing_chat_ids = {chat.chat_id for chat in chats}
+    sync_info = {
+        "watermark": max(
+            (epoch_millis(chat.last_modified) for chat in chats), default=since
+        ),
+        "deleted_chat_ids": sorted(set(known_chat_ids) - existing_chat_ids),
+    }
+    if since is not None:
+        # Chats with turns that are not persisted yet have changed too
+        chats = [
+            chat
+            for chat in chats
+            if epoch_millis(chat.last_modified) >= since
+            or has_recent_turns(username, chat.chat_id)
+        ]
+    return chats, sync_info
+
+
+def page_of(chats: list, limit, before_chat_id):
+    """
+    Returns (chats, next_cursor): the last `limit` chats below
+    before_chat_id, oldest to newest, and the before_chat_id of the next
+    (older) page, or None when there are no older chats
+    - chats: list of ChatObject, sorted by chat_id
+    - limit: int or None
+    - before_chat_id: int or None
+    """
+    if before_chat_id is not None:
+        chats = [chat for chat in chats if chat.chat_id < before_chat_id]
+    next_cursor = None
+    if limit is not None and len(chats) > limit:
+        chats = chats[-limit:]
+        next_cursor = chats[0].chat_id
+    return chats, next_cursor
+
+
+def chat_history_etag(username: str, chats: list, page_info: dict):
+    """
+    Computes a strong ETag for a /get_chat_history response from the
+    listing, before any chat is fetched. Any change to a chat, to its turns
+    that are not persisted yet or to the page contents changes the tag
+    - username: string
+    - chats: list of ChatObject
+    - page_info: dict of the non-chat response fields
+    """
+    digest = hashlib.sha256(f"{username}\n".encode("utf-8"))
+    digest.update(json_codec.dumps(page_info))
+    for chat in chats:
+        digest.update(f"\n{chat.chat_id}:{chat_version(username, chat)}".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def not_modified_response(etag: str):
+    """
+    Builds the empty 304 answered to a client that already has the page
+    - etag: string
+    """
+    response = current_app.response_class(status=304)
+    response.set_etag(etag)
+    return response
+
+
+def fetch_chats(fetch, executor, chats: list):
+    """
+    Fans the chat fetches out over the executor and returns the fetched
+    entries in chat order as (chat_id, CachedChat) tuples, leaving out chats
+    that no longer exist
+    - fetch: callable, takes a ChatObject and returns a CachedChat or None
+    - executor: concurrent.futures.Executor
+    - chats: list of ChatObject
+    """
+    futures = [executor.submit(fetch, chat) for chat in chats]
+    fetched = []
+    for chat, future in zip(chats, futures):
+        entry = future.result()
+        if entry is not None:
+            fetched.append((chat.chat_id, entry))
+    return fetched
+
+
+def chat_history_response(chats: list, page_info: dict, etag: str):
+    """
+    Builds the /get_chat_history response from cached chat entries, splicing
+    in each chat's stored JSON encoding instead of re-serializing it
+    - chats: list of (chat_id, CachedChat) tuples
+    - page_info: dict of the non-chat response fields
+    - etag: string
+    """
+    chat_history = b",".join(
+        b'{"%d":%s}' % (chat_id, entry.encoded) for chat_id, entry in chats
+    )
+    fields = b",".join(
+        b"%s:%s" % (json_codec.dumps(name), json_codec.dumps(value))
+        for name, value in page_info.items()
+    )
+    body = b'{"status_code":200,"chat_history":[%s],%s}' % (chat_history, fields)
+    response = current_app.response_class(body, mimetype="application/json")
+    response.set_etag(etag)
+    return response
+
+
+def stream_chat_history(fetch, executor, window: int, chats: list, page_info: dict):
+    """
+    Yields the chat history as NDJSON: one {chat_id: chat} line per chat in
+    chat order, followed by a trailer line holding status_code and the
+    page_info fields. Fetches run ahead through a fixed window so memory
+    stays constant no matter how many chats are streamed. The 200 status is
+    sent before the first chat is read, so a read that fails partway ends
+    the stream with a {"status_code": 500, "error": message} line instead
+    of the trailer
+    - fetch: callable, takes a ChatObject and returns a CachedChat or None
+    - executor: concurrent.futures.Executor
+    - window: int, fetches in flight at most
+    - chats: list of ChatObject
+    - page_info: dict of the non-chat response fields
+    """
+    remaining = iter(chats)
+    in_flight = deque()
+
+    def fetch_next():
+        chat = next(remaining, None)
+        if chat is not None:
+            in_flight.append((chat.chat_id, executor.submit(fetch, chat)))
+
+    try:
+        for _ in range(window):
+            fetch_next()
+        while in_flight:
+            chat_id, future = in_flight.popleft()
+            try:
+                entry = future.result()
+            except Exception as e:  # pylint: disable=broad-except
+                print(f"Chat history stream failed at chat {chat_id}: {e}")
+                yield json_codec.dumps(
+                    {"status_code": 500, "error": "Error reading the chat history"}
+                ) + b"\n"
+                return
+            fetch_next()
+            if entry is not None:
+                yield b'{"%d":%s}\n' % (chat_id, entry.encoded)
+        yield json_codec.dumps({"status_code": 200, **page_info}) + b"\n"
+    finally:
+        # The client went away mid-stream; drop fetches that have not started
+        for _, future in in_flight:
+            future.cancel()
+
+
+def stream_response(fetch, executor, window: int, chats: list, page_info: dict):
+    """
+    Builds the NDJSON /get_chat_history response (see stream_chat_history)
+    """
+    return current_app.response_class(
+        stream_chat_history(fetch, executor, window, chats, page_info),
+        mimetype=NDJSON_MIMETYPE,
+    )
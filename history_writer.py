@@ -0,0 +1,291 @@
+'''
+Write-behind buffering of chat history appends.
+
+Turns are queued in memory when a reply is generated, instead of invoking
+the AddChatHistory Lambda on the request path. A background thread flushes
+the queue when it holds max_batch_entries turns or when the oldest queued
+turn has waited flush_interval_seconds. Turns of the same chat are
+coalesced, so each flush writes every chat once, whatever the number of
+turns it received. There is a single flusher, and a chat whose write fails
+is retried ahead of newer turns.
+
+Flushes go to a sink:
+- LambdaHistorySink invokes AddChatHistory asynchronously, once per flush
+  with every chat in it, or once per turn in the Lambda's original payload
+  format. The writes of a chat are sent in order, but Lambda may run
+  asynchronous invocations concurrently, so they can be applied out of order
+- history_append.HistoryAppender appends to the chat files directly with
+  conditional writes, so the writes of a chat are applied in order
+
+With a HistoryJournal, every turn is journaled to local disk before append
+returns, and journaled turns left over by a previous process are queued
+again on startup (see history_journal). A turn the journal fails to write is
+still queued, without the journal, and counted as unjournaled.
+'''
+
+import threading
+import time
+from collections import OrderedDict
+
+from botocore.exceptions import ClientError
+
+import json_codec
+from metrics import Histogram
+
+BATCH_SIZE_BUCKETS = [1, 2, 4, 8, 16, 32, 64, 128, 256]
+RETRY_DELAY_SECONDS = 1
+# Flush attempts made for the remaining turns when the buffer is closed
+DRAIN_ATTEMPTS = 3
+
+
+class LambdaHistorySink:
+    """
+    Writes turns through the AddChatHistory Lambda with Event invocations
+    - lambda_client: boto3 Lambda client
+    - function_name: string
+    - batched: bool, send one invocation per flush with
+      {"chats": [{"username", "chat_id", "model_history_entries"}]}; when
+      False, one invocation per turn with {"username", "chat_id",
+      "model_history_entry"}
+    """
+
+    def __init__(self, lambda_client, function_name: str, batched: bool = True):
+        self.lambda_client = lambda_client
+        self.function_name = function_name
+        self.batched = batched
+
+    def write(self, chats: OrderedDict):
+        """
+        Writes the queued turns. Returns the keys of the chats that were
+        written
+        - chats: OrderedDict of (username, chat_id) to list of turns
+        """
+        if self.batched:
+            self._invoke(
+                {
+                    "chats": [
+                        {
+                            "username": username,
+                            "chat_id": chat_id,
+                            "model_history_entries": entries,
+                        }
+                        for (username, chat_id), entries in chats.items()
+                    ]
+                }
+            )
+            return list(chats)
+
+        written = []
+        for (username, chat_id), entries in chats.items():
+            sent = 0
+            try:
+                for entry in entries:
+                    self._invoke(
+                        {
+                            "username": username,
+                            "chat_id": chat_id,
+                            "model_history_entry": entry,
+                        }
+                    )
+                    sent += 1
+            except ClientError as e:
+                print(f"Failed to write history of {username}/{chat_id}: {e}")
+                # Keep the turns that were not sent for the retry
+                del entries[:sent]
+                continue
+            written.append((username, chat_id))
+        return written
+
+    def _invoke(self, payload: dict):
+        self.lambda_client.invoke(
+            FunctionName=self.function_name,
+            InvocationType="Event",
+            Payload=json_codec.dumps(payload),
+        )
+
+
+class WriteBehindBuffer:
+    """
+    Queues chat history appends and flushes them to a sink in the background
+    - sink: LambdaHistorySink or HistoryAppender
+    - max_batch_entries: int, queued turns that trigger a flush
+    - flush_interval_seconds: float, longest time a turn waits to be flushed
+    - journal: HistoryJournal (optional), makes queued turns survive restarts
+    """
+
+    def __init__(
+        self,
+        sink,
+        max_batch_entries: int,
+        flush_interval_seconds: float,
+        journal=None,
+    ):
+        self.sink = sink
+        self.max_batch_entries = max_batch_entries
+        self.flush_interval_seconds = flush_interval_seconds
+        self._pending = OrderedDict()
+        self._pending_entries = 0
+        self._oldest = None
+        self._closed = False
+        self._condition = threading.Condition()
+        self._flusher = None
+        self._counters = {
+            "appended": 0,
+            "unjournaled": 0,
+            "written": 0,
+            "flushes": 0,
+            "failed_flushes": 0,
+        }
+        self.flush_chats = Histogram(BATCH_SIZE_BUCKETS)
+        self.flush_entries = Histogram(BATCH_SIZE_BUCKETS)
+        self.journal = journal
+        if journal is not None:
+            with self._condition:
+                for record, segment in journal.recovered:
+                    key = (record["username"], record["chat_id"])
+                    self._enqueue(key, record["model_history_entry"], segment)
+
+    def append(self, username: str, chat_id: int, entry: dict):
+        """
+        Queues one turn. Only blocks to journal it, if there is a journal
+        - username: string
+        - chat_id: int
+        - entry: dict, the model_history_entry
+        """
+        segment, unjournaled = None, False
+        if self.journal is not None:
+            try:
+                segment = self.journal.append(
+                    {"username": username, "chat_id": chat_id, "model_history_entry": entry}
+                )
+            except OSError as e:
+                # Losing the turn on a crash beats failing the request
+                print(
+                    f"WARNING: history journal unavailable, turn of {username}/{chat_id} "
+                    f"is queued without it and lost if the task stops: {e}"
+                )
+                unjournaled = True
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("History buffer is closed")
+            if unjournaled:
+                self._counters["unjournaled"] += 1
+            self._enqueue((username, chat_id), entry, segment)
+
+    def close(self, timeout: float = 30):
+        """
+        Stops accepting turns and waits until the queued ones are flushed
+        - timeout: float, in seconds
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+            flusher = self._flusher
+        if flusher is not None:
+            flusher.join(timeout)
+        with self._condition:
+            if self._pending_entries:
+                print(f"History buffer closed with {self._pending_entries} turns unwritten")
+        if self.journal is not None:
+            self.journal.close()
+
+    def stats(self):
+        """
+        Returns append / write counters, queued turns and flush sizes
+        """
+        with self._condition:
+            return {
+                **self._counters,
+                "queued": self._pending_entries,
+                "flush_chats": self.flush_chats.stats(),
+                "flush_entries": self.flush_entries.stats(),
+            }
+
+    def _enqueue(self, key: tuple, entry: dict, segment):
+        # Called with the condition held
+        if self._flusher is None:
+            self._flusher = threading.Thread(
+                target=self._run, name="history-writer", daemon=True
+            )
+            self._flusher.start()
+        self._pending.setdefault(key, []).append((entry, segment))
+        self._pending_entries += 1
+        self._counters["appended"] += 1
+        if self._oldest is None:
+            # The flusher may be idle without a timeout; start its interval
+            self._oldest = time.monotonic()
+            self._condition.notify()
+        elif self._pending_entries >= self.max_batch_entries:
+            self._condition.notify()
+
+    def _run(self):
+        drain_failures = 0
+        while True:
+            with self._condition:
+                while not self._closed and not self._due():
+                    timeout = None
+                    if self._oldest is not None:
+                        timeout = self._oldest + self.flush_interval_seconds - time.monotonic()
+                    self._condition.wait(timeout)
+                if self._closed and not self._pending:
+                    return
+                batch, self._pending = self._pending, OrderedDict()
+                entries = self._pending_entries
+                self._pending_entries = 0
+                self._oldest = None
+
+            if self._flush(batch, entries):
+                continue
+            if self._closed:
+                drain_failures += 1
+                if drain_failures >= DRAIN_ATTEMPTS:
+                    return
+            time.sleep(RETRY_DELAY_SECONDS)
+
+    def _due(self):
+        if self._pending_entries >= self.max_batch_entries:
+            return True
+        return (
+            self._oldest is not None
+            and time.monotonic() - self._oldest >= self.flush_interval_seconds
+        )
+
+    def _flush(self, batch: OrderedDict, entries: int):
+        self.flush_chats.observe(len(batch))
+        self.flush_entries.observe(entries)
+        turns = OrderedDict(
+            (key, [entry for entry, _ in queued]) for key, queued in batch.items()
+        )
+        try:
+            written = set(self.sink.write(turns))
+        except Exception as e:  # pylint: disable=broad-except
+            print(f"Failed to flush chat history: {e}")
+            written = set()
+
+        # Sinks drop the turns they did write from the lists of failed chats
+        failed, acknowledged = [], {}
+        for key, queued in batch.items():
+            unwritten = 0 if key in written else len(turns[key])
+            for _, segment in queued[: len(queued) - unwritten]:
+                acknowledged[segment] = acknowledged.get(segment, 0) + 1
+            if unwritten:
+                failed.append((key, queued[len(queued) - unwritten :]))
+        if self.journal is not None:
+            for segment, count in acknowledged.items():
+                if segment is not None:
+                    self.journal.acknowledge(segment, count)
+
+        with self._condition:
+            self._counters["flushes"] += 1
+            self._counters["written"] += sum(acknowledged.values())
+            if not failed:
+                return True
+            self._counters["failed_flushes"] += 1
+            # Failed turns go back ahead of the turns queued since, per chat
+            for key, queued in reversed(failed):
+                self._pending[key] = queued + self._pending.get(key, [])
+                self._pending.move_to_end(key, last=False)
+                self._pending_entries += len(queued)
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            return False
@@ -0,0 +1,45 @@
+'''
+JSON codec shared by request parsing, S3 and SageMaker I/O and responses.
+
+orjson is used when it is installed and the standard library json module
+otherwise; set JSON_CODEC=json to force the standard library. Both codecs
+encode straight to UTF-8 bytes and decode straight from bytes, so callers
+never need an extra .decode("utf-8") / .encode("utf-8") copy.
+'''
+
+import json
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _json_dumps(obj, default=None) -> bytes:
+    return json.dumps(
+        obj, ensure_ascii=False, separators=(",", ":"), default=default
+    ).encode("utf-8")
+
+
+CODECS = {"json": (_json_dumps, json.loads)}
+
+if orjson is not None:
+    # orjson is a compiled extension that pylint cannot inspect
+    # pylint: disable=no-member
+
+    def _orjson_dumps(obj, default=None) -> bytes:
+        # Chat history responses are keyed by integer chat IDs
+        return orjson.dumps(obj, default=default, option=orjson.OPT_NON_STR_KEYS)
+
+    CODECS["orjson"] = (_orjson_dumps, orjson.loads)
+    # pylint: enable=no-member
+
+CODEC_NAME = os.environ.get("JSON_CODEC", "orjson" if orjson else "json")
+if CODEC_NAME not in CODECS:
+    raise ValueError(
+        f"JSON_CODEC must be one of {sorted(CODECS)}, got {CODEC_NAME!r}"
+    )
+
+# dumps(obj, default=None) -> bytes and loads(bytes or str) -> object
+dumps, loads = CODECS[CODEC_NAME]
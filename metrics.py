@@ -0,0 +1,72 @@
+'''
+Lightweight in-process metrics reported by the /metrics route.
+'''
+
+import bisect
+import threading
+
+
+class Histogram:
+    """
+    Thread-safe fixed-bucket histogram. Percentiles are approximated by the
+    upper bound of the bucket they fall in, or by the largest observation
+    when they fall past the last bucket
+    - buckets: list of float, increasing bucket upper bounds
+    """
+
+    def __init__(self, buckets):
+        self.buckets = sorted(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._count = 0
+        self._sum = 0.0
+        self._max = None
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        """
+        Records one observation
+        - value: float
+        """
+        with self._lock:
+            self._counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._count += 1
+            self._sum += value
+            if self._max is None or value > self._max:
+                self._max = value
+
+    def percentile(self, fraction: float):
+        """
+        Returns the approximate value below which the given fraction of the
+        observations fall, or None if nothing was observed
+        - fraction: float, between 0 and 1
+        """
+        with self._lock:
+            return self._percentile(fraction)
+
+    def stats(self):
+        """
+        Returns count, sum, mean, max, p50 / p90 / p99 and the bucket counts
+        """
+        with self._lock:
+            labels = [f"le_{bound:g}" for bound in self.buckets] + ["le_inf"]
+            return {
+                "count": self._count,
+                "sum": self._sum,
+                "mean": self._sum / self._count if self._count else None,
+                "max": self._max,
+                "p50": self._percentile(0.5),
+                "p90": self._percentile(0.9),
+                "p99": self._percentile(0.99),
+                "buckets": dict(zip(labels, self._counts)),
+            }
+
+    def _percentile(self, fraction: float):
+        if not self._count:
+            return None
+        rank = fraction * self._count
+        seen = 0
+        for index, count in enumerate(self._counts):
+            seen += count
+            if count and seen >= rank:
+                return self.buckets[index] if index < len(self.buckets) else self._max
+        return self._max
@@ -0,0 +1,146 @@
+'''
+Dynamic micro-batching of generation requests to the inference endpoint.
+
+Prompts that arrive within max_wait_ms of each other with the same
+generation parameters are sent to the endpoint as one request with a list
+of inputs, which the Hugging Face inference container answers with one
+result per input. Results are then handed back to each waiting request.
+'''
+
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import json_codec
+from metrics import Histogram
+
+BATCH_SIZE_BUCKETS = [1, 2, 4, 8, 16, 32, 64]
+QUEUE_WAIT_MS_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 250, 1000]
+
+
+def parse_batch_response(model_response, batch_size: int):
+    """
+    Returns the generated text for each input of a batched request. The
+    container answers with either one list of candidates or one candidate
+    per input
+    - model_response: the decoded endpoint response
+    - batch_size: int, the number of inputs sent
+    """
+    if not isinstance(model_response, list) or len(model_response) != batch_size:
+        raise ValueError(
+            f"Expected {batch_size} results from a batched request, "
+            f"got {model_response!r:.200}"
+        )
+    return [
+        (result[0] if isinstance(result, list) else result)["generated_text"]
+        for result in model_response
+    ]
+
+
+class MicroBatcher:
+    """
+    Collects concurrent generation requests into batched endpoint calls
+    - send_batch: callable(inputs: list, parameters: dict) returning the list
+      of generated texts, one per input
+    - max_batch_size: int
+    - max_wait_ms: float, how long the oldest queued prompt may wait for
+      others to join its batch
+    - max_concurrent_batches: int, batches that may be in flight at once
+    """
+
+    def __init__(
+        self,
+        send_batch,
+        max_batch_size: int,
+        max_wait_ms: float,
+        max_concurrent_batches: int = 4,
+    ):
+        self.send_batch = send_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = deque()
+        self._condition = threading.Condition()
+        self._dispatcher = ThreadPoolExecutor(
+            max_workers=max_concurrent_batches, thread_name_prefix="batch"
+        )
+        self._collector = None
+        self.batch_sizes = Histogram(BATCH_SIZE_BUCKETS)
+        self.queue_wait_ms = Histogram(QUEUE_WAIT_MS_BUCKETS)
+
+    def submit(self, inputs: str, parameters: dict):
+        """
+        Queues one prompt and blocks until its batch has been answered.
+        Returns the generated text
+        - inputs: string
+        - parameters: dict, generation parameters
+        """
+        future = Future()
+        # Only prompts with identical parameters can share a request
+        group = json_codec.dumps(parameters)
+        with self._condition:
+            if self._collector is None:
+                self._collector = threading.Thread(
+                    target=self._collect, name="batch-collector", daemon=True
+                )
+                self._collector.start()
+            self._queue.append((group, inputs, parameters, future, time.monotonic()))
+            self._condition.notify()
+        return future.result()
+
+    def stats(self):
+        """
+        Returns batch size and queue wait distributions
+        """
+        with self._condition:
+            queued = len(self._queue)
+        return {
+            "queued": queued,
+            "batch_size": self.batch_sizes.stats(),
+            "queue_wait_ms": self.queue_wait_ms.stats(),
+        }
+
+    def _collect(self):
+        while True:
+            with self._condition:
+                while not self._queue:
+                    self._condition.wait()
+                group = self._queue[0][0]
+                deadline = self._queue[0][4] + self.max_wait
+                # Wait for the batch to fill up or for the oldest prompt's
+                # deadline, whichever comes first
+                while (
+                    self._group_size(group) < self.max_batch_size
+                    and time.monotonic() < deadline
+                ):
+                    self._condition.wait(deadline - time.monotonic())
+                batch = self._take_batch(group)
+            self._dispatcher.submit(self._send, batch)
+
+    def _group_size(self, group: bytes):
+        return sum(1 for item in self._queue if item[0] == group)
+
+    def _take_batch(self, group: bytes):
+        batch, remaining = [], deque()
+        for item in self._queue:
+            if item[0] == group and len(batch) < self.max_batch_size:
+                batch.append(item)
+            else:
+                remaining.append(item)
+        self._queue = remaining
+        return batch
+
+    def _send(self, batch: list):
+        now = time.monotonic()
+        self.batch_sizes.observe(len(batch))
+        for item in batch:
+            self.queue_wait_ms.observe((now - item[4]) * 1000)
+
+        try:
+            results = self.send_batch([item[1] for item in batch], batch[0][2])
+        except Exception as e:  # pylint: disable=broad-except
+            for item in batch:
+                item[3].set_exception(e)
+            return
+        for item, result in zip(batch, results):
+            item[3].set_result(result)
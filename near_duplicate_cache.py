@@ -0,0 +1,225 @@
+'''
+Approximate-match cache for paraphrased prompts, using MinHash signatures
+over character shingles and locality-sensitive hashing (LSH).
+
+Each prompt is reduced to a fixed-size MinHash signature whose agreement
+with another prompt's signature estimates the Jaccard similarity of their
+character shingle sets. Signatures are split into bands; prompts that share
+any band land in the same bucket and become candidates, so a lookup only
+compares against a handful of entries. A cached reply is reused when the
+best candidate's estimated similarity reaches the configured threshold.
+
+Signatures are computed with numpy when it is installed (one vectorized
+pass over all hash functions) and in pure Python otherwise.
+'''
+
+import random
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Optional
+
+from generation_cache import normalize_prompt
+from metrics import Histogram
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Hash functions are (a * x + b) mod a Mersenne prime small enough that the
+# product of two residues fits in 64 bits
+MERSENNE_PRIME = (1 << 31) - 1
+SIMILARITY_BUCKETS = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.95, 1.0]
+
+
+def shingle_hashes(text: str, shingle_size: int):
+    """
+    Returns the sorted 32-bit hashes of the character shingles of the
+    normalized text
+    - text: string
+    - shingle_size: int
+    """
+    text = normalize_prompt(text)
+    if len(text) <= shingle_size:
+        shingles = {text}
+    else:
+        shingles = {
+            text[i : i + shingle_size] for i in range(len(text) - shingle_size + 1)
+        }
+    return sorted(zlib.crc32(shingle.encode("utf-8")) for shingle in shingles)
+
+
+class MinHasher:
+    """
+    Computes MinHash signatures with a fixed family of hash functions
+    - num_perm: int, signature length
+    - shingle_size: int
+    - seed: int
+    """
+
+    def __init__(self, num_perm: int, shingle_size: int, seed: int = 1):
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        rng = random.Random(seed)
+        self.coefficients = [
+            (rng.randrange(1, MERSENNE_PRIME), rng.randrange(0, MERSENNE_PRIME))
+            for _ in range(num_perm)
+        ]
+        if numpy is not None:
+            self._a = numpy.array([[a] for a, _ in self.coefficients], dtype=numpy.uint64)
+            self._b = numpy.array([[b] for _, b in self.coefficients], dtype=numpy.uint64)
+
+    def signature(self, text: str):
+        """
+        Returns the MinHash signature of text as a tuple of ints
+        - text: string
+        """
+        hashes = shingle_hashes(text, self.shingle_size)
+        if numpy is not None:
+            values = numpy.array(hashes, dtype=numpy.uint64) % MERSENNE_PRIME
+            # (num_perm, 1) x (num_shingles,) -> (num_perm, num_shingles)
+            permuted = (self._a * values + self._b) % MERSENNE_PRIME
+            return tuple(permuted.min(axis=1).tolist())
+
+        values = [value % MERSENNE_PRIME for value in hashes]
+        return tuple(
+            min((a * value + b) % MERSENNE_PRIME for value in values)
+            for a, b in self.coefficients
+        )
+
+
+def estimate_similarity(first: tuple, second: tuple):
+    """
+    Estimates the Jaccard similarity of two prompts from their signatures
+    - first: tuple
+    - second: tuple
+    """
+    return sum(1 for x, y in zip(first, second) if x == y) / len(first)
+
+
+class NearDuplicateCache:
+    """
+    LSH index of MinHash signatures mapping prompts to cached replies
+    - threshold: float, minimum estimated similarity for a hit
+    - max_entries: int
+    - ttl_seconds: float
+    - num_perm: int, signature length; must be a multiple of bands
+    - bands: int, LSH bands; more bands find less similar candidates
+    - shingle_size: int
+    """
+
+    def __init__(
+        self,
+        threshold: float,
+        max_entries: int,
+        ttl_seconds: float,
+        num_perm: int = 64,
+        bands: int = 16,
+        shingle_size: int = 4,
+    ):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.hasher = MinHasher(num_perm, shingle_size)
+        self._entries = OrderedDict()
+        self._buckets = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self._counters = {"lookups": 0, "hits": 0, "evictions": 0, "expired": 0}
+        self.best_similarity = Histogram(SIMILARITY_BUCKETS)
+        self.hit_similarity = Histogram(SIMILARITY_BUCKETS)
+
+    def get(self, prompt: str, group) -> Optional[str]:
+        """
+        Returns the cached reply of the most similar prompt in the same
+        group, or None if none reaches the threshold
+        - prompt: string
+        - group: hashable, e.g. the encoded generation parameters; only
+          prompts of the same group are compared
+        """
+        signature = self.hasher.signature(prompt)
+        now = time.time()
+        with self._lock:
+            self._counters["lookups"] += 1
+            best_id, best = None, 0.0
+            for entry_id in self._candidates(signature, group):
+                entry_signature, _, expires_at, _ = self._entries[entry_id]
+                if expires_at <= now:
+                    self._remove(entry_id)
+                    self._counters["expired"] += 1
+                    continue
+                similarity = estimate_similarity(signature, entry_signature)
+                if similarity > best:
+                    best_id, best = entry_id, similarity
+
+            self.best_similarity.observe(best)
+            if best_id is None or best < self.threshold:
+                return None
+            self._counters["hits"] += 1
+            self.hit_similarity.observe(best)
+            self._entries.move_to_end(best_id)
+            return self._entries[best_id][1]
+
+    def put(self, prompt: str, group, reply: str):
+        """
+        Indexes a prompt and its reply
+        - prompt: string
+        - group: hashable
+        - reply: string
+        """
+        signature = self.hasher.signature(prompt)
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            expires_at = time.time() + self.ttl_seconds
+            self._entries[entry_id] = (signature, reply, expires_at, group)
+            for band_key in self._band_keys(signature, group):
+                self._buckets.setdefault(band_key, set()).add(entry_id)
+            while len(self._entries) > self.max_entries:
+                self._evict_oldest()
+
+    def stats(self):
+        """
+        Returns hit rate and the similarity distributions of the best
+        candidate per lookup and of the hits
+        """
+        with self._lock:
+            lookups = self._counters["lookups"]
+            return {
+                **self._counters,
+                "hit_rate": self._counters["hits"] / lookups if lookups else None,
+                "entries": len(self._entries),
+                "threshold": self.threshold,
+                "best_similarity": self.best_similarity.stats(),
+                "hit_similarity": self.hit_similarity.stats(),
+            }
+
+    def _band_keys(self, signature: tuple, group):
+        for band in range(self.bands):
+            rows = signature[band * self.rows : (band + 1) * self.rows]
+            yield (group, band, rows)
+
+    def _candidates(self, signature: tuple, group):
+        candidates = set()
+        for band_key in self._band_keys(signature, group):
+            candidates.update(self._buckets.get(band_key, ()))
+        return candidates
+
+    def _evict_oldest(self):
+        self._remove(next(iter(self._entries)))
+        self._counters["evictions"] += 1
+
+    def _remove(self, entry_id: int):
+        signature, _, _, group = self._entries.pop(entry_id)
+        for band_key in self._band_keys(signature, group):
+            bucket = self._buckets.get(band_key)
+            if bucket is not None:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del self._buckets[band_key]
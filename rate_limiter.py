@@ -0,0 +1,299 @@
+'''
+Per-user rate limiting and fair sharing of the inference endpoint.
+
+RateLimiter gives every user a token bucket: requests take one token, tokens
+refill at a fixed rate up to a burst size, and a request that finds the
+bucket empty is rejected with the time until the next token. Bucket state
+lives in a pluggable store, in process memory by default or in a DynamoDB
+table shared by every task of a deployment.
+
+FairScheduler bounds the number of concurrent model calls and, once they
+are all taken, hands freed slots to waiting users in round-robin order, so
+one user with many requests in flight cannot starve the others. A request
+that waits longer than max_wait_seconds for a slot gives up with
+QueueTimeout.
+'''
+
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from decimal import Decimal
+
+from boto3.dynamodb.conditions import Attr
+from botocore.exceptions import ClientError
+
+from metrics import Histogram
+
+QUEUE_WAIT_MS_BUCKETS = [1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+# In-memory buckets are pruned of idle (full) entries every this many takes
+PRUNE_INTERVAL = 1000
+# Retry-After suggested to requests that timed out waiting for a slot
+QUEUE_TIMEOUT_RETRY_AFTER_SECONDS = 1
+
+
+class RateLimited(Exception):
+    """
+    Raised when a request is turned away and should be retried later
+    - retry_after: float, seconds until the next request is allowed
+    - reason: string, "rate" when the user is over their request rate
+    """
+
+    status_code = 429
+
+    def __init__(self, message: str, retry_after: float, reason: str = "rate"):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class QueueTimeout(RateLimited):
+    """
+    Raised when a request waited too long for an inference slot. The server
+    is busy rather than the user over their rate, hence the 503
+    - retry_after: float, seconds after which to try again
+    """
+
+    status_code = 503
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message, retry_after, reason="queue_timeout")
+
+
+class InMemoryTokenBuckets:
+    """
+    Token buckets held in process memory
+    """
+
+    def __init__(self):
+        self._buckets = {}
+        self._takes = 0
+        self._lock = threading.Lock()
+
+    def take(self, key: str, rate: float, burst: float):
+        """
+        Takes one token from the bucket. Returns (allowed, retry_after)
+        - key: string
+        - rate: float, tokens added per second
+        - burst: float, bucket capacity
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._takes += 1
+            if self._takes % PRUNE_INTERVAL == 0:
+                self._prune(now, rate, burst)
+            tokens, updated_at = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated_at) * rate)
+            if tokens < 1:
+                self._buckets[key] = (tokens, now)
+                return False, (1 - tokens) / rate
+            self._buckets[key] = (tokens - 1, now)
+            return True, 0.0
+
+    def _prune(self, now: float, rate: float, burst: float):
+        self._buckets = {
+            key: (tokens, updated_at)
+            for key, (tokens, updated_at) in self._buckets.items()
+            if tokens + (now - updated_at) * rate < burst
+        }
+
+
+class DynamoDBTokenBuckets:
+    """
+    Token buckets shared between tasks through a DynamoDB table with partition
+    key bucket_key (string). Updates are conditional on the bucket not having
+    changed since it was read, and retried when it has. Items carry an
+    expires_at attribute for DynamoDB TTL
+    - table: boto3 DynamoDB Table
+    - max_attempts: int
+    """
+
+    def __init__(self, table, max_attempts: int = 3):
+        self.table = table
+        self.max_attempts = max_attempts
+
+    def take(self, key: str, rate: float, burst: float):
+        """
+        Takes one token from the bucket. Returns (allowed, retry_after)
+        - key: string
+        - rate: float, tokens added per second
+        - burst: float, bucket capacity
+        """
+        for _ in range(self.max_attempts):
+            now = time.time()
+            item = self.table.get_item(
+                Key={"bucket_key": key}, ConsistentRead=True
+            ).get("Item")
+            if item is None:
+                tokens = burst
+                condition = Attr("bucket_key").not_exists()
+            else:
+                elapsed = max(0.0, now - float(item["updated_at"]))
+                tokens = min(burst, float(item["tokens"]) + elapsed * rate)
+                condition = Attr("updated_at").eq(item["updated_at"])
+            if tokens < 1:
+                return False, (1 - tokens) / rate
+
+            try:
+                self.table.put_item(
+                    Item={
+                        "bucket_key": key,
+                        "tokens": Decimal(repr(tokens - 1)),
+                        "updated_at": Decimal(repr(now)),
+                        "expires_at": int(now + burst / rate) + 60,
+                    },
+                    ConditionExpression=condition,
+                )
+                return True, 0.0
+            except ClientError as e:
+                if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                    raise
+        # Lost every race for this bucket: it is being drained concurrently
+        return False, 1 / rate
+
+
+class RateLimiter:
+    """
+    Per-key token-bucket rate limiter. When the store fails, requests are
+    allowed rather than rejected
+    - store: InMemoryTokenBuckets or DynamoDBTokenBuckets
+    - requests_per_minute: float
+    - burst: int, requests allowed at once after a quiet period
+    """
+
+    def __init__(self, store, requests_per_minute: float, burst: int):
+        self.store = store
+        self.rate = requests_per_minute / 60
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._counters = {"allowed": 0, "limited": 0, "store_errors": 0}
+
+    def check(self, key: str):
+        """
+        Takes one request from key's bucket, raising RateLimited if it is
+        empty
+        - key: string, e.g. the username
+        """
+        try:
+            allowed, retry_after = self.store.take(key, self.rate, self.burst)
+        except ClientError as e:
+            print(f"Rate limit store failed for {key}: {e}")
+            self._count("store_errors")
+            allowed, retry_after = True, 0.0
+
+        self._count("allowed" if allowed else "limited")
+        if not allowed:
+            raise RateLimited("Too many requests", retry_after)
+
+    def stats(self):
+        """
+        Returns the limit and the allowed / limited counters
+        """
+        with self._lock:
+            return {
+                **self._counters,
+                "requests_per_minute": self.rate * 60,
+                "burst": self.burst,
+                "store": type(self.store).__name__,
+            }
+
+    def _count(self, counter: str):
+        with self._lock:
+            self._counters[counter] += 1
+
+
+class FairScheduler:
+    """
+    Bounds concurrent model calls and grants freed slots to waiting keys in
+    round-robin order
+    - max_concurrent: int
+    - max_wait_seconds: float (optional), longest wait for a slot; waits are
+      unbounded without it
+    """
+
+    def __init__(self, max_concurrent: int, max_wait_seconds: float = None):
+        self.max_concurrent = max_concurrent
+        self.max_wait_seconds = max_wait_seconds
+        self._active = 0
+        self._timeouts = 0
+        # key -> deque of waiting requests, in round-robin order
+        self._waiting = OrderedDict()
+        self._lock = threading.Lock()
+        self.queue_wait_ms = Histogram(QUEUE_WAIT_MS_BUCKETS)
+
+    def acquire(self, key):
+        """
+        Blocks until a slot is granted to key. Raises QueueTimeout if none is
+        within max_wait_seconds
+        - key: hashable, e.g. the username
+        """
+        started = time.monotonic()
+        with self._lock:
+            if self._active < self.max_concurrent and not self._waiting:
+                self._active += 1
+                ticket = None
+            else:
+                ticket = threading.Event()
+                self._waiting.setdefault(key, deque()).append(ticket)
+        if ticket is not None and not ticket.wait(self.max_wait_seconds):
+            with self._lock:
+                # The slot may have been granted since the wait timed out
+                if not ticket.is_set():
+                    tickets = self._waiting[key]
+                    tickets.remove(ticket)
+                    if not tickets:
+                        del self._waiting[key]
+                    self._timeouts += 1
+                    ticket = None
+            if ticket is None:
+                raise QueueTimeout(
+                    "Timed out waiting for an inference slot",
+                    QUEUE_TIMEOUT_RETRY_AFTER_SECONDS,
+                )
+        self.queue_wait_ms.observe((time.monotonic() - started) * 1000)
+
+    def release(self):
+        """
+        Frees a slot, handing it to the next key in turn if any is waiting
+        """
+        with self._lock:
+            if not self._waiting:
+                self._active -= 1
+                return
+            key, tickets = next(iter(self._waiting.items()))
+            ticket = tickets.popleft()
+            if tickets:
+                self._waiting.move_to_end(key)
+            else:
+                del self._waiting[key]
+        ticket.set()
+
+    @contextmanager
+    def slot(self, key):
+        """
+        Context manager holding a slot for key
+        - key: hashable
+        """
+        self.acquire(key)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self):
+        """
+        Returns active and queued calls and the queue wait distribution
+        """
+        with self._lock:
+            active = self._active
+            queued = sum(len(tickets) for tickets in self._waiting.values())
+            waiting_keys = len(self._waiting)
+            timeouts = self._timeouts
+        return {
+            "max_concurrent": self.max_concurrent,
+            "active": active,
+            "queued": queued,
+            "waiting_keys": waiting_keys,
+            "timeouts": timeouts,
+            "queue_wait_ms": self.queue_wait_ms.stats(),
+        }
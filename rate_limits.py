@@ -0,0 +1,80 @@
+'''
+Per-user rate limits and fair queuing of the inference routes (see
+rate_limiter).
+
+Every user gets a token bucket of USER_RATE_LIMIT_PER_MINUTE requests per
+minute with bursts of USER_RATE_LIMIT_BURST (0 requests per minute disables
+the limit). RATE_LIMIT_STORE=dynamodb shares the buckets between tasks
+through a table with partition key bucket_key (string).
+
+At most INFERENCE_MAX_CONCURRENT model calls run at once; past this, users
+take turns for freed slots. Requests over their rate are answered with a
+429, and requests that waited too long for a slot with a 503.
+'''
+
+import os
+
+from admission import retry_later_response
+from rate_limiter import (
+    DynamoDBTokenBuckets,
+    FairScheduler,
+    InMemoryTokenBuckets,
+    RateLimited,
+    RateLimiter,
+)
+
+USER_RATE_LIMIT_PER_MINUTE = float(os.environ.get("USER_RATE_LIMIT_PER_MINUTE", 30))
+USER_RATE_LIMIT_BURST = int(os.environ.get("USER_RATE_LIMIT_BURST", 10))
+RATE_LIMIT_STORE = os.environ.get("RATE_LIMIT_STORE", "memory")
+RATE_LIMIT_TABLE_NAME = "rate-limits"
+INFERENCE_MAX_CONCURRENT = int(os.environ.get("INFERENCE_MAX_CONCURRENT", 64))
+# Longest wait for a free slot (0 waits without a bound)
+INFERENCE_QUEUE_TIMEOUT_SECONDS = float(os.environ.get("INFERENCE_QUEUE_TIMEOUT_SECONDS", 30))
+RETRY_LATER_MESSAGES = {
+    "rate": "Too many requests. Try again later.",
+    "queue_timeout": "The server is busy. Try again shortly.",
+}
+
+
+def build_rate_limiter(dynamodb_resource):
+    """
+    Returns the per-user RateLimiter, or None when the limit is disabled
+    - dynamodb_resource: boto3 DynamoDB resource, for RATE_LIMIT_STORE=dynamodb
+    """
+    if USER_RATE_LIMIT_PER_MINUTE <= 0:
+        return None
+    return RateLimiter(
+        (
+            DynamoDBTokenBuckets(dynamodb_resource.Table(RATE_LIMIT_TABLE_NAME))
+            if RATE_LIMIT_STORE == "dynamodb"
+            else InMemoryTokenBuckets()
+        ),
+        USER_RATE_LIMIT_PER_MINUTE,
+        USER_RATE_LIMIT_BURST,
+    )
+
+
+def build_inference_scheduler():
+    """
+    Returns the FairScheduler of the model calls
+    """
+    return FairScheduler(INFERENCE_MAX_CONCURRENT, INFERENCE_QUEUE_TIMEOUT_SECONDS or None)
+
+
+def rate_limited(error: RateLimited):
+    """
+    Answers requests over the user's rate limit with a 429, and requests
+    that waited too long for an inference slot (QueueTimeout) with a 503
+    - error: RateLimited
+    """
+    return retry_later_response(
+        error.status_code, RETRY_LATER_MESSAGES[error.reason], error.retry_after
+    )
+
+
+def init_app(app):
+    """
+    Registers the answer to RateLimited (and QueueTimeout) on the app
+    - app: Flask
+    """
+    app.register_error_handler(RateLimited, rate_limited)
@@ -0,0 +1,69 @@
+'''
+Read-your-writes for the history routes (see history_overlay).
+
+Turns generated by this process are merged into history reads until a read
+shows them persisted, for at most RECENT_TURNS_TTL_SECONDS (0 disables the
+overlay). A chat read with merged turns gets a version that covers them,
+so ETags change as soon as a turn is recorded.
+'''
+
+import hashlib
+import os
+
+from chat_cache import CachedChat
+from history_overlay import RecentTurnsOverlay
+import json_codec
+
+RECENT_TURNS_TTL_SECONDS = float(os.environ.get("RECENT_TURNS_TTL_SECONDS", 120))
+RECENT_TURNS_MAX_CHATS = 10000
+RECENT_TURNS = None
+if RECENT_TURNS_TTL_SECONDS > 0:
+    RECENT_TURNS = RecentTurnsOverlay(RECENT_TURNS_TTL_SECONDS, RECENT_TURNS_MAX_CHATS)
+
+
+def has_recent_turns(username: str, chat_id: int):
+    """
+    Checks if the chat has turns that are not persisted yet
+    - username: string
+    - chat_id: int
+    """
+    return RECENT_TURNS is not None and RECENT_TURNS.has_pending(username, chat_id)
+
+
+def merge_recent_turns(username: str, chat_id: int, entry: CachedChat):
+    """
+    Returns the cached chat entry with the turns of the chat that are not
+    persisted yet appended, or the entry itself if there are none. The ETag
+    of a merged entry covers the appended turns
+    - username: string
+    - chat_id: int
+    - entry: CachedChat
+    """
+    if not has_recent_turns(username, chat_id):
+        return entry
+    pending = RECENT_TURNS.pending(username, chat_id, len(entry.chat))
+    if not pending:
+        return entry
+    encoded = json_codec.dumps(pending)
+    chat = entry.chat + pending
+    return CachedChat(
+        etag=f"{entry.etag}+{hashlib.sha256(encoded).hexdigest()[:16]}",
+        chat=chat,
+        encoded=json_codec.dumps(chat),
+        size=entry.size,
+    )
+
+
+def chat_version(username: str, chat):
+    """
+    Returns a version string for a listed chat as reads return it: its ETag
+    in the listing, plus its turns in the recent turns overlay, if any
+    - username: string
+    - chat: ChatObject
+    """
+    if RECENT_TURNS is None:
+        return chat.etag
+    live = RECENT_TURNS.live_turns(username, chat.chat_id)
+    if not live:
+        return chat.etag
+    return f"{chat.etag}+{hashlib.sha256(json_codec.dumps(live)).hexdigest()[:16]}"
@@ -0,0 +1,82 @@
+'''
+Reuse of generated replies for requests that send "use_cache": true.
+
+The exact-match generation cache (see generation_cache) is checked first.
+Sampled generations (the default parameters) are only cached when
+GENERATION_CACHE_ALLOW_SAMPLING=1; GENERATION_CACHE_DB adds a SQLite tier.
+
+Near-duplicate (MinHash / LSH) matching comes behind it, for the same
+opted-in requests (see near_duplicate_cache). It is off unless
+NEAR_DUPLICATE_CACHE=1, which also reuses sampled replies whatever
+GENERATION_CACHE_ALLOW_SAMPLING says.
+'''
+
+import os
+
+from generation_cache import GenerationCache
+import json_codec
+from near_duplicate_cache import NearDuplicateCache
+
+GENERATION_CACHE_MAX_ENTRIES = int(os.environ.get("GENERATION_CACHE_MAX_ENTRIES", 10000))
+GENERATION_CACHE_TTL_SECONDS = float(os.environ.get("GENERATION_CACHE_TTL_SECONDS", 3600))
+GENERATION_CACHE = GenerationCache(
+    max_entries=GENERATION_CACHE_MAX_ENTRIES,
+    ttl_seconds=GENERATION_CACHE_TTL_SECONDS,
+    db_path=os.environ.get("GENERATION_CACHE_DB"),
+    allow_sampling=os.environ.get("GENERATION_CACHE_ALLOW_SAMPLING", "0") == "1",
+)
+NEAR_DUPLICATE_CACHE = None
+if os.environ.get("NEAR_DUPLICATE_CACHE", "0") == "1":
+    NEAR_DUPLICATE_CACHE = NearDuplicateCache(
+        threshold=float(os.environ.get("NEAR_DUPLICATE_THRESHOLD", 0.9)),
+        max_entries=GENERATION_CACHE_MAX_ENTRIES,
+        ttl_seconds=GENERATION_CACHE_TTL_SECONDS,
+    )
+
+
+def cached_reply(generate, payload: dict, use_cache: bool = False, prompt: str = None):
+    """
+    Returns the model reply for a generation request. With use_cache, a
+    cached reply for the same input and parameters is returned when the
+    parameters allow caching, then a reply to a near-duplicate prompt when
+    near-duplicate matching is enabled (whatever the parameters), and new
+    replies are cached
+    - generate: callable, takes no arguments and returns a new reply
+    - payload: dict, the TGI request body
+    - use_cache: bool
+    - prompt: string (optional), the bare user prompt, for near-duplicate
+      matching; only pass it when the model input carries no other context
+    """
+    exact = use_cache and GENERATION_CACHE.accepts(payload["parameters"])
+    near_duplicates = NEAR_DUPLICATE_CACHE if use_cache and prompt is not None else None
+    if not exact and near_duplicates is None:
+        return generate()
+
+    if exact:
+        key = GENERATION_CACHE.key(payload["inputs"], payload["parameters"])
+        model_reply = GENERATION_CACHE.get(key)
+        if model_reply is not None:
+            return model_reply
+
+    if near_duplicates is not None:
+        group = json_codec.dumps(dict(sorted(payload["parameters"].items())))
+        model_reply = near_duplicates.get(prompt, group)
+        if model_reply is not None:
+            return model_reply
+
+    model_reply = generate()
+    if exact:
+        GENERATION_CACHE.put(key, model_reply)
+    if near_duplicates is not None:
+        near_duplicates.put(prompt, group, model_reply)
+    return model_reply
+
+
+def stats():
+    """
+    Returns the counters of the enabled caches
+    """
+    caches = {"generation_cache": GENERATION_CACHE.stats()}
+    if NEAR_DUPLICATE_CACHE is not None:
+        caches["near_duplicate_cache"] = NEAR_DUPLICATE_CACHE.stats()
+    return caches
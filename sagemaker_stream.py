@@ -0,0 +1,86 @@
+'''
+Parsing of the token stream returned by invoke_endpoint_with_response_stream
+for the Hugging Face TGI container.
+
+With "stream": true in the request, TGI emits server-sent events, one
+data:{...} line per generated token. SageMaker splits that byte stream into
+PayloadPart events at arbitrary points, so lines are reassembled here before
+they are decoded.
+
+botocore reports an error the endpoint sends mid-stream (ModelStreamError,
+InternalStreamFailure) by raising EventStreamError while the stream is
+iterated, and a stalled stream by raising ReadTimeoutError; both surface
+here as ModelStreamError.
+'''
+
+from botocore.exceptions import BotoCoreError, EventStreamError
+
+import json_codec
+
+
+class ModelStreamError(Exception):
+    """
+    Raised when the endpoint reports an error in the middle of a stream
+    """
+
+
+def iter_tgi_tokens(event_stream):
+    """
+    Yields the text of each generated token from a SageMaker response stream,
+    skipping special tokens such as end-of-sequence
+    - event_stream: the "Body" of an invoke_endpoint_with_response_stream
+      response
+    """
+    buffer = b""
+    for event in iter_events(event_stream):
+        if "PayloadPart" not in event:
+            error = event.get("ModelStreamError") or event.get("InternalStreamFailure")
+            raise ModelStreamError(f"Inference stream failed: {error or event}")
+
+        buffer += event["PayloadPart"]["Bytes"]
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            token = parse_tgi_line(line)
+            if token:
+                yield token
+
+    token = parse_tgi_line(buffer)
+    if token:
+        yield token
+
+
+def iter_events(event_stream):
+    """
+    Yields the events of a SageMaker response stream, raising
+    ModelStreamError when reading the stream fails
+    - event_stream: the "Body" of an invoke_endpoint_with_response_stream
+      response
+    """
+    events = iter(event_stream)
+    while True:
+        try:
+            event = next(events)
+        except StopIteration:
+            return
+        except (EventStreamError, BotoCoreError) as e:
+            raise ModelStreamError(f"Inference stream failed: {e}") from e
+        yield event
+
+
+def parse_tgi_line(line: bytes):
+    """
+    Returns the token text carried by one TGI event-stream line, or None for
+    blank lines, non-data lines and special tokens
+    - line: bytes
+    """
+    line = line.strip()
+    if not line.startswith(b"data:"):
+        return None
+
+    message = json_codec.loads(line[len(b"data:"):])
+    if "error" in message:
+        raise ModelStreamError(f"Inference stream failed: {message['error']}")
+    token = message.get("token") or {}
+    if token.get("special"):
+        return None
+    return token.get("text")
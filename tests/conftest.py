@@ -0,0 +1,126 @@
+'''
+Shared fixtures: an in-memory S3 with ETags, conditional writes and
+deletes, also used by the benchmarks, and polling for background work.
+
+Run from the repository root:
+    python -m pytest -q
+'''
+
+import io
+import os
+import sys
+import threading
+import time
+
+import pytest
+from botocore.exceptions import ClientError
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def client_error(code: str, status: int):
+    """
+    Builds a botocore ClientError like the ones S3 raises
+    - code: string
+    - status: int
+    """
+    return ClientError(
+        {"Error": {"Code": code}, "ResponseMetadata": {"HTTPStatusCode": status}},
+        "S3",
+    )
+
+
+class MemoryS3:
+    """
+    The subset of the S3 client used by ChatCache and HistoryAppender, kept
+    in memory
+    - latency_ms: float, delay added to every request
+    """
+
+    def __init__(self, latency_ms: float = 0):
+        self.latency_ms = latency_ms
+        self.objects = {}
+        self.bytes_written = 0
+        self._versions = 0
+        self._lock = threading.Lock()
+
+    # Parameter names follow the boto3 client
+    # pylint: disable=invalid-name,unused-argument
+
+    def delete_object(self, Bucket, Key):
+        """
+        Deletes an object, if it exists
+        """
+        self._delay()
+        with self._lock:
+            self.objects.pop(Key, None)
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None, Range=None):
+        """
+        Returns an object, honouring IfNoneMatch and suffix ranges
+        ("bytes=-N")
+        """
+        self._delay()
+        with self._lock:
+            if Key not in self.objects:
+                raise client_error("NoSuchKey", 404)
+            body, etag = self.objects[Key]
+        if IfNoneMatch == etag:
+            raise client_error("304", 304)
+        if Range is None:
+            return {"Body": io.BytesIO(body), "ETag": etag}
+        first = max(0, len(body) - int(Range.split("-")[-1]))
+        return {
+            "Body": io.BytesIO(body[first:]),
+            "ETag": etag,
+            "ContentRange": f"bytes {first}-{len(body) - 1}/{len(body)}",
+        }
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None, **kwargs):
+        """
+        Stores an object, honouring IfMatch and IfNoneMatch="*"
+        """
+        self._delay()
+        with self._lock:
+            current = self.objects.get(Key)
+            if (IfMatch is not None and (current is None or current[1] != IfMatch)) or (
+                IfNoneMatch == "*" and current is not None
+            ):
+                raise client_error("PreconditionFailed", 412)
+            self._versions += 1
+            etag = f'"{self._versions}"'
+            self.objects[Key] = (bytes(Body), etag)
+            self.bytes_written += len(Body)
+        return {"ETag": etag}
+
+    def _delay(self):
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+
+
+def poll(condition, timeout: float = 5):
+    """
+    Polls condition until it is true. Returns its last value
+    - condition: callable
+    - timeout: float, in seconds
+    """
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+@pytest.fixture
+def wait_for():
+    """
+    Polls a condition of background work until it is true or times out
+    """
+    return poll
+
+
+@pytest.fixture
+def s3():
+    """
+    An empty in-memory S3
+    """
+    return MemoryS3()
@@ -0,0 +1,124 @@
+'''
+Tests of admission_control: AIMD tuning of a dependency's concurrency limit
+and the share of it each route priority may use.
+'''
+
+import pytest
+
+import admission_control
+from admission_control import AdaptiveConcurrencyLimit, parse_route_priorities
+
+
+class FakeClock:
+    """
+    A monotonic clock moved by hand
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        """
+        Returns the current time
+        """
+        return self.now
+
+
+@pytest.fixture(name="clock")
+def fake_clock(monkeypatch):
+    """
+    Replaces the clock that spaces out limit decreases
+    """
+    fake = FakeClock()
+    monkeypatch.setattr(admission_control, "time", fake)
+    return fake
+
+
+def finish(limit: AdaptiveConcurrencyLimit, latency: float, overloaded: bool = False):
+    """
+    Runs one high-priority request through the limit
+    """
+    assert limit.try_acquire("high")
+    limit.release(latency, overloaded=overloaded)
+
+
+@pytest.mark.usefixtures("clock")
+def test_fast_requests_raise_the_limit_by_one_per_window():
+    """
+    A limit's worth of requests within the SLO raises the limit by about one,
+    up to max_limit
+    """
+    limit = AdaptiveConcurrencyLimit(100, initial_limit=10, min_limit=1, max_limit=12)
+    for _ in range(10):
+        finish(limit, 0.01)
+    assert 10.9 < limit.limit <= 11
+
+    for _ in range(100):
+        finish(limit, 0.01)
+    assert limit.limit == 12
+
+
+def test_slow_requests_cut_the_limit_once_per_slo_period(clock):
+    """
+    A request over the SLO multiplies the limit by the backoff factor, and
+    the requests that finish in the same SLO period do not cut it again
+    """
+    limit = AdaptiveConcurrencyLimit(100, initial_limit=10, min_limit=1, max_limit=20)
+    finish(limit, 0.5)
+    assert limit.limit == pytest.approx(9)
+    finish(limit, 0.5)
+    assert limit.limit == pytest.approx(9)
+
+    clock.now += 0.1
+    finish(limit, 0.5)
+    assert limit.limit == pytest.approx(8.1)
+    assert limit.stats()["decreases"] == 2
+
+
+def test_overload_errors_cut_the_limit_down_to_min_limit(clock):
+    """
+    A fast request that failed with an overload error counts as congestion,
+    and the limit never drops below min_limit
+    """
+    limit = AdaptiveConcurrencyLimit(100, initial_limit=4, min_limit=3, max_limit=20)
+    finish(limit, 0.01, overloaded=True)
+    assert limit.limit == pytest.approx(3.6)
+    for _ in range(5):
+        clock.now += 1
+        finish(limit, 0.01, overloaded=True)
+    assert limit.limit == 3
+
+
+@pytest.mark.usefixtures("clock")
+def test_low_priority_requests_are_shed_first():
+    """
+    Each priority may only fill its share of the limit, so low-priority
+    requests are turned away while high-priority ones still get through
+    """
+    limit = AdaptiveConcurrencyLimit(100, initial_limit=10, min_limit=1, max_limit=20)
+    admitted = {}
+    for priority in ["low", "normal", "high"]:
+        while limit.try_acquire(priority):
+            pass
+        admitted[priority] = limit.in_flight
+    assert admitted == {"low": 5, "normal": 8, "high": 10}
+    assert limit.stats()["shed"] == {"high": 1, "normal": 1, "low": 1}
+
+    # Once the limit has shrunk, each priority still gets at least one slot
+    limit = AdaptiveConcurrencyLimit(100, initial_limit=1, min_limit=1, max_limit=20)
+    assert limit.try_acquire("low")
+    assert not limit.try_acquire("high")
+
+
+def test_parse_route_priorities():
+    """
+    Route priorities parse from "endpoint=priority" pairs and reject unknown
+    priorities
+    """
+    assert parse_route_priorities(" get_chat_history=low, ,user_authentication=high") == {
+        "get_chat_history": "low",
+        "user_authentication": "high",
+    }
+    assert not parse_route_priorities("")
+    with pytest.raises(ValueError):
+        parse_route_priorities("get_chat_history=urgent")
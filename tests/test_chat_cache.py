@@ -0,0 +1,130 @@
+'''
+Tests of chat_cache: revalidation of cached chats with listing ETags and
+conditional GETs, and eviction within the byte budget.
+'''
+
+import pytest
+from botocore.exceptions import ClientError
+
+import json_codec
+from chat_cache import PARSED_SIZE_FACTOR, ChatCache
+from tests.conftest import MemoryS3
+
+BUCKET = "chats"
+
+
+class ConditionRecordingS3(MemoryS3):
+    """
+    An in-memory S3 that records the IfNoneMatch of every GET
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.conditions = []
+
+    # pylint: disable=invalid-name
+    def get_object(self, Bucket, Key, IfNoneMatch=None, Range=None):
+        """
+        Returns an object, recording the condition it was requested with
+        """
+        self.conditions.append(IfNoneMatch)
+        return super().get_object(Bucket, Key, IfNoneMatch, Range)
+
+
+def put_chat(s3: MemoryS3, key: str, chat: list):
+    """
+    Stores a chat file and returns its ETag
+    """
+    return s3.put_object(Bucket=BUCKET, Key=key, Body=json_codec.dumps(chat))["ETag"]
+
+
+def test_unchanged_chats_are_revalidated_with_a_304():
+    """
+    A cached chat is revalidated with a conditional GET, and the 304 answer
+    returns the cached entry; a changed chat is downloaded again
+    """
+    s3 = ConditionRecordingS3()
+    etag = put_chat(s3, "alice/1.json", [{"user": "hi"}])
+    cache = ChatCache(s3, BUCKET, max_bytes=10000)
+
+    entry = cache.fetch("alice/1.json")
+    assert entry.chat == [{"user": "hi"}]
+    assert cache.fetch("alice/1.json") is entry
+    assert s3.conditions == [None, etag]
+
+    put_chat(s3, "alice/1.json", [{"user": "hi"}, {"user": "again"}])
+    assert len(cache.fetch("alice/1.json").chat) == 2
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"]) == (1, 2)
+
+
+def test_a_matching_listing_etag_skips_the_request():
+    """
+    When the caller already knows the chat's current ETag, a cached chat is
+    returned without any request
+    """
+    s3 = ConditionRecordingS3()
+    etag = put_chat(s3, "alice/1.json", [{"user": "hi"}])
+    cache = ChatCache(s3, BUCKET, max_bytes=10000)
+
+    entry = cache.fetch("alice/1.json", etag=etag)
+    assert cache.fetch("alice/1.json", etag=etag) is entry
+    assert s3.conditions == [None]
+
+
+def test_deleted_chats_are_dropped(s3):
+    """
+    A chat deleted from S3 is returned as None and leaves the cache
+    """
+    put_chat(s3, "alice/1.json", [{"user": "hi"}])
+    cache = ChatCache(s3, BUCKET, max_bytes=10000)
+    cache.fetch("alice/1.json")
+
+    s3.delete_object(Bucket=BUCKET, Key="alice/1.json")
+    assert cache.fetch("alice/1.json") is None
+    assert cache.stats()["entries"] == 0
+    assert cache.stats()["bytes"] == 0
+
+
+def test_entries_are_evicted_to_stay_within_the_byte_budget(s3):
+    """
+    Entries are charged for their raw bytes plus the estimated parsed copy,
+    and the least recently used ones are evicted once the budget is full
+    """
+    chat = [{"user": "hi"}]
+    entry_size = len(json_codec.dumps(chat)) * (1 + PARSED_SIZE_FACTOR)
+    cache = ChatCache(s3, BUCKET, max_bytes=2 * entry_size)
+    for key in ["a.json", "b.json", "c.json"]:
+        put_chat(s3, key, chat)
+
+    assert cache.fetch("a.json").size == entry_size
+    cache.fetch("b.json")
+    cache.get("a.json")
+    cache.fetch("c.json")
+
+    assert cache.get("b.json") is None
+    assert cache.get("a.json") is not None
+    assert cache.get("c.json") is not None
+    stats = cache.stats()
+    assert (stats["entries"], stats["bytes"], stats["evictions"]) == (2, 2 * entry_size, 1)
+
+    # A chat larger than the whole budget is returned but not kept
+    put_chat(s3, "big.json", chat * 3)
+    assert cache.fetch("big.json").chat == chat * 3
+    assert cache.get("big.json") is None
+    assert cache.stats()["entries"] == 2
+
+
+def test_failed_conditional_writes_drop_the_cached_entry(s3):
+    """
+    A successful write is cached; a write whose condition does not hold
+    raises and drops the entry, so the next read goes to S3
+    """
+    cache = ChatCache(s3, BUCKET, max_bytes=10000)
+    chat = [{"user": "hi"}]
+    entry = cache.write("alice/1.json", chat, json_codec.dumps(chat), IfNoneMatch="*")
+    assert cache.get("alice/1.json") is entry
+
+    with pytest.raises(ClientError):
+        cache.write("alice/1.json", chat, json_codec.dumps(chat), IfMatch='"stale"')
+    assert cache.get("alice/1.json") is None
@@ -0,0 +1,98 @@
+'''
+Tests of chat_segments: migration, tail reads, and appends racing with
+compaction.
+'''
+
+import threading
+
+from chat_cache import ChatCache
+from chat_segments import SegmentedChatStore
+from chat_store import chat_key, manifest_key, segment_key
+import json_codec
+
+BUCKET_NAME = "test"
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+
+def make_store(s3, compact_min_segments: int = 4, background: bool = True):
+    """
+    Returns a SegmentedChatStore whose segments are all small
+    """
+    return SegmentedChatStore(
+        ChatCache(s3, BUCKET_NAME, CACHE_MAX_BYTES),
+        small_segment_bytes=1024 * 1024,
+        compact_min_segments=compact_min_segments,
+        max_pending=100,
+        background=background,
+    )
+
+
+def test_first_append_migrates_the_array_file(s3):
+    """
+    The first append copies the array file into the first segment
+    """
+    s3.put_object(Bucket=BUCKET_NAME, Key=chat_key("user", 1), Body=json_codec.dumps([{"n": 0}]))
+    store = make_store(s3, compact_min_segments=100)
+    store.append("user", 1, [{"n": 1}])
+    store.append("user", 1, [{"n": 2}, {"n": 3}])
+
+    assert store.fetch("user", 1).chat == [{"n": n} for n in range(4)]
+    assert store.read_turns("user", 1, 2) == ([{"n": 2}, {"n": 3}], True, 2)
+    assert store.read_turns("user", 1) == ([{"n": n} for n in range(4)], False, 0)
+    assert store.stats()["migrated"] == 1
+
+
+def test_concurrent_appends_and_compaction_keep_every_turn_in_order(s3, wait_for):
+    """
+    Appends racing with each other and with background compactions lose no turn
+    """
+    writers, appends = 4, 30
+    store = make_store(s3)
+
+    def write(writer):
+        for number in range(appends):
+            store.append("user", 1, [{"writer": writer, "n": number}])
+
+    threads = [threading.Thread(target=write, args=(writer,)) for writer in range(writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert wait_for(lambda: store.stats()["compactions_queued"] == 0)
+
+    # A fresh reader sees every turn, each writer's in the order it wrote them
+    turns = make_store(s3).fetch("user", 1).chat
+    assert len(turns) == writers * appends
+    for writer in range(writers):
+        assert [turn["n"] for turn in turns if turn["writer"] == writer] == list(range(appends))
+
+    stats = store.stats()
+    assert stats["compactions"] > 0
+    assert stats["failed_compactions"] == 0
+    # Segments replaced by a compaction, or orphaned by a lost race, are gone
+    manifest = json_codec.loads(s3.objects[manifest_key("user", 1)][0])
+    listed = {segment_key("user", 1, segment["number"]) for segment in manifest["segments"]}
+    stored = {key for key in s3.objects if ".segments/" in key}
+    assert stored == listed
+    assert manifest["turn_count"] == writers * appends
+
+
+def test_reader_retries_when_compaction_deletes_its_segments(s3):
+    """
+    A reader holding an outdated manifest reads the new one
+    """
+    store = make_store(s3, compact_min_segments=100, background=False)
+    for number in range(5):
+        store.append("user", 1, [{"n": number}])
+    reader = make_store(s3)
+    listed_etag = reader.fetch("user", 1).etag
+
+    # The reader trusts its cached manifest for the ETag of an older listing,
+    # but no longer has the segments that manifest lists
+    assert store.compact("user", 1)
+    for number in range(5):
+        reader.chat_cache.invalidate(segment_key("user", 1, number))
+    chat = reader.fetch("user", 1, etag=listed_etag)
+    assert [turn["n"] for turn in chat.chat] == list(range(5))
+    assert chat.etag != listed_etag
+    assert reader.stats()["read_retries"] == 1
@@ -0,0 +1,169 @@
+'''
+Tests of chat_store: the process-wide bound on S3 requests, and tail reads
+that decode only the end of a chat file.
+'''
+
+import threading
+import time
+
+import chat_store
+from chat_cache import ChatCache
+from chat_store import BoundedS3Client, fetch_chat_tail, parse_chat_tail, read_array_turns
+import json_codec
+from tests.conftest import MemoryS3
+
+BUCKET_NAME = "test"
+# Braces inside strings and multi-byte characters make turn boundaries hard
+TURNS = [
+    {"prompt": f"prompt {i} {{not a turn}}", "model_response": "réponse " * 5}
+    for i in range(20)
+]
+
+
+class SlowS3:
+    """
+    Wraps an in-memory S3 to record how many requests run at once
+    """
+
+    def __init__(self, s3):
+        self.s3 = s3
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def _call(self, method, **kwargs):
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(0.01)
+        try:
+            return getattr(self.s3, method)(**kwargs)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def get_object(self, **kwargs):
+        """
+        Returns an object
+        """
+        return self._call("get_object", **kwargs)
+
+    def put_object(self, **kwargs):
+        """
+        Stores an object
+        """
+        return self._call("put_object", **kwargs)
+
+
+def test_requests_from_every_thread_share_the_bound(s3):
+    """
+    Gets and puts from many threads never exceed max_concurrency at once,
+    and bodies come back readable
+    """
+    slow = SlowS3(s3)
+    client = BoundedS3Client(slow, 3)
+    client.put_object(Bucket=BUCKET_NAME, Key="key", Body=b"[]")
+    bodies = []
+
+    def work():
+        client.put_object(Bucket=BUCKET_NAME, Key="other", Body=b"{}")
+        bodies.append(client.get_object(Bucket=BUCKET_NAME, Key="key")["Body"].read())
+
+    threads = [threading.Thread(target=work) for _ in range(12)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert slow.max_in_flight == 3
+    assert bodies == [b"[]"] * 12
+
+
+class RangeRecordingS3(MemoryS3):
+    """
+    An in-memory S3 that records the Range of every GET
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.ranges = []
+
+    # pylint: disable=invalid-name
+    def get_object(self, Bucket, Key, IfNoneMatch=None, Range=None):
+        """
+        Returns an object, recording the requested range
+        """
+        self.ranges.append(Range)
+        return super().get_object(Bucket, Key, IfNoneMatch, Range)
+
+
+def test_tail_is_decoded_from_any_suffix_of_the_file():
+    """
+    Whatever byte the suffix starts at, the tail is either the right turns
+    or None (more of the file is needed), never a wrong parse
+    """
+    encoded = json_codec.dumps(TURNS)
+    decoded = 0
+    for length in range(1, len(encoded) + 1):
+        tail = parse_chat_tail(encoded[-length:], 3, length == len(encoded))
+        if tail is not None:
+            assert tail == (TURNS[-3:], True)
+            decoded += 1
+    # Every suffix holding three whole turns decodes
+    assert parse_chat_tail(encoded[-len(json_codec.dumps(TURNS[-4:])) :], 3, False)
+    assert decoded > len(encoded) // 2
+
+
+def test_short_suffix_needs_more_of_the_file():
+    """
+    A suffix with fewer turns than asked for is not enough, unless it is the
+    whole file
+    """
+    encoded = json_codec.dumps(TURNS[:2])
+    assert parse_chat_tail(encoded[1:], 3, False) is None
+    assert parse_chat_tail(encoded, 3, True) == (TURNS[:2], False)
+
+
+def test_fetch_doubles_the_range_until_the_tail_fits(monkeypatch):
+    """
+    The ranged GET starts at a guess per turn and doubles, without reading
+    the whole file when the tail fits in less
+    """
+    monkeypatch.setattr(chat_store, "TAIL_BYTES_PER_TURN", 16)
+    s3 = RangeRecordingS3()
+    encoded = json_codec.dumps(TURNS)
+    s3.put_object(Bucket=BUCKET_NAME, Key="u/1.json", Body=encoded)
+
+    assert fetch_chat_tail(s3, BUCKET_NAME, "u/1.json", 3) == (TURNS[-3:], True)
+    sizes = [int(range_header.split("-")[-1]) for range_header in s3.ranges]
+    assert sizes == [48 * 2**attempt for attempt in range(len(sizes))]
+    assert len(sizes) > 1 and sizes[-2] < len(encoded)
+
+
+def test_fetch_of_a_short_or_missing_chat(s3):
+    """
+    A range past the start of the file returns the whole chat, and a missing
+    file returns None
+    """
+    s3.put_object(Bucket=BUCKET_NAME, Key="u/1.json", Body=json_codec.dumps(TURNS[:2]))
+    assert fetch_chat_tail(s3, BUCKET_NAME, "u/1.json", 5) == (TURNS[:2], False)
+    assert fetch_chat_tail(s3, BUCKET_NAME, "u/2.json", 5) is None
+
+
+def test_cached_chats_are_not_read_again():
+    """
+    Only the end of an uncached chat is read, and the index of its first
+    turn is unknown; a cached chat is only revalidated, and its tail taken
+    from the cached copy
+    """
+    s3 = RangeRecordingS3()
+    s3.put_object(Bucket=BUCKET_NAME, Key="u/1.json", Body=json_codec.dumps(TURNS))
+    chat_cache = ChatCache(s3, BUCKET_NAME, 1024 * 1024)
+
+    assert read_array_turns(chat_cache, "u/1.json", 2) == (TURNS[-2:], True, None)
+    assert s3.ranges[-1] is not None
+
+    chat_cache.fetch("u/1.json")
+    requests = len(s3.ranges)
+    assert read_array_turns(chat_cache, "u/1.json", 2) == (TURNS[-2:], True, 18)
+    assert read_array_turns(chat_cache, "u/1.json") == (TURNS, False, 0)
+    assert s3.ranges[requests:] == [None, None]
@@ -0,0 +1,180 @@
+'''
+Tests of circuit_breaker: breaker state transitions, timeout buckets, and
+which invoke_endpoint errors count against an endpoint.
+'''
+
+import time
+
+import pytest
+from botocore.exceptions import ClientError
+
+from circuit_breaker import (
+    CLOSED,
+    HALF_OPEN,
+    OPEN,
+    AdaptiveTimeout,
+    CircuitBreaker,
+    EndpointUnavailable,
+    InvalidModelRequest,
+    ResilientEndpoint,
+)
+
+RESET_TIMEOUT_SECONDS = 0.05
+
+
+def model_error(original_status: int):
+    """
+    Builds the ClientError SageMaker raises when the container answers with
+    an error status
+    - original_status: int
+    """
+    return ClientError(
+        {
+            "Error": {"Code": "ModelError", "Message": "Received client error"},
+            "ResponseMetadata": {"HTTPStatusCode": 424},
+            "OriginalStatusCode": original_status,
+            "OriginalMessage": "inputs tokens + max_new_tokens must be <= 2048",
+        },
+        "InvokeEndpoint",
+    )
+
+
+class FakeRuntime:
+    """
+    A sagemaker-runtime client whose endpoints raise the given errors
+    - errors: dict of endpoint name to the exception it raises
+    """
+
+    def __init__(self, errors: dict):
+        self.errors = errors
+        self.calls = []
+
+    # Parameter names follow the boto3 client
+    # pylint: disable=invalid-name
+
+    def invoke_endpoint(self, EndpointName, **kwargs):
+        """
+        Raises the endpoint's error, or answers
+        """
+        self.calls.append(EndpointName)
+        if EndpointName in self.errors:
+            raise self.errors[EndpointName]
+        return {"Body": kwargs["Body"]}
+
+
+def make_endpoint(runtime: FakeRuntime, failure_threshold: int = 5):
+    """
+    Returns a ResilientEndpoint over a primary and a secondary endpoint
+    """
+    return ResilientEndpoint(
+        {5: runtime, 10: runtime},
+        ["primary", "secondary"],
+        failure_threshold=failure_threshold,
+        reset_timeout_seconds=30,
+    )
+
+
+def test_breaker_opens_probes_and_closes():
+    """
+    The circuit opens after the threshold, lets one probe through after the
+    reset timeout, and closes when the probe succeeds
+    """
+    breaker = CircuitBreaker(2, RESET_TIMEOUT_SECONDS)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+    assert 0 < breaker.retry_after() <= RESET_TIMEOUT_SECONDS
+
+    time.sleep(RESET_TIMEOUT_SECONDS)
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+    # Only one probe at a time
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+
+    time.sleep(RESET_TIMEOUT_SECONDS)
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CLOSED
+    assert breaker.retry_after() == 0
+    assert breaker.stats()["transitions"] == {
+        "closed_to_open": 1,
+        "open_to_half_open": 2,
+        "half_open_to_open": 1,
+        "half_open_to_closed": 1,
+    }
+
+
+def test_success_resets_the_consecutive_failures():
+    """
+    Only consecutive failures open the circuit
+    """
+    breaker = CircuitBreaker(2, RESET_TIMEOUT_SECONDS)
+    for _ in range(3):
+        breaker.record_failure()
+        breaker.record_success()
+    assert breaker.state == CLOSED
+
+
+def test_timeout_follows_the_recent_p99_latency():
+    """
+    The timeout is the smallest bucket above multiplier times the p99
+    """
+    timeout = AdaptiveTimeout([20, 5, 10], multiplier=3, window=10, min_samples=3)
+    assert timeout.current() == 20
+    for _ in range(3):
+        timeout.observe(1)
+    assert timeout.current() == 5
+    timeout.observe(3)
+    assert timeout.current() == 10
+    timeout.observe(60)
+    assert timeout.current() == 20
+
+
+def test_rejected_prompts_do_not_open_the_circuit():
+    """
+    A ModelError wrapping a 4xx from the container is the caller's error:
+    it is raised as InvalidModelRequest without failing over, and the
+    circuit stays closed
+    """
+    runtime = FakeRuntime({"primary": model_error(422)})
+    endpoint = make_endpoint(runtime)
+    for _ in range(10):
+        with pytest.raises(InvalidModelRequest) as raised:
+            endpoint.invoke("invoke_endpoint", Body=b"{}")
+        assert raised.value.status_code == 422
+    assert runtime.calls == ["primary"] * 10
+    stats = endpoint.stats()
+    assert stats["failovers"] == 0
+    assert stats["endpoints"]["primary"]["state"] == CLOSED
+
+
+@pytest.mark.parametrize("original_status", [500, 503, 429])
+def test_model_errors_from_unhealthy_containers_fail_over(original_status):
+    """
+    A ModelError wrapping a 5xx or 429 counts against the endpoint
+    """
+    runtime = FakeRuntime({"primary": model_error(original_status)})
+    endpoint = make_endpoint(runtime, failure_threshold=2)
+    for _ in range(2):
+        assert endpoint.invoke("invoke_endpoint", Body=b"{}") == {"Body": b"{}"}
+    assert endpoint.stats()["endpoints"]["primary"]["state"] == OPEN
+    # The open circuit is skipped without calling the primary
+    endpoint.invoke("invoke_endpoint", Body=b"{}")
+    assert runtime.calls == ["primary", "secondary"] * 2 + ["secondary"]
+
+
+def test_every_endpoint_failing_raises_endpoint_unavailable():
+    """
+    With no endpoint left the call fails fast with a retry delay
+    """
+    error = model_error(503)
+    endpoint = make_endpoint(FakeRuntime({"primary": error, "secondary": error}), 1)
+    with pytest.raises(EndpointUnavailable):
+        endpoint.invoke("invoke_endpoint", Body=b"{}")
+    with pytest.raises(EndpointUnavailable) as raised:
+        endpoint.invoke("invoke_endpoint", Body=b"{}")
+    assert 1 <= raised.value.retry_after <= 30
@@ -0,0 +1,99 @@
+'''
+Tests of generation_cache: which generation parameters may be cached, cache
+keys, LRU eviction and the SQLite tier.
+'''
+
+import pytest
+
+from generation_cache import GenerationCache, uses_sampling
+
+
+@pytest.mark.parametrize(
+    "parameters, sampled",
+    [
+        ({}, False),
+        ({"max_new_tokens": 256}, False),
+        ({"do_sample": False, "temperature": 1}, False),
+        ({"temperature": 0}, False),
+        ({"top_p": 1.0}, False),
+        ({"do_sample": True}, True),
+        ({"temperature": 0.7}, True),
+        ({"top_p": 0.9}, True),
+        ({"top_k": 50}, True),
+        ({"typical_p": 0.95}, True),
+        ({"do_sample": True, "temperature": 0.7, "seed": 42}, False),
+    ],
+)
+def test_uses_sampling(parameters, sampled):
+    """
+    Sampling parameters make a generation non-deterministic unless a seed
+    fixes the draw
+    """
+    assert uses_sampling(parameters) is sampled
+
+
+def test_only_deterministic_generations_are_accepted():
+    """
+    Sampled generations are uncacheable unless allow_sampling is set
+    """
+    cache = GenerationCache(max_entries=10, ttl_seconds=60)
+    assert cache.accepts({"max_new_tokens": 256})
+    assert not cache.accepts({"temperature": 0.7, "top_p": 0.9})
+    assert cache.stats()["uncacheable"] == 1
+
+    cache = GenerationCache(max_entries=10, ttl_seconds=60, allow_sampling=True)
+    assert cache.accepts({"temperature": 0.7, "top_p": 0.9})
+    assert cache.stats()["uncacheable"] == 0
+
+
+def test_keys_ignore_case_whitespace_and_parameter_order():
+    """
+    Prompts differing only in case and spacing share a key, and so do equal
+    parameters in another order; different parameters do not
+    """
+    key = GenerationCache.key("What is  S3?\n", {"max_new_tokens": 256, "seed": 1})
+    assert GenerationCache.key("what is s3?", {"seed": 1, "max_new_tokens": 256}) == key
+    assert GenerationCache.key("what is s3?", {"seed": 2, "max_new_tokens": 256}) != key
+
+
+def test_least_recently_used_entries_are_evicted():
+    """
+    The in-memory tier keeps max_entries entries, evicting the least
+    recently read
+    """
+    cache = GenerationCache(max_entries=2, ttl_seconds=60)
+    cache.put("a", "reply a")
+    cache.put("b", "reply b")
+    assert cache.get("a") == "reply a"
+    cache.put("c", "reply c")
+
+    assert cache.get("b") is None
+    assert cache.get("a") == "reply a"
+    assert cache.get("c") == "reply c"
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["evictions"]) == (3, 1, 1)
+
+
+def test_expired_entries_are_misses():
+    """
+    Entries are not returned past their TTL
+    """
+    cache = GenerationCache(max_entries=2, ttl_seconds=0)
+    cache.put("a", "reply a")
+    assert cache.get("a") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_sqlite_tier_survives_a_restart(tmp_path):
+    """
+    Entries written to the SQLite tier are served by a new cache on the same
+    file, and loaded into its in-memory tier
+    """
+    db_path = str(tmp_path / "generations.db")
+    GenerationCache(max_entries=10, ttl_seconds=60, db_path=db_path).put("a", "reply a")
+
+    cache = GenerationCache(max_entries=10, ttl_seconds=60, db_path=db_path)
+    assert cache.get("a") == "reply a"
+    assert cache.get("a") == "reply a"
+    stats = cache.stats()
+    assert (stats["disk_hits"], stats["hits"], stats["persistent"]) == (1, 1, True)
@@ -0,0 +1,96 @@
+'''
+Tests of history_append: conditional appends to array chats, and how the
+AddChatHistory handler reports chats it could not write.
+'''
+
+import pytest
+
+import json_codec
+from chat_cache import ChatCache
+from chat_store import chat_key
+from history_append import AppendFailed, HistoryAppender, handle_event
+
+BUCKET_NAME = "test"
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+
+class PartialAppender(HistoryAppender):
+    """
+    A HistoryAppender whose appends to the chats in fail_chats raise
+    """
+
+    def __init__(self, chat_cache, fail_chats=()):
+        super().__init__(chat_cache)
+        self.fail_chats = set(fail_chats)
+
+    def append(self, username, chat_id, entries):
+        if (username, chat_id) in self.fail_chats:
+            raise RuntimeError("S3 is down")
+        return super().append(username, chat_id, entries)
+
+
+def batch(*chat_ids):
+    """
+    Returns a batched payload with one turn for each chat of user "user"
+    """
+    return {
+        "chats": [
+            {"username": "user", "chat_id": chat_id, "model_history_entries": [{"n": chat_id}]}
+            for chat_id in chat_ids
+        ]
+    }
+
+
+def stored(s3, chat_id):
+    """
+    Returns the turns stored for a chat of user "user"
+    """
+    return json_codec.loads(s3.objects[chat_key("user", chat_id)][0])
+
+
+def test_appends_by_two_writers_keep_every_turn(s3):
+    """
+    Appends extend the version of the chat another writer left
+    """
+    appender = HistoryAppender(ChatCache(s3, BUCKET_NAME, CACHE_MAX_BYTES))
+    appender.append("user", 1, [{"n": 0}])
+    # Another writer appends behind the cache's back
+    other = HistoryAppender(ChatCache(s3, BUCKET_NAME, CACHE_MAX_BYTES))
+    other.append("user", 1, [{"n": 1}])
+    other.append("user", 1, [{"n": 2}])
+    appender.append("user", 1, [{"n": 3}])
+    assert stored(s3, 1) == [{"n": n} for n in range(4)]
+
+
+def test_single_turn_event_that_fails_raises(s3):
+    """
+    A failed single-turn event raises, so Lambda retries it
+    """
+    appender = PartialAppender(ChatCache(s3, BUCKET_NAME, CACHE_MAX_BYTES), {("user", 1)})
+    event = {"username": "user", "chat_id": 1, "model_history_entry": {"n": 1}}
+    with pytest.raises(AppendFailed):
+        handle_event(appender, event, retry=pytest.fail)
+
+
+def test_failed_chats_of_a_batch_are_retried_alone(s3):
+    """
+    Only the chats that failed are sent again
+    """
+    appender = PartialAppender(ChatCache(s3, BUCKET_NAME, CACHE_MAX_BYTES), {("user", 2)})
+    retried = []
+    result = handle_event(appender, batch(1, 2, 3), retry=retried.append)
+    assert result == {"status_code": 200, "written": 2, "retried": 1}
+    assert retried == [batch(2)]
+    assert stored(s3, 1) == [{"n": 1}]
+
+    # Without a way to retry them alone, the batch raises
+    with pytest.raises(AppendFailed):
+        handle_event(appender, batch(4, 2))
+
+
+def test_malformed_event_is_not_retried(s3):
+    """
+    A payload that can never be written is reported instead of raised
+    """
+    appender = HistoryAppender(ChatCache(s3, BUCKET_NAME, CACHE_MAX_BYTES))
+    assert handle_event(appender, {"chats": [{"username": "user"}]})["status_code"] == 400
@@ -0,0 +1,152 @@
+'''
+Tests of history_journal: recovery of unacknowledged turns, deletion of
+acknowledged segments, and write errors.
+'''
+
+import os
+import threading
+
+import history_journal
+from history_journal import HistoryJournal, decode_records, encode_record
+from history_writer import WriteBehindBuffer
+
+SEGMENT_MAX_BYTES = 200
+
+
+class FailingSink:
+    """
+    A history sink that is down
+    """
+
+    def write(self, chats):
+        """
+        Fails every write
+        """
+        raise RuntimeError("sink is down")
+
+
+class RecordingSink:
+    """
+    A history sink that keeps the turns it writes
+    """
+
+    def __init__(self):
+        self.turns = []
+
+    def write(self, chats):
+        """
+        Writes every chat
+        """
+        for key, entries in chats.items():
+            self.turns.extend((key, entry) for entry in entries)
+        return list(chats)
+
+
+def journal_files(directory):
+    """
+    Returns the names of the journal segments in a directory
+    """
+    return sorted(name for name in os.listdir(directory) if name.endswith(".journal"))
+
+
+def test_records_round_trip_and_stop_at_a_torn_record():
+    """
+    Decoding stops at a truncated record
+    """
+    data = encode_record({"a": 1}) + encode_record({"b": 2})
+    records, valid_bytes = decode_records(data + encode_record({"c": 3})[:-1])
+    assert records == [{"a": 1}, {"b": 2}]
+    assert valid_bytes == len(data)
+
+
+def test_unwritten_turns_are_recovered_and_their_segments_deleted(tmp_path, wait_for):
+    """
+    Turns a stopped process did not write are written after a restart
+    """
+    directory = str(tmp_path)
+    journal = HistoryJournal(directory, SEGMENT_MAX_BYTES)
+    buffer = WriteBehindBuffer(FailingSink(), 100, 60, journal=journal)
+    for turn in range(5):
+        buffer.append("user", turn % 2, {"prompt": f"p{turn}"})
+    # The process stops without flushing
+    journal.close()
+    assert len(journal_files(directory)) > 1
+
+    recovered = HistoryJournal(directory, SEGMENT_MAX_BYTES)
+    assert len(recovered.recovered) == 5
+    sink = RecordingSink()
+    buffer = WriteBehindBuffer(sink, 100, 0.01, journal=recovered)
+    assert wait_for(lambda: len(sink.turns) == 5)
+    assert [entry["prompt"] for key, entry in sink.turns if key == ("user", 0)] == [
+        "p0",
+        "p2",
+        "p4",
+    ]
+    assert wait_for(lambda: not journal_files(directory))
+    assert recovered.stats()["acknowledged"] == 5
+    buffer.close()
+    assert not HistoryJournal(directory, SEGMENT_MAX_BYTES).recovered
+
+
+def test_torn_record_is_dropped_on_recovery(tmp_path):
+    """
+    A record torn by a crash is not recovered
+    """
+    directory = str(tmp_path)
+    journal = HistoryJournal(directory, SEGMENT_MAX_BYTES)
+    journal.append({"prompt": "kept"})
+    journal.close()
+    with open(os.path.join(directory, journal_files(directory)[-1]), "ab") as file:
+        file.write(encode_record({"prompt": "torn"})[:-3])
+
+    records = [record for record, _ in HistoryJournal(directory, SEGMENT_MAX_BYTES).recovered]
+    assert records == [{"prompt": "kept"}]
+
+
+def test_concurrent_appends_share_commits(tmp_path):
+    """
+    Concurrent appends are all durable
+    """
+    journal = HistoryJournal(str(tmp_path), 1024 * 1024)
+    threads = [
+        threading.Thread(target=lambda: [journal.append({"a": 1}) for _ in range(50)])
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    journal.close()
+    stats = journal.stats()
+    assert stats["appended"] == 400
+    assert stats["commits"] <= 400
+    assert len(HistoryJournal(str(tmp_path), 1024 * 1024).recovered) == 400
+
+
+def test_write_error_fails_the_commit_and_the_journal_keeps_working(tmp_path, monkeypatch):
+    """
+    A failed write only fails the turns of its commit
+    """
+    directory = str(tmp_path)
+    journal = HistoryJournal(directory, 1024 * 1024)
+    journal.append({"prompt": "before"})
+
+    def failing_fsync(fd):
+        raise OSError(28, "No space left on device")
+
+    monkeypatch.setattr(history_journal.os, "fsync", failing_fsync)
+    sink = RecordingSink()
+    buffer = WriteBehindBuffer(sink, 100, 60, journal=journal)
+    # The turn is queued without the journal instead of failing the request
+    buffer.append("user", 1, {"prompt": "unjournaled"})
+    assert buffer.stats()["unjournaled"] == 1
+    assert journal.stats()["failed_commits"] == 1
+
+    monkeypatch.undo()
+    buffer.append("user", 1, {"prompt": "after"})
+    assert buffer.stats()["unjournaled"] == 1
+    buffer.close()
+    assert [entry["prompt"] for _, entry in sink.turns] == ["unjournaled", "after"]
+    recovered = [record for record, _ in HistoryJournal(directory, 1024 * 1024).recovered]
+    assert {"prompt": "before"} in recovered
+    assert not any(record.get("model_history_entry") == {"prompt": "after"} for record in recovered)
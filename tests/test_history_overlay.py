@@ -0,0 +1,90 @@
+'''
+Tests of history_overlay: pending turns are placed by their index in the
+chat, not by value.
+'''
+
+import time
+
+from history_overlay import RecentTurnsOverlay, split_persisted
+
+TURN = {"prompt": "hi", "model_response": "hello"}
+
+
+def test_split_persisted_counts_the_pending_turns_below_the_stored_count():
+    """
+    Pending turns below the stored turn count are persisted
+    """
+    pending = [(3, "d"), (4, "e"), (5, "f")]
+    assert split_persisted(3, pending) == 0
+    assert split_persisted(4, pending) == 1
+    assert split_persisted(6, pending) == 3
+    assert split_persisted(10, pending) == 3
+    assert split_persisted(0, []) == 0
+
+
+def test_turn_equal_to_the_last_stored_turn_is_still_pending():
+    """
+    A turn is not confirmed by an equal turn before it
+    """
+    overlay = RecentTurnsOverlay(60, 100)
+    # The chat already ends with an identical turn, e.g. a cached reply
+    overlay.add("user", 1, 3, TURN)
+    assert overlay.pending("user", 1, 3) == [TURN]
+    assert overlay.has_pending("user", 1)
+    assert overlay.pending("user", 1, 4) == []
+    assert not overlay.has_pending("user", 1)
+    assert overlay.stats()["confirmed"] == 1
+
+
+def test_only_unpersisted_turns_are_returned_in_index_order():
+    """
+    Turns recorded out of order are returned in chat order
+    """
+    overlay = RecentTurnsOverlay(60, 100)
+    overlay.add("user", 1, 6, {"prompt": "c"})
+    overlay.add("user", 1, 4, {"prompt": "a"})
+    overlay.add("user", 1, 5, {"prompt": "b"})
+    assert overlay.pending("user", "1", 5) == [{"prompt": "b"}, {"prompt": "c"}]
+    assert overlay.pending("user", 1, 5) == [{"prompt": "b"}, {"prompt": "c"}]
+
+
+def test_turns_expire():
+    """
+    Turns no read confirms are dropped after the TTL
+    """
+    overlay = RecentTurnsOverlay(0.01, 100)
+    overlay.add("user", 1, 0, TURN)
+    time.sleep(0.02)
+    assert overlay.pending("user", 1, 0) == []
+    assert overlay.stats()["expired"] == 1
+
+
+def test_least_recently_updated_chats_are_dropped():
+    """
+    The overlay holds at most max_chats chats
+    """
+    overlay = RecentTurnsOverlay(60, 2)
+    for chat_id in range(3):
+        overlay.add("user", chat_id, 0, TURN)
+    assert not overlay.has_pending("user", 0)
+    assert overlay.has_pending("user", 2)
+    assert overlay.stats()["chats"] == 2
+
+
+def test_turns_are_pending_until_placed():
+    """
+    A turn recorded before its index is known is never confirmed, comes
+    after the placed turns, and is dropped if it cannot be placed
+    """
+    overlay = RecentTurnsOverlay(60, 100)
+    first = overlay.add("user", 1, None, {"prompt": "a"})
+    overlay.add("user", 1, 5, {"prompt": "b"})
+    assert overlay.pending("user", 1, 100) == [{"prompt": "a"}]
+    overlay.place("user", 1, first, 6)
+    assert overlay.pending("user", 1, 6) == [{"prompt": "a"}]
+    assert overlay.pending("user", 1, 7) == []
+
+    unplaced = overlay.add("user", 2, None, TURN)
+    overlay.place("user", 2, unplaced, None)
+    assert not overlay.has_pending("user", 2)
+    assert overlay.stats()["unplaced"] == 1
@@ -0,0 +1,170 @@
+'''
+Tests of history_writer: coalescing, ordering and requeueing of failed
+chats by the write-behind buffer, and partial failures of the Lambda sink.
+'''
+
+import threading
+from collections import OrderedDict
+
+import pytest
+from botocore.exceptions import ClientError
+
+import history_writer
+import json_codec
+from history_writer import LambdaHistorySink, WriteBehindBuffer
+
+
+class FlakySink:
+    """
+    A history sink that fails the chats in fail_chats a number of times
+    - failures: int, writes of each of those chats that fail
+    """
+
+    def __init__(self, fail_chats=(), failures: int = 0):
+        self.fail_chats = set(fail_chats)
+        self.failures = failures
+        self.writes = []
+        self.turns = {}
+        self._lock = threading.Lock()
+
+    def write(self, chats):
+        """
+        Writes the chats that do not fail
+        """
+        with self._lock:
+            self.writes.append(OrderedDict((key, list(entries)) for key, entries in chats.items()))
+            failing = self.failures > 0
+            self.failures -= 1
+            written = []
+            for key, entries in chats.items():
+                if failing and key in self.fail_chats:
+                    continue
+                self.turns.setdefault(key, []).extend(entries)
+                written.append(key)
+            return written
+
+
+class FailingLambda:
+    """
+    A Lambda client whose invocations fail after the first few
+    """
+
+    def __init__(self, successes: int):
+        self.successes = successes
+        self.payloads = []
+
+    def invoke(self, **kwargs):
+        """
+        Records the invocation, or fails it
+        """
+        if len(self.payloads) >= self.successes:
+            raise ClientError({"Error": {"Code": "TooManyRequestsException"}}, "Invoke")
+        self.payloads.append(kwargs["Payload"])
+
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    """
+    Retries failed flushes without the production delay
+    """
+    monkeypatch.setattr(history_writer, "RETRY_DELAY_SECONDS", 0.01)
+
+
+def prompts(turns):
+    """
+    Returns the prompts of a list of turns
+    """
+    return [turn["prompt"] for turn in turns]
+
+
+def test_turns_of_a_chat_are_coalesced_into_one_write(wait_for):
+    """
+    Each flush writes every chat once
+    """
+    sink = FlakySink()
+    buffer = WriteBehindBuffer(sink, 6, 60)
+    for turn in range(6):
+        buffer.append("user", turn % 2, {"prompt": turn})
+    assert wait_for(lambda: buffer.stats()["written"] == 6)
+    buffer.close()
+    assert len(sink.writes) == 1
+    assert prompts(sink.writes[0][("user", 0)]) == [0, 2, 4]
+    assert prompts(sink.writes[0][("user", 1)]) == [1, 3, 5]
+
+
+def test_flush_after_an_idle_period_is_not_delayed(wait_for):
+    """
+    A turn queued while the flusher is idle is flushed on time
+    """
+    sink = FlakySink()
+    buffer = WriteBehindBuffer(sink, 100, 0.05)
+    buffer.append("user", 1, {"prompt": "first"})
+    assert wait_for(lambda: buffer.stats()["written"] == 1, timeout=1)
+    # The flusher is idle now, with nothing queued
+    buffer.append("user", 1, {"prompt": "second"})
+    assert wait_for(lambda: buffer.stats()["written"] == 2, timeout=1)
+    buffer.close()
+
+
+def test_failed_chat_is_retried_ahead_of_newer_turns(wait_for):
+    """
+    Turns of a failed chat are written before the turns queued since
+    """
+    sink = FlakySink(fail_chats={("user", 1)}, failures=1)
+    buffer = WriteBehindBuffer(sink, 2, 0.05)
+    buffer.append("user", 1, {"prompt": "a"})
+    buffer.append("user", 2, {"prompt": "x"})
+    assert wait_for(lambda: sink.writes)
+    buffer.append("user", 1, {"prompt": "b"})
+    assert wait_for(lambda: buffer.stats()["written"] == 3)
+    buffer.close()
+
+    assert prompts(sink.turns[("user", 1)]) == ["a", "b"]
+    assert prompts(sink.turns[("user", 2)]) == ["x"]
+    stats = buffer.stats()
+    assert stats["failed_flushes"] == 1
+    assert stats["queued"] == 0
+
+
+def test_close_drains_the_queue():
+    """
+    Closing writes the queued turns and refuses new ones
+    """
+    sink = FlakySink()
+    buffer = WriteBehindBuffer(sink, 100, 60)
+    for turn in range(3):
+        buffer.append("user", 1, {"prompt": turn})
+    buffer.close()
+    assert prompts(sink.turns[("user", 1)]) == [0, 1, 2]
+    with pytest.raises(RuntimeError):
+        buffer.append("user", 1, {"prompt": "late"})
+
+
+def test_lambda_sink_keeps_the_turns_it_did_not_send():
+    """
+    Only the turns that were not sent are retried
+    """
+    lambda_client = FailingLambda(successes=1)
+    sink = LambdaHistorySink(lambda_client, "AddChatHistory", batched=False)
+    chats = OrderedDict({("user", 1): [{"prompt": "a"}, {"prompt": "b"}]})
+    assert not sink.write(chats)
+    assert len(lambda_client.payloads) == 1
+    assert chats[("user", 1)] == [{"prompt": "b"}]
+
+
+def test_lambda_sink_sends_one_invocation_per_flush():
+    """
+    By default every chat of a flush goes in one batched event
+    """
+    lambda_client = FailingLambda(successes=1)
+    sink = LambdaHistorySink(lambda_client, "AddChatHistory")
+    chats = OrderedDict(
+        {("user", 1): [{"prompt": "a"}, {"prompt": "b"}], ("user", 2): [{"prompt": "c"}]}
+    )
+    assert sink.write(chats) == [("user", 1), ("user", 2)]
+    assert json_codec.loads(lambda_client.payloads[0]) == {
+        "chats": [
+            {"username": "user", "chat_id": 1, "model_history_entries": chats[("user", 1)]},
+            {"username": "user", "chat_id": 2, "model_history_entries": chats[("user", 2)]},
+        ]
+    }
@@ -0,0 +1,104 @@
+'''
+Tests of micro_batcher: which concurrent prompts share an endpoint request,
+and how batched results and errors reach each waiting request.
+'''
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from micro_batcher import MicroBatcher, parse_batch_response
+
+
+class RecordingEndpoint:
+    """
+    A batched endpoint that answers each input with its upper-case copy and
+    records the batches it was sent
+    """
+
+    def __init__(self, error: Exception = None):
+        self.error = error
+        self.batches = []
+        self._lock = threading.Lock()
+
+    def send_batch(self, inputs: list, parameters: dict):
+        """
+        Answers one batched request
+        """
+        with self._lock:
+            self.batches.append((list(inputs), parameters))
+        if self.error is not None:
+            raise self.error
+        return [text.upper() for text in inputs]
+
+
+def submit_all(batcher: MicroBatcher, requests: list):
+    """
+    Submits (inputs, parameters) requests concurrently and returns their
+    results in order
+    """
+    with ThreadPoolExecutor(max_workers=len(requests)) as executor:
+        futures = [executor.submit(batcher.submit, *request) for request in requests]
+        return [future.result() for future in futures]
+
+
+def test_parse_batch_response():
+    """
+    Both shapes of a batched container response give one text per input,
+    and a response of the wrong length is rejected
+    """
+    assert parse_batch_response(
+        [[{"generated_text": "a"}], {"generated_text": "b"}], 2
+    ) == ["a", "b"]
+    with pytest.raises(ValueError):
+        parse_batch_response([{"generated_text": "a"}], 2)
+    with pytest.raises(ValueError):
+        parse_batch_response({"generated_text": "a"}, 1)
+
+
+def test_concurrent_prompts_share_a_request():
+    """
+    Prompts with the same parameters are sent together as soon as a batch
+    fills up, and each request gets the result for its own input
+    """
+    endpoint = RecordingEndpoint()
+    batcher = MicroBatcher(endpoint.send_batch, max_batch_size=2, max_wait_ms=5000)
+    prompts = ["a", "b", "c", "d"]
+    results = submit_all(batcher, [(prompt, {"top_p": 0.9}) for prompt in prompts])
+
+    assert results == ["A", "B", "C", "D"]
+    assert sorted(len(inputs) for inputs, _ in endpoint.batches) == [2, 2]
+    assert sorted(text for inputs, _ in endpoint.batches for text in inputs) == prompts
+    assert batcher.stats()["batch_size"]["count"] == 2
+
+
+def test_prompts_with_different_parameters_are_not_batched():
+    """
+    Only prompts with identical parameters share a request, and a prompt
+    left alone is sent once it has waited max_wait_ms
+    """
+    endpoint = RecordingEndpoint()
+    batcher = MicroBatcher(endpoint.send_batch, max_batch_size=8, max_wait_ms=20)
+    results = submit_all(batcher, [("a", {"top_p": 0.9}), ("b", {"top_p": 0.5})])
+
+    assert results == ["A", "B"]
+    assert sorted(endpoint.batches, key=lambda batch: batch[0]) == [
+        (["a"], {"top_p": 0.9}),
+        (["b"], {"top_p": 0.5}),
+    ]
+    assert batcher.stats()["queued"] == 0
+
+
+def test_a_failed_batch_fails_every_request_in_it():
+    """
+    An endpoint error is raised in every request of the batch
+    """
+    endpoint = RecordingEndpoint(error=RuntimeError("endpoint unavailable"))
+    batcher = MicroBatcher(endpoint.send_batch, max_batch_size=2, max_wait_ms=5000)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [executor.submit(batcher.submit, prompt, {}) for prompt in "ab"]
+        for future in futures:
+            with pytest.raises(RuntimeError, match="endpoint unavailable"):
+                future.result()
+    assert len(endpoint.batches) == 1
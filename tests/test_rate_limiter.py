@@ -0,0 +1,155 @@
+'''
+Tests of rate_limiter: token bucket refill, and the fair scheduler's round
+robin between users and queue timeouts.
+'''
+
+import threading
+
+import pytest
+
+import rate_limiter
+from rate_limiter import (
+    FairScheduler,
+    InMemoryTokenBuckets,
+    QueueTimeout,
+    RateLimited,
+    RateLimiter,
+)
+from tests.conftest import client_error
+
+
+class FakeClock:
+    """
+    A monotonic clock moved by hand
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        """
+        Returns the current time
+        """
+        return self.now
+
+
+class FailingStore:
+    """
+    A bucket store whose table is unavailable
+    """
+
+    def take(self, key, rate, burst):
+        """
+        Fails like a DynamoDB call
+        """
+        raise client_error("ProvisionedThroughputExceededException", 400)
+
+
+@pytest.fixture(name="clock")
+def fake_clock(monkeypatch):
+    """
+    Replaces the clock of the in-memory buckets
+    """
+    fake = FakeClock()
+    monkeypatch.setattr(rate_limiter, "time", fake)
+    return fake
+
+
+def test_bucket_allows_a_burst_then_refills(clock):
+    """
+    A full bucket allows a burst, then one request per refilled token, and
+    tells rejected requests when the next token arrives
+    """
+    limiter = RateLimiter(InMemoryTokenBuckets(), requests_per_minute=60, burst=3)
+    for _ in range(3):
+        limiter.check("alice")
+    with pytest.raises(RateLimited) as raised:
+        limiter.check("alice")
+    assert raised.value.retry_after == pytest.approx(1)
+    assert raised.value.status_code == 429
+
+    clock.now += 0.5
+    with pytest.raises(RateLimited) as raised:
+        limiter.check("alice")
+    assert raised.value.retry_after == pytest.approx(0.5)
+    clock.now += 0.5
+    limiter.check("alice")
+
+    # Refill stops at the burst size
+    clock.now += 60
+    for _ in range(3):
+        limiter.check("alice")
+    with pytest.raises(RateLimited):
+        limiter.check("alice")
+    assert limiter.stats()["allowed"] == 7
+    assert limiter.stats()["limited"] == 3
+
+
+@pytest.mark.usefixtures("clock")
+def test_users_have_their_own_buckets():
+    """
+    One user's requests do not drain another user's bucket
+    """
+    limiter = RateLimiter(InMemoryTokenBuckets(), requests_per_minute=60, burst=1)
+    limiter.check("alice")
+    with pytest.raises(RateLimited):
+        limiter.check("alice")
+    limiter.check("bob")
+
+
+def test_store_failures_allow_requests():
+    """
+    An unavailable store does not turn every request away
+    """
+    limiter = RateLimiter(FailingStore(), requests_per_minute=60, burst=1)
+    for _ in range(3):
+        limiter.check("alice")
+    assert limiter.stats()["store_errors"] == 3
+
+
+def test_waiting_too_long_for_a_slot_raises_queue_timeout():
+    """
+    A request that gets no slot within max_wait_seconds gives up with a 503,
+    and leaves the queue
+    """
+    scheduler = FairScheduler(1, max_wait_seconds=0.05)
+    scheduler.acquire("alice")
+    with pytest.raises(QueueTimeout) as raised:
+        scheduler.acquire("bob")
+    assert isinstance(raised.value, RateLimited)
+    assert raised.value.status_code == 503
+    stats = scheduler.stats()
+    assert (stats["active"], stats["queued"], stats["timeouts"]) == (1, 0, 1)
+
+    scheduler.release()
+    scheduler.acquire("bob")
+    assert scheduler.stats()["active"] == 1
+
+
+def test_freed_slots_go_round_robin_between_users(wait_for):
+    """
+    A user with many queued requests gets one freed slot in turn with the
+    other waiting users, not every slot until its queue is empty
+    """
+    scheduler = FairScheduler(1)
+    scheduler.acquire("holder")
+    granted = []
+    threads = []
+
+    def request(key):
+        scheduler.acquire(key)
+        granted.append(key)
+
+    for key in ["busy", "busy", "busy", "quiet"]:
+        thread = threading.Thread(target=request, args=(key,))
+        thread.start()
+        threads.append(thread)
+        assert wait_for(lambda queued=len(threads): scheduler.stats()["queued"] == queued)
+
+    for expected in range(1, 5):
+        scheduler.release()
+        assert wait_for(lambda expected=expected: len(granted) == expected)
+    for thread in threads:
+        thread.join()
+    assert granted == ["busy", "quiet", "busy", "busy"]
+    assert scheduler.stats()["active"] == 1